@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+# -*- coding:UTF-8 -*-
+# Copyright (c) 2020 Nicolas Iooss
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""Send many DNS queries at once from a single UDP socket
+
+Instead of running a program like dig for every query, the queries are
+crafted with dnspython and many of them are kept in flight on the same
+socket. Responses are matched to their queries by ID and question, and the
+queries which did not get any response are sent again after a timeout.
+Truncated responses are queried again over TCP.
+
+The records are returned as (name, type, fields) tuples, where fields are
+the text representation of the data of the record, like in the output of
+dig. For example:
+
+    dns_client.py -t NSEC3PARAM example.org
+
+Without any name, this script tests the client against a local stub server.
+"""
+import argparse
+import logging
+import random
+import select
+import socket
+import threading
+import time
+
+try:
+    import dns.message
+    HAVE_DNSPYTHON = True
+except ImportError:
+    HAVE_DNSPYTHON = False
+else:
+    import dns.exception
+    import dns.flags
+    import dns.query
+    import dns.rcode
+    import dns.rdatatype
+    import dns.rrset
+
+
+logger = logging.getLogger(__name__)
+
+
+# Default number of queries which are sent without having received their responses
+DEFAULT_MAX_IN_FLIGHT = 64
+
+# Default number of seconds to wait for a response before sending a query again
+DEFAULT_TIMEOUT = 2.0
+
+# Default number of times a query is sent again
+DEFAULT_RETRIES = 3
+
+
+def get_system_nameserver(resolv_conf='/etc/resolv.conf'):
+    """Get the first nameserver configured in /etc/resolv.conf"""
+    try:
+        with open(resolv_conf, 'r') as fd:
+            for line in fd:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == 'nameserver':
+                    # Drop the scope of IPv6 link-local addresses
+                    return fields[1].split('%', 1)[0]
+    except IOError as exc:
+        logger.warning("Unable to read %r: %s", resolv_conf, exc)
+    return '127.0.0.1'
+
+
+def get_message_records(message, rdtypes=None):
+    """Get the (name, type, fields) of the records of all the sections of a DNS message"""
+    records = []
+    for section in (message.answer, message.authority, message.additional):
+        for rrset in section:
+            rdtype = dns.rdatatype.to_text(rrset.rdtype)
+            if rdtypes is not None and rdtype not in rdtypes:
+                continue
+            name = rrset.name.to_text()
+            for rdata in rrset:
+                records.append((name, rdtype, rdata.to_text().split()))
+    return records
+
+
+class DnsClient(object):
+    """Client sending batches of DNS queries to a recursive resolver"""
+    def __init__(self, server=None, port=53, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        if not HAVE_DNSPYTHON:
+            raise RuntimeError("Sending DNS queries requires dnspython")
+        self.server = server or get_system_nameserver()
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.max_in_flight = max_in_flight
+
+        addrinfo = socket.getaddrinfo(self.server, self.port, 0, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        family, socktype, proto, _, self.server_addr = addrinfo[0]
+        self.sock = socket.socket(family, socktype, proto)
+        self.sock.setblocking(False)
+
+        # Statistics
+        self.sent_count = 0
+        self.received_count = 0
+        self.failed_count = 0
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def receive_responses(self, pending, deadline):
+        """Receive the responses which are available, waiting for them until the deadline
+
+        pending is a dictionary of ID -> (key, query, send count, time of the last sending)
+        which is updated. Yield (key, query, response message).
+        """
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        readable, _, _ = select.select([self.sock], [], [], remaining)
+        if not readable:
+            return
+        while pending:
+            try:
+                data, addr = self.sock.recvfrom(65535)
+            except BlockingIOError:
+                return
+            except ConnectionRefusedError:
+                # An ICMP error reported by a previous sending. Let the timeout handle it.
+                continue
+            try:
+                response = dns.message.from_wire(data)
+            except dns.exception.DNSException as exc:
+                logger.debug("Ignoring invalid DNS message from %r: %s", addr, exc)
+                continue
+            entry = pending.get(response.id)
+            if entry is None or not entry[1].is_response(response):
+                logger.debug("Ignoring unexpected DNS response %d from %r", response.id, addr)
+                continue
+            del pending[response.id]
+            self.received_count += 1
+            yield entry[0], entry[1], response
+
+    def query_tcp(self, query):
+        """Send a query over TCP, for responses which do not fit in UDP datagrams"""
+        for _ in range(self.retries + 1):
+            self.sent_count += 1
+            try:
+                response = dns.query.tcp(query, self.server_addr[0], timeout=self.timeout, port=self.port)
+            except (EOFError, OSError, dns.exception.DNSException) as exc:
+                logger.debug("Failed to query %s over TCP: %s", query.question[0].name, exc)
+                continue
+            self.received_count += 1
+            return response
+        return None
+
+    def iter_responses(self, get_query):
+        """Send queries as long as get_query() gives some, and yield (key, response message) as they arrive
+
+        get_query() returns (key, name, type) for a new query, or None when
+        there is no query to send for now. It is called again whenever a
+        response arrives, so that the caller can enqueue queries which depend
+        on the responses. The iteration ends when get_query() returns None
+        while no query is in flight. The response is None when the resolver
+        did not answer.
+        """
+        pending = {}
+        while True:
+            now = time.monotonic()
+
+            # Send the queries which timed out again, or give up
+            for query_id, (key, query, send_count, sent_time) in list(pending.items()):
+                if sent_time + self.timeout > now:
+                    continue
+                if send_count > self.retries:
+                    logger.warning("No response for %s <%s> after %d queries",
+                                   query.question[0].name, dns.rdatatype.to_text(query.question[0].rdtype),
+                                   send_count)
+                    del pending[query_id]
+                    self.failed_count += 1
+                    yield key, None
+                    continue
+                self.sock.sendto(query.to_wire(), self.server_addr)
+                self.sent_count += 1
+                pending[query_id] = (key, query, send_count + 1, now)
+
+            # Fill the window of queries in flight
+            while len(pending) < self.max_in_flight:
+                next_query = get_query()
+                if next_query is None:
+                    break
+                key, name, rdtype = next_query
+                query = dns.message.make_query(name, rdtype, want_dnssec=True)
+                while query.id in pending:
+                    query.id = random.randint(0, 0xffff)
+                self.sock.sendto(query.to_wire(), self.server_addr)
+                self.sent_count += 1
+                pending[query.id] = (key, query, 1, now)
+
+            if not pending:
+                return
+
+            # Wait for some responses, until the oldest query times out
+            deadline = min(entry[3] for entry in pending.values()) + self.timeout
+            for key, query, response in self.receive_responses(pending, deadline):
+                if response.flags & dns.flags.TC:
+                    logger.debug("Truncated DNS response for %s <%s>, using TCP",
+                                 query.question[0].name, dns.rdatatype.to_text(query.question[0].rdtype))
+                    response = self.query_tcp(query)
+                    if response is None:
+                        logger.warning("No response for %s <%s> over TCP",
+                                       query.question[0].name, dns.rdatatype.to_text(query.question[0].rdtype))
+                        self.failed_count += 1
+                yield key, response
+
+    def query_many(self, questions):
+        """Send queries for a list of (name, type), in parallel
+
+        Return a list with the response message of each question, or None if
+        the resolver did not answer.
+        """
+        results = [None] * len(questions)
+        indexed_questions = iter(enumerate(questions))
+
+        def get_query():
+            index, question = next(indexed_questions, (None, None))
+            return None if question is None else (index, question[0], question[1])
+
+        for index, response in self.iter_responses(get_query):
+            results[index] = response
+        return results
+
+    def query_records(self, questions, rdtypes=None):
+        """Send queries for a list of (name, type) and return the list of records of each question
+
+        Questions which did not get any response get None instead of a list.
+        """
+        return [
+            get_message_records(response, rdtypes) if response is not None else None
+            for response in self.query_many(questions)
+        ]
+
+
+class DnsStubServer(object):
+    """Authoritative DNS server for tests, answering from a dictionary of (name, type) -> list of data
+
+    It listens on a random port of the loopback interface, with UDP and TCP.
+    Queries for names which are not in the dictionary get NXDOMAIN. With
+    drop_first, the first copy of every query is dropped, to test the retries.
+    """
+    def __init__(self, records, drop_first=False):
+        self.records = {(name.lower(), rdtype): rdatas for (name, rdtype), rdatas in records.items()}
+        self.names = set(name for name, _ in self.records.keys())
+        self.drop_first = drop_first
+        self.seen_queries = set()
+        self.udp_count = 0
+        self.tcp_count = 0
+
+        self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_sock.bind(('127.0.0.1', 0))
+        self.port = self.udp_sock.getsockname()[1]
+        self.tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp_sock.bind(('127.0.0.1', self.port))
+        self.tcp_sock.listen(8)
+
+        self.is_running = True
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.is_running = False
+        self.thread.join()
+        self.udp_sock.close()
+        self.tcp_sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def make_response(self, query):
+        """Craft the response of a query"""
+        response = dns.message.make_response(query)
+        response.flags |= dns.flags.AA
+        question = query.question[0]
+        name = question.name.to_text().lower()
+        if name not in self.names:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+        rdatas = self.records.get((name, dns.rdatatype.to_text(question.rdtype)))
+        if rdatas:
+            response.answer.append(dns.rrset.from_text_list(question.name, 60, 'IN', question.rdtype, rdatas))
+        return response
+
+    def handle_udp(self):
+        data, addr = self.udp_sock.recvfrom(65535)
+        query = dns.message.from_wire(data)
+        self.udp_count += 1
+        if self.drop_first and (query.id, query.question[0].name) not in self.seen_queries:
+            self.seen_queries.add((query.id, query.question[0].name))
+            return
+        response = self.make_response(query)
+        try:
+            wire = response.to_wire(max_size=query.payload if query.edns >= 0 else 512)
+        except dns.exception.TooBig:
+            response = dns.message.make_response(query)
+            response.flags |= dns.flags.AA | dns.flags.TC
+            wire = response.to_wire()
+        self.udp_sock.sendto(wire, addr)
+
+    def handle_tcp(self):
+        conn, _ = self.tcp_sock.accept()
+        with conn:
+            query, _ = dns.query.receive_tcp(conn)
+            self.tcp_count += 1
+            dns.query.send_tcp(conn, self.make_response(query).to_wire(max_size=65535))
+
+    def serve(self):
+        while self.is_running:
+            readable, _, _ = select.select([self.udp_sock, self.tcp_sock], [], [], 0.1)
+            if self.udp_sock in readable:
+                self.handle_udp()
+            if self.tcp_sock in readable:
+                self.handle_tcp()
+
+
+def self_test():
+    """Test the client against a stub server which drops the first copy of every query"""
+    records = {
+        ('example.org.', 'NSEC'): ['host0.example.org. A NS SOA RRSIG NSEC'],
+        ('example.org.', 'NSEC3PARAM'): ['1 0 5 aabbccdd'],
+        ('example.org.', 'TXT'): ['"{}{}"'.format(index, 'x' * 200) for index in range(20)],
+    }
+    for index in range(200):
+        records[('host{}.example.org.'.format(index), 'A')] = ['192.0.2.{}'.format(index % 256)]
+    questions = [('host{}.example.org.'.format(index), 'A') for index in range(200)]
+    questions += [('example.org.', 'NSEC'), ('example.org.', 'NSEC3PARAM'), ('example.org.', 'TXT')]
+    questions.append(('nonexistent.example.org.', 'A'))
+
+    with DnsStubServer(records, drop_first=True) as server:
+        with DnsClient(server='127.0.0.1', port=server.port, timeout=0.2, max_in_flight=32) as client:
+            responses = client.query_many(questions)
+            for (name, rdtype), response in zip(questions, responses):
+                assert response is not None, "no response for {} <{}>".format(name, rdtype)
+                fields = [record[2] for record in get_message_records(response, (rdtype, ))]
+                expected = [rdata.split() for rdata in records.get((name, rdtype), [])]
+                assert sorted(fields) == sorted(expected), "unexpected {} <{}>: {}".format(name, rdtype, fields)
+            assert responses[-1].rcode() == dns.rcode.NXDOMAIN
+            # Every query was sent twice over UDP, and the large TXT record was queried over TCP
+            assert server.udp_count == 2 * len(questions), server.udp_count
+            assert server.tcp_count == 1, server.tcp_count
+            assert client.failed_count == 0
+    logger.info("Received %d responses from the stub server, after %d queries", len(responses), client.sent_count)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Send DNS queries")
+    parser.add_argument('names', metavar="NAME", nargs='*', type=str,
+                        help="domain names to query (default: test against a local stub server)")
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help="show debug messages")
+    parser.add_argument('-s', '--server', type=str,
+                        help="DNS server to query (default: first nameserver of /etc/resolv.conf)")
+    parser.add_argument('-p', '--port', type=int, default=53,
+                        help="port of the DNS server")
+    parser.add_argument('-t', '--type', type=str, default='A',
+                        help="type of the records to query")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='[%(levelname)-5s] %(message)s',
+                        level=logging.DEBUG if args.debug else logging.INFO)
+
+    if not args.names:
+        self_test()
+        return 0
+
+    with DnsClient(server=args.server, port=args.port) as client:
+        responses = client.query_many([(name, args.type) for name in args.names])
+    for name, response in zip(args.names, responses):
+        if response is None:
+            print("; no response for {}".format(name))
+            continue
+        print("; {} <{}>: {}".format(name, args.type, dns.rcode.to_text(response.rcode())))
+        for record_name, rdtype, fields in get_message_records(response):
+            print("{} IN {} {}".format(record_name, rdtype, ' '.join(fields)))
+    return 0
+
+
+if __name__ == '__main__':
+    main()
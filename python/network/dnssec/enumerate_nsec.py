@@ -26,13 +26,28 @@ Some domains where it works:
 * example.com
 * dnssec-tools.org
 * internetsociety.org.
+
+The queries are sent from the process when dnspython is available, and with
+drill, dig or host otherwise.
+
+With dnspython, the chain is walked from several names at once: the given
+domain, the names of a wordlist (option --wordlist) and the ends of the
+fragments of the chain which were saved by a previous run (option --state).
+Each received record gives a new name to query, and the fragments merge when
+one reaches the start of another. For example:
+
+    enumerate_nsec.py -S example.org.state -w words.txt -Q 100 example.org
 """
 import argparse
+import collections
 import errno
 import logging
 import re
 import subprocess
 import sys
+import time
+
+from dns_client import DEFAULT_MAX_IN_FLIGHT, HAVE_DNSPYTHON, DnsClient, get_message_records
 
 
 logger = logging.getLogger(__name__)
@@ -55,10 +70,19 @@ class NSecRecord(object):
         fields = line.strip().split(None)
         assert fields[2] == 'IN', "Unknown DNS class {}".format(fields[2])
         assert fields[3] == 'NSEC', "Not a DNS NSEC record: type {}".format(fields[3])
+        return cls.from_dns_fields(fields[0], fields[4:])
+
+    def to_dns_line(self):
+        """Write a line like a BIND entry or a result of command 'dig'"""
+        return '{} 60 IN NSEC {} {}'.format(self.name, self.next_name, ' '.join(self.record_types))
+
+    @classmethod
+    def from_dns_fields(cls, name, fields):
+        """Build a record from its name and the fields of its data (next name and record types)"""
         return cls(
-            name=fields[0],
-            next_name=fields[4],
-            record_types=fields[5:],
+            name=name,
+            next_name=fields[0],
+            record_types=fields[1:],
         )
 
     @classmethod
@@ -95,7 +119,10 @@ class NSecRecord(object):
 
     @classmethod
     def query_dns(cls, domain, use_host=False):
-        """Query the DNS server for a NSEC record for the specified domain"""
+        """Query the DNS server for a NSEC record for the specified domain
+
+        This is used without dnspython, as DnsClient queries are sent by NSecWalker.
+        """
         if use_host:
             # Force using host
             return cls.query_dns_with_host(domain)
@@ -120,8 +147,142 @@ class NSecRecord(object):
         return cls.query_dns_with_host(domain)
 
 
-def enumerate_with_nsec(domain, use_host=False):
+class NSecWalker(object):
+    """Walk a NSEC chain from several names at once, keeping many queries in flight
+
+    The records are indexed by lowercase owner name. The state file, if any,
+    receives every new record as soon as it is known, to resume the walk.
+    """
+    def __init__(self, dns_client, state_file=None):
+        self.dns_client = dns_client
+        self.state_file = state_file
+        self.records = {}
+        # Names which are waiting to be queried, and all the names which have been queued
+        self.queue = collections.deque()
+        self.queued_names = set()
+        # Record of the first NSEC of the response of each queried name
+        self.query_results = {}
+        self.query_count = 0
+        self.last_progress_time = 0
+
+    def load_state(self, zone):
+        """Load the records of a zone saved in the state file, returning how many there were
+
+        The state file may be shared by several zones: the records of the other
+        ones are ignored.
+        """
+        zone = zone.lower().rstrip('.')
+        try:
+            with open(self.state_file, 'r') as fd:
+                for line in fd:
+                    if line.strip() and not line.startswith((';', '#')):
+                        nsec = NSecRecord.from_dns_entry(line)
+                        name = nsec.name.lower().rstrip('.')
+                        if not zone or name == zone or name.endswith('.' + zone):
+                            self.records[nsec.name.lower()] = nsec
+        except IOError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+        return len(self.records)
+
+    def get_fragment_ends(self):
+        """Get the next names of the known records which are not known records"""
+        return [nsec.next_name for nsec in self.records.values() if nsec.next_name.lower() not in self.records]
+
+    def enqueue(self, name):
+        """Queue a name to be queried, unless it is already known"""
+        key = name.lower()
+        if key in self.records or key in self.queued_names:
+            return
+        self.queued_names.add(key)
+        self.queue.append(name)
+
+    def get_query(self):
+        """Get the next query to send, for DnsClient.iter_responses()"""
+        while self.queue:
+            name = self.queue.popleft()
+            # The record may have been received since the name was queued
+            if name.lower() not in self.records:
+                return (name, name, 'NSEC')
+        return None
+
+    def add_record(self, nsec, state_fd=None):
+        """Add a received record, and queue its next name"""
+        key = nsec.name.lower()
+        if key in self.records:
+            return
+        self.records[key] = nsec
+        if state_fd is not None:
+            state_fd.write(nsec.to_dns_line() + '\n')
+        self.enqueue(nsec.next_name)
+
+    def show_progress(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_progress_time < 1:
+            return
+        self.last_progress_time = now
+        logger.info("Walked %d NSEC records with %d queries (%d fragment ends, %d queued names)",
+                    len(self.records), self.query_count, len(self.get_fragment_ends()), len(self.queue))
+
+    def walk(self, seeds):
+        """Walk the chain from some seed names and from the ends of the known fragments"""
+        for name in seeds:
+            self.enqueue(name)
+        for name in self.get_fragment_ends():
+            self.enqueue(name)
+
+        state_fd = open(self.state_file, 'a') if self.state_file else None
+        try:
+            for name, response in self.dns_client.iter_responses(self.get_query):
+                self.query_count += 1
+                if response is None:
+                    continue
+                records = get_message_records(response, ('NSEC', ))
+                if not records:
+                    logger.debug("No NSEC record for %r", name)
+                    continue
+                self.query_results[name.lower()] = NSecRecord.from_dns_fields(records[0][0], records[0][2])
+                for record_name, _, fields in records:
+                    self.add_record(NSecRecord.from_dns_fields(record_name, fields), state_fd)
+                if state_fd is not None:
+                    state_fd.flush()
+                self.show_progress()
+        finally:
+            if state_fd is not None:
+                state_fd.close()
+        self.show_progress(force=True)
+
+    def get_record(self, name):
+        """Get the record which is received when querying a name"""
+        return self.records.get(name.lower()) or self.query_results.get(name.lower())
+
+
+def enumerate_with_nsec_walker(domain, dns_client, seeds=(), state_file=None):
+    """Enumerate the content of a zone by walking the NSEC chain from several names at once"""
+    walker = NSecWalker(dns_client, state_file=state_file)
+    if state_file:
+        logger.info("Loaded %d NSEC records from %r", walker.load_state(domain), state_file)
+    walker.walk([domain] + list(seeds))
+
+    # Show the chain from the domain, like when walking it one name at a time
+    known_entries = set()
+    while domain.lower() not in known_entries:
+        nsec = walker.get_record(domain)
+        if nsec is None:
+            logger.error("No NSEC record found for %r", domain)
+            return False
+        print("{} ({})".format(nsec.name, ', '.join(nsec.record_types)))
+        known_entries.add(nsec.name.lower())
+        domain = nsec.next_name
+    print("[NSEC loop closed with {}]".format(domain))
+    return True
+
+
+def enumerate_with_nsec(domain, use_host=False, dns_client=None, seeds=(), state_file=None):
     """Enumerate the content of a zone using NSEC entries"""
+    if dns_client is not None:
+        return enumerate_with_nsec_walker(domain, dns_client, seeds=seeds, state_file=state_file)
+
     known_entries = set()
     while domain not in known_entries:
         nsec = NSecRecord.query_dns(domain, use_host=use_host)
@@ -143,14 +304,43 @@ def main(argv=None):
                         help="show debug messages")
     parser.add_argument('-H', '--use-host', action='store_true',
                         help="use command 'host'")
+    parser.add_argument('-s', '--server', type=str,
+                        help="DNS server to query (default: first nameserver of /etc/resolv.conf)")
+    parser.add_argument('-p', '--port', type=int, default=53,
+                        help="port of the DNS server")
+    parser.add_argument('-Q', '--max-in-flight', type=int, default=DEFAULT_MAX_IN_FLIGHT,
+                        help="maximum number of concurrent DNS queries (default: {})".format(DEFAULT_MAX_IN_FLIGHT))
+    parser.add_argument('-w', '--wordlist', type=str,
+                        help="start walking the chain from the subdomains named by the words of a list too")
+    parser.add_argument('-S', '--state', type=str,
+                        help="save the walked records in a file, to resume the walk from it")
     args = parser.parse_args(argv)
 
     logging.basicConfig(format='[%(levelname)-5s] %(message)s',
                         level=logging.DEBUG if args.debug else logging.INFO)
 
-    for domain in args.domains:
-        if not enumerate_with_nsec(domain, use_host=args.use_host):
-            return 1
+    dns_client = None
+    if HAVE_DNSPYTHON and not args.use_host:
+        dns_client = DnsClient(server=args.server, port=args.port, max_in_flight=args.max_in_flight)
+    elif args.server or args.wordlist or args.state:
+        parser.error("options --server, --wordlist and --state require dnspython, without --use-host")
+
+    words = []
+    if args.wordlist:
+        with open(args.wordlist, 'r') as fd:
+            words = [line.strip().strip('.') for line in fd if line.strip().strip('.')]
+
+    try:
+        for domain in args.domains:
+            if not domain.endswith('.'):
+                domain += '.'
+            seeds = ['{}.{}'.format(word, domain) for word in words]
+            if not enumerate_with_nsec(domain, use_host=args.use_host, dns_client=dns_client,
+                                       seeds=seeds, state_file=args.state):
+                return 1
+    finally:
+        if dns_client is not None:
+            dns_client.close()
 
     return 0
 
@@ -27,17 +27,38 @@ Documentation:
 
 Similar tool:
 * https://github.com/anonion0/nsec3map
+
+The hashes of the NSEC3 records which are gathered can be cracked offline
+with a pool of processes, using the words of a wordlist, masks like
+"?l?l?d" (where ?l is a lowercase letter, ?d a digit, ?h a hyphen, ?a any of
+them and ?c a character of option --charset) and all the names made of up to
+--max-length characters of --charset. For example:
+
+    enumerate_nsec3.py -c cache.txt --offline -m 'www?d' -m '?l?l?l?l?l' example.org
+
+Before this, the NSEC3 records are gathered by querying the names of up to
+--bruteforce-length characters which fall in the ranges of hashes that are
+not covered by any known record. All the candidate names are hashed first,
+and each round queries, in parallel, the candidate which is the closest to
+the middle of every uncovered range, until no candidate is left in them.
 """
 import argparse
+import array
 import base64
 import binascii
+import bisect
 import errno
 import hashlib
 import itertools
 import logging
+import multiprocessing
+import os
 import struct
 import subprocess
 import sys
+import time
+
+from dns_client import DEFAULT_MAX_IN_FLIGHT, HAVE_DNSPYTHON, DnsClient
 
 
 logger = logging.getLogger(__name__)
@@ -48,6 +69,11 @@ NSEC3_HASH_ALG = {
     1: 'SHA1',  # https://tools.ietf.org/html/rfc5155#section-11
 }
 
+# Size of the hashes of NSEC3 records, in bytes
+NSEC3_HASH_SIZE = {
+    1: 20,
+}
+
 
 def dns_name_to_wire(domain_name):
     """Transform a domain name to wire-format
@@ -66,8 +92,25 @@ BASE32_ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ234567'
 BASE32HEX_ALPHABET = '0123456789abcdefghijklmnopqrstuv'
 assert len(BASE32_ALPHABET) == 32
 assert len(BASE32HEX_ALPHABET) == 32
-BASE32_TO_HEX_MAP = dict(zip(BASE32_ALPHABET, BASE32HEX_ALPHABET))
-BASE32_FROM_HEX_MAP = dict(zip(BASE32HEX_ALPHABET, BASE32_ALPHABET))
+BASE32_TO_HEX_TRANS = str.maketrans(BASE32_ALPHABET, BASE32HEX_ALPHABET)
+BASE32_FROM_HEX_TRANS = str.maketrans(BASE32HEX_ALPHABET, BASE32_ALPHABET)
+
+# Character sets of the placeholders of masks, like in hashcat
+MASK_CHARSETS = {
+    'l': 'abcdefghijklmnopqrstuvwxyz',
+    'd': '0123456789',
+    'h': '-',
+    'a': 'abcdefghijklmnopqrstuvwxyz0123456789-',
+}
+
+# Default character set of option --charset
+DEFAULT_CRACK_CHARSET = 'abcdefghijklmnopqrstuvwxyz0123456789'
+
+# Number of candidate names which are hashed by a worker process at once
+CRACK_BATCH_SIZE = 20000
+
+# Default length of the names which are queried to find the NSEC3 records of a zone
+DEFAULT_BRUTEFORCE_LENGTH = 4
 
 
 def nsec3_hash(domain_name, hash_alg, iterations, salt):
@@ -82,15 +125,391 @@ def nsec3_hash(domain_name, hash_alg, iterations, salt):
         raise NotImplementedError("Unimplemented hash algorithm {}".format(hash_alg))
 
     # Encode the hash in base32hex
-    b32hash = base64.b32encode(current_hash).decode('ascii')
-    b32hex_hash = ''.join(BASE32_TO_HEX_MAP[c] for c in b32hash)
-    return b32hex_hash
+    return base32hex_encode(current_hash)
+
+
+def base32hex_encode(raw_hash):
+    """Encode an hash in lowercase base32hex"""
+    return base64.b32encode(raw_hash).decode('ascii').translate(BASE32_TO_HEX_TRANS)
 
 
 def base32hex_decode(hex_hash):
     """Decode an hash encoded in base32hex"""
-    b32hash = ''.join(BASE32_FROM_HEX_MAP[c] for c in hex_hash.lower())
-    return base64.b32decode(b32hash)
+    return base64.b32decode(hex_hash.lower().translate(BASE32_FROM_HEX_TRANS))
+
+
+def base32hex_to_int(hex_hash):
+    """Decode an hash encoded in base32hex into an integer, to compute ranges of hashes"""
+    return int.from_bytes(base32hex_decode(hex_hash), 'big')
+
+
+def parse_mask(mask, custom_charset=DEFAULT_CRACK_CHARSET):
+    """Parse a mask into a list of character sets, one for each position"""
+    charsets = []
+    chars = iter(mask)
+    for char in chars:
+        if char != '?':
+            charsets.append(char)
+            continue
+        placeholder = next(chars, None)
+        if placeholder == '?':
+            charsets.append('?')
+        elif placeholder == 'c':
+            charsets.append(custom_charset)
+        elif placeholder in MASK_CHARSETS:
+            charsets.append(MASK_CHARSETS[placeholder])
+        else:
+            raise ValueError("Unknown placeholder ?{} in mask {}".format(placeholder or '', repr(mask)))
+    return charsets
+
+
+def iter_mask_batches(charsets, batch_size=CRACK_BATCH_SIZE):
+    """Split the names matching a list of character sets into batches of ('mask', prefix, remaining charsets)
+
+    The workers generate the names of a batch themselves, which is faster than sending them.
+    """
+    # Find how many positions are enumerated by each batch
+    split_pos = len(charsets)
+    batch_count = 1
+    while split_pos > 0 and batch_count * len(charsets[split_pos - 1]) <= batch_size:
+        split_pos -= 1
+        batch_count *= len(charsets[split_pos])
+    for prefix in itertools.product(*charsets[:split_pos]):
+        yield ('mask', ''.join(prefix), charsets[split_pos:])
+
+
+def iter_word_batches(words, batch_size=CRACK_BATCH_SIZE):
+    """Split some words into batches of ('words', list of words)"""
+    words = iter(words)
+    while True:
+        batch = list(itertools.islice(words, batch_size))
+        if not batch:
+            return
+        yield ('words', batch)
+
+
+# State of the worker processes which crack NSEC3 hashes, set by nsec3_crack_worker_init()
+_nsec3_crack_state = None
+
+
+def nsec3_crack_worker_init(zone_name, iterations, salt, target_hashes, gap_points, uncovered_gaps):
+    """Initialize a worker process with the parameters and the hashes of the zone"""
+    global _nsec3_crack_state  # pylint: disable=global-statement
+    _nsec3_crack_state = (
+        dns_name_to_wire(zone_name),
+        iterations,
+        salt,
+        frozenset(target_hashes),
+        gap_points,
+        frozenset(uncovered_gaps),
+    )
+
+
+def nsec3_crack_batch(batch):
+    """Hash a batch of candidate names, in a worker process
+
+    Return the number of names, the list of (raw hash, name) of the names
+    which matched a target hash, and a dictionary giving a name for the
+    uncovered gaps where other names fell.
+    """
+    zone_wire, iterations, salt, target_hashes, gap_points, uncovered_gaps = _nsec3_crack_state
+    if batch[0] == 'words':
+        names = batch[1]
+    else:
+        prefix, charsets = batch[1:]
+        names = (prefix + ''.join(suffix) for suffix in itertools.product(*charsets))
+
+    sha1 = hashlib.sha1
+    bisect_right = bisect.bisect_right
+    count = 0
+    found = []
+    gap_names = {}
+    for name in names:
+        labels = name.lower().encode('ascii').split(b'.')
+        if not all(0 < len(label) < 64 for label in labels):
+            continue
+        count += 1
+        current_hash = sha1(b''.join(bytes((len(label), )) + label for label in labels) + zone_wire + salt).digest()
+        for _ in range(iterations):
+            current_hash = sha1(current_hash + salt).digest()
+        if current_hash in target_hashes:
+            found.append((current_hash, name))
+        elif uncovered_gaps:
+            # Gap i is between gap_points[i] and gap_points[i + 1] (or gap_points[0] for the last one)
+            gap_index = bisect_right(gap_points, current_hash) - 1
+            if gap_index < 0:
+                gap_index = len(gap_points) - 1
+            if gap_index in uncovered_gaps and gap_index not in gap_names:
+                gap_names[gap_index] = name
+    return count, found, gap_names
+
+
+class Nsec3Cracker(object):
+    """Crack the hashes of NSEC3 records offline, with a pool of processes
+
+    Candidate names are hashed into raw digests, which are compared to the
+    decoded hashes of the records, without any base32 encoding. The names
+    which fall in the gaps of an incomplete NSEC3 chain are also reported,
+    as querying them reveals new records.
+    """
+    def __init__(self, nsec3param, known_nsec3, jobs=None):
+        self.nsec3param = nsec3param
+        self.zone_name = nsec3param.domain
+        self.jobs = jobs or os.cpu_count() or 1
+
+        # Decode the (hash, next hash) of the known records
+        owners = {}
+        for domain_hash, next_hashed in known_nsec3:
+            owners[base32hex_decode(domain_hash)] = base32hex_decode(next_hashed)
+        self.target_hashes = sorted(owners.keys())
+
+        # Find the gaps between consecutive known hashes which are not covered by a record
+        self.gap_points = sorted(set(owners.keys()).union(owners.values()))
+        self.uncovered_gaps = set()
+        for index, point in enumerate(self.gap_points):
+            next_point = self.gap_points[(index + 1) % len(self.gap_points)]
+            if owners.get(point) != next_point:
+                self.uncovered_gaps.add(index)
+
+        # Dictionary of raw hash -> name
+        self.found_names = {}
+        # Dictionary of gap index -> name which hashes in the gap
+        self.gap_names = {}
+        self.tested_count = 0
+
+    def get_known_hashes(self):
+        """Get a dictionary of base32hex hash -> cracked name"""
+        return {base32hex_encode(raw_hash): name for raw_hash, name in self.found_names.items()}
+
+    def get_gap_names(self):
+        """Get a dictionary of base32hex hash of the start of an uncovered gap -> name in the gap"""
+        return {base32hex_encode(self.gap_points[index]): name for index, name in self.gap_names.items()}
+
+    def add_known_name(self, domain_hash, name):
+        """Record the name of a hash which is already known"""
+        raw_hash = base32hex_decode(domain_hash)
+        if raw_hash in self.target_hashes:
+            self.found_names[raw_hash] = name
+
+    def is_complete(self):
+        return len(self.found_names) == len(self.target_hashes)
+
+    def add_results(self, results):
+        """Merge the results of a batch"""
+        count, found, gap_names = results
+        self.tested_count += count
+        for raw_hash, name in found:
+            if raw_hash not in self.found_names:
+                full_name = '{}.{}'.format(name, self.zone_name) if self.zone_name != '.' else name + '.'
+                logger.debug("Cracked NSEC3 hash %s: %s", base32hex_encode(raw_hash), full_name)
+                self.found_names[raw_hash] = full_name
+        for gap_index, name in gap_names.items():
+            self.gap_names.setdefault(gap_index, name)
+
+    def crack_batches(self, batches):
+        """Hash the names of some batches, stopping when all the hashes are cracked"""
+        if self.is_complete():
+            return
+        start_time = time.time()
+        initial_count = self.tested_count
+        initargs = (
+            self.zone_name, self.nsec3param.iterations, self.nsec3param.salt,
+            self.target_hashes, self.gap_points, self.uncovered_gaps,
+        )
+        if self.jobs <= 1:
+            nsec3_crack_worker_init(*initargs)
+            for batch in batches:
+                self.add_results(nsec3_crack_batch(batch))
+                if self.is_complete():
+                    break
+        else:
+            with multiprocessing.Pool(self.jobs, initializer=nsec3_crack_worker_init, initargs=initargs) as pool:
+                for results in pool.imap_unordered(nsec3_crack_batch, batches):
+                    self.add_results(results)
+                    if self.is_complete():
+                        # Stop the workers
+                        pool.terminate()
+                        break
+        elapsed = time.time() - start_time
+        tested = self.tested_count - initial_count
+        logger.debug("Hashed %d names in %.1f seconds (%.0f names/s), cracked %d/%d hashes",
+                     tested, elapsed, tested / elapsed if elapsed else 0,
+                     len(self.found_names), len(self.target_hashes))
+
+    def crack_words(self, words):
+        """Try the names of a wordlist"""
+        self.crack_batches(iter_word_batches(words))
+
+    def crack_mask(self, mask, custom_charset=DEFAULT_CRACK_CHARSET):
+        """Try all the names matching a mask"""
+        self.crack_batches(iter_mask_batches(parse_mask(mask, custom_charset)))
+
+    def crack_charset(self, charset, max_length):
+        """Try all the names made of up to max_length characters of a character set"""
+        for length in range(1, max_length + 1):
+            if self.is_complete():
+                break
+            self.crack_batches(iter_mask_batches([charset] * length))
+
+
+# State of the worker processes which hash candidate names, set by nsec3_prehash_worker_init()
+_nsec3_prehash_state = None
+
+
+def nsec3_prehash_worker_init(zone_name, iterations, salt):
+    """Initialize a worker process with the parameters of the zone"""
+    global _nsec3_prehash_state  # pylint: disable=global-statement
+    _nsec3_prehash_state = (dns_name_to_wire(zone_name), iterations, salt)
+
+
+def nsec3_prehash_batch(batch):
+    """Hash a ('mask', prefix, charsets) batch of single-label names, in a worker process
+
+    Return the first 64 bits of the hashes of the names, in the order of the batch.
+    """
+    zone_wire, iterations, salt = _nsec3_prehash_state
+    prefix, charsets = batch[1:]
+    sha1 = hashlib.sha1
+    hash_prefixes = array.array('Q')
+    for suffix in itertools.product(*charsets):
+        label = (prefix + ''.join(suffix)).lower().encode('ascii')
+        current_hash = sha1(bytes((len(label), )) + label + zone_wire + salt).digest()
+        for _ in range(iterations):
+            current_hash = sha1(current_hash + salt).digest()
+        hash_prefixes.append(int.from_bytes(current_hash[:8], 'big'))
+    return hash_prefixes.tobytes()
+
+
+class Nsec3Candidates(object):
+    """Names made of up to max_length characters of a set, hashed offline and sorted by hash
+
+    Only the first 64 bits of each hash are kept, with the position of the
+    name in the enumeration, from which the name is computed again when it
+    is picked. This keeps millions of candidates in a few dozens of MB.
+    """
+    def __init__(self, nsec3param, charset, max_length, jobs=None):
+        self.nsec3param = nsec3param
+        self.zone_name = nsec3param.domain
+        self.charset = charset
+        self.max_length = max_length
+        self.jobs = jobs or os.cpu_count() or 1
+        self.hash_shift = NSEC3_HASH_SIZE[nsec3param.hash_algorithm] * 8 - 64
+        self.hash_prefixes = array.array('Q')
+        self.positions = array.array('L')
+        # Positions in the sorted arrays of the candidates which have already been picked
+        self.picked = set()
+
+    def __len__(self):
+        return len(self.hash_prefixes)
+
+    def get_name(self, position):
+        """Get the full domain name of the candidate at a position of the enumeration"""
+        length = 1
+        count = len(self.charset)
+        while position >= count:
+            position -= count
+            length += 1
+            count *= len(self.charset)
+        chars = []
+        for _ in range(length):
+            position, char_index = divmod(position, len(self.charset))
+            chars.append(self.charset[char_index])
+        name = ''.join(reversed(chars))
+        return '{}.{}'.format(name, self.zone_name) if self.zone_name != '.' else name + '.'
+
+    def compute(self):
+        """Hash all the candidates, with a pool of processes"""
+        start_time = time.time()
+        batches = itertools.chain.from_iterable(
+            iter_mask_batches([self.charset] * length) for length in range(1, self.max_length + 1))
+        initargs = (self.zone_name, self.nsec3param.iterations, self.nsec3param.salt)
+        hash_prefixes = array.array('Q')
+        if self.jobs <= 1:
+            nsec3_prehash_worker_init(*initargs)
+            for batch in batches:
+                hash_prefixes.frombytes(nsec3_prehash_batch(batch))
+        else:
+            with multiprocessing.Pool(self.jobs, initializer=nsec3_prehash_worker_init, initargs=initargs) as pool:
+                # Keep the order of the batches, which gives the positions of the names
+                for data in pool.imap(nsec3_prehash_batch, batches):
+                    hash_prefixes.frombytes(data)
+
+        order = sorted(range(len(hash_prefixes)), key=hash_prefixes.__getitem__)
+        self.hash_prefixes = array.array('Q', (hash_prefixes[pos] for pos in order))
+        self.positions = array.array('L', order)
+        self.picked = set()
+        logger.debug("Hashed %d candidate names of up to %d characters in %.1f seconds",
+                     len(order), self.max_length, time.time() - start_time)
+
+    def pick(self, start, end):
+        """Pick the candidate whose hash is the closest to the middle of range [start, end) of hashes
+
+        Return (name, hash as an integer), or None if no candidate falls in the range.
+        """
+        low = bisect.bisect_left(self.hash_prefixes, start >> self.hash_shift)
+        high = bisect.bisect_right(self.hash_prefixes, (end - 1) >> self.hash_shift)
+        middle_prefix = ((start + end) // 2) >> self.hash_shift
+
+        # Walk away from the middle, on both sides
+        right = bisect.bisect_left(self.hash_prefixes, middle_prefix, low, high)
+        left = right - 1
+        while left >= low or right < high:
+            if right >= high or (left >= low and (
+                    middle_prefix - self.hash_prefixes[left] < self.hash_prefixes[right] - middle_prefix)):
+                index = left
+                left -= 1
+            else:
+                index = right
+                right += 1
+            if index in self.picked:
+                continue
+            self.picked.add(index)
+            name = self.get_name(self.positions[index])
+            # Only the first bits were compared, so check the full hash
+            name_hash = base32hex_to_int(self.nsec3param.hash(name))
+            if start <= name_hash < end:
+                return name, name_hash
+        return None
+
+
+class HashRangeSet(object):
+    """Set of disjoint ranges [start, end) of hashes
+
+    The bounds of the ranges are kept in two sorted lists, so that finding
+    a hash and removing a range are done by bisection and only modify the
+    ranges which overlap the removed one.
+    """
+    def __init__(self, start, end):
+        self.starts = [start]
+        self.ends = [end]
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return iter(list(zip(self.starts, self.ends)))
+
+    def __contains__(self, value):
+        index = bisect.bisect_right(self.starts, value) - 1
+        return index >= 0 and value < self.ends[index]
+
+    def remove(self, start, end):
+        """Remove range [start, end) from the set"""
+        first = bisect.bisect_right(self.ends, start)
+        last = first
+        new_starts = []
+        new_ends = []
+        while last < len(self.starts) and self.starts[last] < end:
+            # Keep the parts of the range which are outside of [start, end)
+            if self.starts[last] < start:
+                new_starts.append(self.starts[last])
+                new_ends.append(start)
+            if self.ends[last] > end:
+                new_starts.append(end)
+                new_ends.append(self.ends[last])
+            last += 1
+        self.starts[first:last] = new_starts
+        self.ends[first:last] = new_ends
 
 
 class NSec3ParamRecord(object):
@@ -103,7 +522,7 @@ class NSec3ParamRecord(object):
         self.flags = flags
         self.iterations = iterations
         self.salt = salt
-        self.hex_salt = binascii.hexlify(salt).decode('ascii')
+        self.hex_salt = binascii.hexlify(salt).decode('ascii') or '-'
 
     def __repr__(self):
         return '<{}(domain={}, alg={}, {}iterations={}, salt=0x{}>'.format(
@@ -140,7 +559,7 @@ class NSec3Record(object):
         self.flags = flags
         self.iterations = iterations
         self.salt = salt
-        self.hex_salt = binascii.hexlify(salt).decode('ascii')
+        self.hex_salt = binascii.hexlify(salt).decode('ascii') or '-'
         self.next_hashed = next_hashed.lower()
         self.record_types = record_types
 
@@ -179,6 +598,11 @@ class NSec3Record(object):
         )
 
 
+def parse_hex_salt(hex_salt):
+    """Parse the salt of a NSEC3 or NSEC3PARAM record, which is "-" when it is empty"""
+    return b'' if hex_salt == '-' else binascii.unhexlify(hex_salt)
+
+
 def build_dns_record_object(domain, rdtype, fields):
     """Craft an object describing a DNS record"""
     if rdtype == 'NSEC3PARAM' and len(fields) == 4:
@@ -188,7 +612,7 @@ def build_dns_record_object(domain, rdtype, fields):
                 hash_algorithm=int(fields[0]),
                 flags=int(fields[1]),
                 iterations=int(fields[2]),
-                salt=binascii.unhexlify(fields[3]),
+                salt=parse_hex_salt(fields[3]),
             )
         except ValueError:
             pass
@@ -199,7 +623,7 @@ def build_dns_record_object(domain, rdtype, fields):
                 hash_algorithm=int(fields[0]),
                 flags=int(fields[1]),
                 iterations=int(fields[2]),
-                salt=binascii.unhexlify(fields[3]),
+                salt=parse_hex_salt(fields[3]),
                 next_hashed=fields[4],
                 record_types=fields[5:],
             )
@@ -210,8 +634,14 @@ def build_dns_record_object(domain, rdtype, fields):
     raise ValueError
 
 
-def query_dns(domain, request_type, response_types):
+def query_dns(domain, request_type, response_types, dns_client=None):
     """Query the DNS server for a some records for the specified domain"""
+    if dns_client is not None:
+        records = dns_client.query_records([(domain, request_type)], rdtypes=response_types)[0]
+        if records is None:
+            raise RuntimeError("No response from DNS server {}".format(dns_client.server))
+        return [build_dns_record_object(*record) for record in records]
+
     # Try using drill or dig
     for prgm in (['drill', '-D'], ['dig', '+dnssec']):
         cmdline = prgm + [domain, request_type]
@@ -273,7 +703,7 @@ def load_dns_cache_file(cache_file):
 
 def save_dns_cache_file(dns_cache):
     """Save a file with resolved DNS records"""
-    cache_file = dns_cache['_file']
+    cache_file = dns_cache.get('_file')
     if not cache_file:
         # No cache
         return
@@ -289,47 +719,71 @@ def save_dns_cache_file(dns_cache):
         fd.write(''.join(sorted(records)))
 
 
-def query_cached_dns(domain, rdtype, dns_cache):
+def cache_dns_records(dns_cache, rdtype, records):
+    """Add some records to the DNS cache"""
+    if rdtype not in dns_cache:
+        dns_cache[rdtype] = {}
+    for record in records:
+        if record.domain not in dns_cache[rdtype]:
+            dns_cache[rdtype][record.domain] = []
+        dns_cache[rdtype][record.domain].append(record)
+
+
+def query_cached_dns(domain, rdtype, dns_cache, dns_client=None):
     try:
         return dns_cache[rdtype][domain]
     except KeyError:
         pass
-    results = query_dns(domain, rdtype, (rdtype, ))
+    results = query_dns(domain, rdtype, (rdtype, ), dns_client=dns_client)
 
     if results:
-        # Cache the results
-        if rdtype not in dns_cache:
-            dns_cache[rdtype] = {}
-        for record in results:
-            if record.domain not in dns_cache[rdtype]:
-                dns_cache[rdtype][record.domain] = []
-            dns_cache[rdtype][record.domain].append(record)
+        cache_dns_records(dns_cache, rdtype, results)
     return results
 
 
 class Nsec3ForZone(object):
     """Maintain a list of NSEC3 records for a given DNS zone
 
-    It is a kind of interval list of known NSEC3 records
+    It is a kind of interval list of known NSEC3 records, along with the set
+    of the ranges of hashes which are not covered by any of them.
     """
     def __init__(self, nsec3param, dns_cache):
         assert isinstance(nsec3param, NSec3ParamRecord)
         self.nsec3param = nsec3param
         self.zone_name = nsec3param.domain
-        known_nsec3 = set()
+        self.hash_space = 1 << (NSEC3_HASH_SIZE[nsec3param.hash_algorithm] * 8)
+        self.uncovered = HashRangeSet(0, self.hash_space)
         self.known_nsec3_keys = set()
+        # Use a sorted list as this structure should not be large, and the
+        # query time is more important to optimize than the insert time.
+        self.known_nsec3 = []
         for nsec3_records in dns_cache.get('NSEC3', {}).values():
             for nsec3 in nsec3_records:
                 if nsec3.zone_name == self.zone_name:
-                    known_nsec3.add((nsec3.domain_hash, nsec3.next_hashed))
-                    self.known_nsec3_keys.add(nsec3.domain_hash)
-        # Use a sorted list as this structure should not be large, and the
-        # query time is more important to optimize than the insert time.
-        self.known_nsec3 = sorted(known_nsec3)
-
-        # Is the last one looping back
-        self.is_looping = self.known_nsec3[-1][0] > self.known_nsec3[-1][1]
-        assert all(tup[0] < tup[1] for tup in self.known_nsec3[:-1])
+                    self.add_nsec3(nsec3)
+
+    def add_nsec3(self, nsec3):
+        """Add a NSEC3 record of the zone, returning False if it was already known"""
+        if nsec3.domain_hash in self.known_nsec3_keys:
+            return False
+        self.known_nsec3_keys.add(nsec3.domain_hash)
+        interval = (nsec3.domain_hash, nsec3.next_hashed)
+        position = bisect.bisect_left(self.known_nsec3, interval)
+        self.known_nsec3.insert(position, interval)
+
+        # Only the last record of the chain loops back to the first one
+        if nsec3.domain_hash >= nsec3.next_hashed and position != len(self.known_nsec3) - 1:
+            logger.warning("Inconsistent NSEC3 chain: %r loops back before the end", nsec3)
+
+        # The record covers the hashes from its owner to its next owner (excluded)
+        start = base32hex_to_int(nsec3.domain_hash)
+        end = base32hex_to_int(nsec3.next_hashed)
+        if start < end:
+            self.uncovered.remove(start, end)
+        else:
+            self.uncovered.remove(start, self.hash_space)
+            self.uncovered.remove(0, end)
+        return True
 
     def __len__(self):
         assert len(self.known_nsec3_keys) == len(self.known_nsec3)
@@ -341,71 +795,80 @@ class Nsec3ForZone(object):
         incomplete = known_next - self.known_nsec3_keys
         return len(incomplete)
 
-    def find_interval_for_hash(self, domain_hash):
-        """Find the given hash in the known NSEC3 records"""
-        interval_firstpos = 0
-        interval_lastpos = len(self.known_nsec3) - 1
-        interval_lastitem = self.known_nsec3[interval_lastpos][1]
-        if self.is_looping:
-            if domain_hash >= self.known_nsec3[interval_lastpos][0]:
-                return self.known_nsec3[interval_lastpos]
-            if domain_hash < interval_lastitem:
-                return self.known_nsec3[interval_lastpos]
-        else:
-            if domain_hash >= interval_lastitem:
-                return None
-        if domain_hash < self.known_nsec3[0][0]:
-            return None
-
-        # Dichotomy
-        while interval_firstpos <= interval_lastpos:
-            middle_pos = (interval_firstpos + interval_lastpos) // 2
-            middle_item_tuple = self.known_nsec3[middle_pos]
-            if domain_hash < middle_item_tuple[0]:
-                interval_lastpos = middle_pos - 1
-            elif domain_hash > middle_item_tuple[1]:
-                interval_firstpos = middle_pos + 1
+    def walk_gaps(self, candidates, dns_client, dns_cache):
+        """Query candidate names in the uncovered ranges of hashes, until no candidate is left in them
+
+        Each round queries the candidate which is the closest to the middle of
+        each uncovered range, all at once. The NSEC3 record which covers it is
+        necessarily a new one, and it splits the range in the most balanced way.
+        Without dns_client, the names are queried one after the other with drill or dig.
+        Return the number of queried names and a dictionary of base32hex hash -> name
+        for the queried names which exist.
+        """
+        existing_names = {}
+        queried_count = 0
+        round_number = 0
+        while self.uncovered:
+            names = []
+            for start, end in self.uncovered:
+                picked = candidates.pick(start, end)
+                if picked is not None:
+                    names.append(picked[0])
+            if not names:
+                break
+
+            round_number += 1
+            queried_count += len(names)
+            if dns_client is not None:
+                responses = dns_client.query_records([(name, 'NSEC3') for name in names], rdtypes=('NSEC3', ))
+                if all(records is None for records in responses):
+                    logger.error("No response from DNS server %s, stopping the bruteforce", dns_client.server)
+                    break
+                responses = [
+                    None if records is None else [build_dns_record_object(*record) for record in records]
+                    for records in responses]
             else:
-                return middle_item_tuple
-        return None
+                responses = [query_dns(name, 'NSEC3', ('NSEC3', )) for name in names]
+            new_count = 0
+            for name, found_nsec3 in zip(names, responses):
+                if found_nsec3 is None:
+                    continue
+                if not found_nsec3:
+                    logger.warning("No NSEC3 record for %s, it may be a valid domain name.", name)
+                    continue
+                cache_dns_records(dns_cache, 'NSEC3', found_nsec3)
+                name_hash = self.nsec3param.hash(name)
+                for nsec3 in found_nsec3:
+                    if nsec3.zone_name != self.zone_name:
+                        logger.warning("Received a DNSSEC NSEC3 record for an unexpected zone: %r != %r",
+                                       nsec3.zone_name, self.zone_name)
+                        continue
+                    if nsec3.domain_hash == name_hash:
+                        existing_names[name_hash] = name
+                    if self.add_nsec3(nsec3):
+                        new_count += 1
+            save_dns_cache_file(dns_cache)
+            logger.info("Round %d: queried %d names, got %d new NSEC3 entries (%d known, %d uncovered ranges)",
+                        round_number, len(names), new_count, len(self), len(self.uncovered))
+            if not new_count:
+                # The names were in uncovered ranges, so some known records do not match the zone
+                logger.error("No new NSEC3 record in the responses, the cached records may be outdated")
+                break
+        return queried_count, existing_names
 
-    def test_base_domain(self, domain_base_name, dns_cache):
-        """Ensure that the given base domain is covered by an NSEC3 entry"""
-        # Compute the hash for the domain name
-        assert domain_base_name[-1] != '.'
-        domain_name = '{}.{}'.format(domain_base_name, self.zone_name)
-        domain_hash = self.nsec3param.hash(domain_name)
-        if self.find_interval_for_hash(domain_hash):
-            return
 
-        # Query the NSEC3 records
-        found_nsec3 = query_cached_dns(domain_name, 'NSEC3', dns_cache)
-        if not found_nsec3:
-            logger.warning("No NSEC3 record for %s, it may be a valid domain name.", domain_name)
-            return
-        for nsec3 in found_nsec3:
-            if nsec3.zone_name != self.zone_name:
-                logger.warning("Received a DNSSEC NSEC3 record for an unexpected zone: %r != %r",
-                               nsec3.zone_name, self.zone_name)
-            elif nsec3.domain_hash not in self.known_nsec3_keys:
-                logger.debug("Adding to NSEC3 cache: %r", nsec3)
-                self.known_nsec3_keys.add(nsec3.domain_hash)
-                self.known_nsec3.append((nsec3.domain_hash, nsec3.next_hashed))
-        self.known_nsec3.sort()
-        if not self.is_looping:
-            self.is_looping = self.known_nsec3[-1][0] > self.known_nsec3[-1][1]
-        assert all(tup[0] < tup[1] for tup in self.known_nsec3[:-1])
-        if not self.find_interval_for_hash(domain_hash):
-            logger.warning("The NSEC3 record for %r has not been cached.", domain_name)
-
-
-def enumerate_nsec3(domain, dns_cache, output_format, wordlist=None):
-    """Enumerate the NSEC3 entries of a domain"""
+def enumerate_nsec3(domain, dns_cache, output_format, wordlist=None, masks=None,
+                    charset=DEFAULT_CRACK_CHARSET, max_length=0, jobs=None, offline=False,
+                    bruteforce_length=DEFAULT_BRUTEFORCE_LENGTH, dns_client=None):
+    """Enumerate the NSEC3 entries of a domain
+
+    The DNS queries are sent with dns_client when it is set, or with drill or dig otherwise.
+    """
     if not domain.endswith('.'):
         domain += '.'
 
     # Show NSEC3PARAM
-    results = query_cached_dns(domain, 'NSEC3PARAM', dns_cache)
+    results = query_cached_dns(domain, 'NSEC3PARAM', dns_cache, dns_client=dns_client)
     nsec3param = None
     if not results:
         logger.warning("No NSEC3PARAM record for %r", domain)
@@ -421,7 +884,11 @@ def enumerate_nsec3(domain, dns_cache, output_format, wordlist=None):
         nsec3param = results[0]
 
     # Start with a NSEC3 for the domain
-    found_nsec3 = query_cached_dns(domain, 'NSEC3', dns_cache)
+    if offline and nsec3param is not None:
+        # The cache is indexed by the hashed names of NSEC3 records
+        found_nsec3 = dns_cache.get('NSEC3', {}).get('{}.{}'.format(nsec3param.hash(domain), domain))
+    else:
+        found_nsec3 = query_cached_dns(domain, 'NSEC3', dns_cache, dns_client=dns_client)
     if not found_nsec3:
         logger.error("No NSEC3 record for %r", domain)
         return False
@@ -449,54 +916,59 @@ def enumerate_nsec3(domain, dns_cache, output_format, wordlist=None):
     # Gather all the known NSEC3 records from the cache, to build known intervals
     nsec3zone = Nsec3ForZone(nsec3param, dns_cache)
     assert nsec3zone.zone_name == domain, "Mismatched domain name for DNS zone"
-    assert any(domain_nsec3.domain_hash == x[0] for x in nsec3zone.known_nsec3), "Inconsistent cache, missing domain"
+    assert domain_nsec3.domain_hash in nsec3zone.known_nsec3_keys, "Inconsistent cache, missing domain"
 
     # Start recording the cache. It is fails, better do it now that after the bruteforce
     save_dns_cache_file(dns_cache)
 
+    existing_names = {}
+
     if nsec3zone.count_incomplete() == 0:
         logger.info("Got %d entries in NSEC3 DNS cache for %s, which build a complete chain!",
                     len(nsec3zone), zone_name)
+    elif offline:
+        logger.info("Got %d entries in NSEC3 DNS cache for %s (%d incomplete entries)",
+                    len(nsec3zone), zone_name, nsec3zone.count_incomplete())
     else:
         logger.info("Got %d entries in NSEC3 DNS cache for %s before bruteforce (%d incomplete entries)",
                     len(nsec3zone), zone_name, nsec3zone.count_incomplete())
 
-        # Bruteforce up to 4 letters domains
-        dns_alphabet = 'abcdefghjiklmnopqrstuvwxyz0123456789'
-        for domain_len in range(1, 5):
-            if nsec3zone.count_incomplete() == 0:
-                break
-            for domain_letters in itertools.product(dns_alphabet, repeat=domain_len):
-                domain_base_name = ''.join(domain_letters)
-                nsec3zone.test_base_domain(domain_base_name, dns_cache)
-            save_dns_cache_file(dns_cache)
+        # Query the names of up to bruteforce_length characters which fall in the uncovered gaps
+        if bruteforce_length:
+            candidates = Nsec3Candidates(nsec3param, charset, bruteforce_length, jobs=jobs)
+            candidates.compute()
+            queried_count, existing_names = nsec3zone.walk_gaps(candidates, dns_client, dns_cache)
             logger.info(
-                "Got %d NSEC3 entries after bruteforcing %d-letter domains (%d incomplete)",
-                len(nsec3zone), domain_len, nsec3zone.count_incomplete())
-
-    # Let's guess some names
-    known_hashes = {expected_hash: domain}
-    for domain_len in range(1, 4):
-        if len(known_hashes) == len(nsec3zone):
-            break
-        dns_alphabet = 'abcdefghjiklmnopqrstuvwxyz0123456789-_.'
-        for domain_letters in itertools.product(dns_alphabet, repeat=domain_len):
-            guessed_name = ''.join(domain_letters) + '.' + zone_name
-            guessed_hash = nsec3param.hash(guessed_name)
-            if guessed_hash in nsec3zone.known_nsec3_keys:
-                known_hashes[guessed_hash] = guessed_name
-    logger.debug("Guessed %d/%d names", len(known_hashes), len(nsec3zone))
+                "Got %d NSEC3 entries after querying %d names of up to %d characters (%d incomplete)",
+                len(nsec3zone), queried_count, bruteforce_length, nsec3zone.count_incomplete())
+
+    # Let's guess some names, offline
+    cracker = Nsec3Cracker(nsec3param, nsec3zone.known_nsec3, jobs=jobs)
+    cracker.add_known_name(expected_hash, domain)
+    for domain_hash, name in existing_names.items():
+        cracker.add_known_name(domain_hash, name)
+    cracker.crack_charset('abcdefghjiklmnopqrstuvwxyz0123456789-_.', 3)
+    logger.debug("Guessed %d/%d names", len(cracker.found_names), len(nsec3zone))
 
     # Use the provided wordlist to recover names
     if wordlist:
-        for word in wordlist:
-            if len(known_hashes) == len(nsec3zone):
-                break
-            guessed_name = word + '.' + zone_name
-            guessed_hash = nsec3param.hash(guessed_name)
-            if guessed_hash in nsec3zone.known_nsec3_keys:
-                known_hashes[guessed_hash] = guessed_name
-        logger.debug("Found %d/%d names after wordlist", len(known_hashes), len(nsec3zone))
+        cracker.crack_words(wordlist)
+        logger.debug("Found %d/%d names after wordlist", len(cracker.found_names), len(nsec3zone))
+
+    for mask in (masks or ()):
+        cracker.crack_mask(mask, charset)
+        logger.debug("Found %d/%d names after mask %r", len(cracker.found_names), len(nsec3zone), mask)
+
+    if max_length:
+        cracker.crack_charset(charset, max_length)
+        logger.debug("Found %d/%d names after names of up to %d characters",
+                     len(cracker.found_names), len(nsec3zone), max_length)
+
+    known_hashes = cracker.get_known_hashes()
+    gap_names = cracker.get_gap_names()
+    logger.info("Cracked %d/%d NSEC3 hashes by hashing %d names, which fell in %d/%d uncovered gaps",
+                len(known_hashes), len(nsec3zone), cracker.tested_count,
+                len(gap_names), len(cracker.uncovered_gaps))
 
     if output_format == 'john':
         # Format the output in a format suitable for John The Ripper
@@ -514,6 +986,11 @@ def enumerate_nsec3(domain, dns_cache, output_format, wordlist=None):
             print("- [{0}] {1[0]} -> {1[1]} for {2}".format(idx, hashes, known_name))
         else:
             print("- [{0}] {1[0]} -> {1[1]}".format(idx, hashes))
+
+    if gap_names:
+        print("Names in uncovered gaps of the NSEC3 chain of {}:".format(domain))
+        for gap_start, name in sorted(gap_names.items()):
+            print("- after {}: {}.{}".format(gap_start, name, zone_name))
     return True
 
 
@@ -529,6 +1006,26 @@ def main(argv=None):
                         help="output hashes in John The Ripper format")
     parser.add_argument('-w', '--wordlist', type=str,
                         help="list of domains to use to crack NSEC3 hashes")
+    parser.add_argument('-m', '--mask', action='append',
+                        help="crack NSEC3 hashes with names matching a mask (?l, ?d, ?h, ?a, ?c placeholders)")
+    parser.add_argument('-C', '--charset', type=str, default=DEFAULT_CRACK_CHARSET,
+                        help="character set of ?c in masks, --max-length and --bruteforce-length "
+                        "(default: {})".format(DEFAULT_CRACK_CHARSET))
+    parser.add_argument('-L', '--max-length', type=int, default=0,
+                        help="crack NSEC3 hashes with all the names of up to this number of characters")
+    parser.add_argument('-J', '--jobs', type=int,
+                        help="number of processes which crack NSEC3 hashes (default: number of CPUs)")
+    parser.add_argument('-O', '--offline', action='store_true',
+                        help="do not bruteforce names online, only crack the cached NSEC3 hashes")
+    parser.add_argument('-B', '--bruteforce-length', type=int, default=DEFAULT_BRUTEFORCE_LENGTH,
+                        help="query the names of up to this number of characters which fall in gaps "
+                        "(default: {})".format(DEFAULT_BRUTEFORCE_LENGTH))
+    parser.add_argument('-s', '--server', type=str,
+                        help="DNS server to query (default: first nameserver of /etc/resolv.conf)")
+    parser.add_argument('-p', '--port', type=int, default=53,
+                        help="port of the DNS server")
+    parser.add_argument('-Q', '--max-in-flight', type=int, default=DEFAULT_MAX_IN_FLIGHT,
+                        help="maximum number of concurrent DNS queries (default: {})".format(DEFAULT_MAX_IN_FLIGHT))
     args = parser.parse_args(argv)
 
     logging.basicConfig(format='[%(levelname)-5s] %(message)s',
@@ -536,6 +1033,21 @@ def main(argv=None):
 
     dns_cache = load_dns_cache_file(args.cache_file) if args.cache_file else {}
 
+    # Send the queries from the process, if dnspython is available
+    dns_client = None
+    if HAVE_DNSPYTHON:
+        dns_client = DnsClient(server=args.server, port=args.port, max_in_flight=args.max_in_flight)
+    elif args.server:
+        parser.error("option --server requires dnspython")
+
+    for mask in (args.mask or ()):
+        try:
+            parse_mask(mask, args.charset)
+        except ValueError as exc:
+            parser.error(str(exc))
+    if args.bruteforce_length and '.' in args.charset:
+        parser.error("the character set of --bruteforce-length cannot contain dots")
+
     output_format = None
     if args.john:
         output_format = 'john'
@@ -552,9 +1064,16 @@ def main(argv=None):
                         wordlist_entries.add('.'.join(line_parts[i_start:i_end]))
         wordlist = sorted(wordlist_entries)
 
-    for domain in args.domains:
-        if not enumerate_nsec3(domain, dns_cache, output_format, wordlist=wordlist):
-            return 1
+    try:
+        for domain in args.domains:
+            if not enumerate_nsec3(domain, dns_cache, output_format, wordlist=wordlist, masks=args.mask,
+                                   charset=args.charset, max_length=args.max_length, jobs=args.jobs,
+                                   offline=args.offline, bruteforce_length=args.bruteforce_length,
+                                   dns_client=dns_client):
+                return 1
+    finally:
+        if dns_client is not None:
+            dns_client.close()
 
     return 0
 
@@ -511,6 +511,18 @@ class DNSCache(object):
         self.unverified_cache = {}
         self.verified_cache = {}
         self.refreshed_records = set()
+
+        # Parsed records, by (class, text content), as parsing DNSKEY records builds public keys
+        self.parsed_records = {}
+        # Trusted DNSKEY records of each zone, as (built with refresh, list of keys), and by (zone, keytag)
+        self.trusted_dnskeys = {}
+        self.trusted_dnskeys_by_tag = {}
+        self.stats = {
+            'parsed_hits': 0,
+            'parsed_misses': 0,
+            'dnskey_hits': 0,
+            'dnskey_misses': 0,
+        }
         self.load()
 
     def load(self):
@@ -601,6 +613,8 @@ class DNSCache(object):
             response = None
 
         # Remove old entries from the caches
+        if rdtype_text in ('DNSKEY', 'DS'):
+            self.invalidate_dnskeys(domain)
         if domain in self.verified_cache and 'IN' in self.verified_cache[domain]:
             rrsig_type_text = 'RRSIG ' + rdtype_text
             if rdtype_text in self.verified_cache[domain]['IN']:
@@ -653,7 +667,7 @@ class DNSCache(object):
         record_class = record_classes[signed_rdtype]
         signed_records_text = self.unverified_cache[domain][rdclass][signed_rdtype]
         # logger.debug("Verifying signature of %s %r: %r", signed_rdtype, domain, signed_records_text)
-        signed_records = [record_class(record).to_wire() for record in signed_records_text]
+        signed_records = [self.parse_record(record_class, record).to_wire() for record in signed_records_text]
         # Sort the records according to the canonical ordering
         signed_records.sort()
 
@@ -697,6 +711,9 @@ class DNSCache(object):
             self.verified_cache[domain][rdclass] = {}
         self.verified_cache[domain][rdclass][rdtype] = rdtype_content
         self.verified_cache[domain][rdclass][signed_rdtype] = signed_records_text
+        if signed_rdtype in ('DNSKEY', 'DS'):
+            # The keys of the zone are now trusted through another way
+            self.invalidate_dnskeys(domain)
 
         keys_to_remove = ((domain, rdclass, rdtype), (domain, rdclass, signed_rdtype))
         # Return the to-be-removed keys, if asked
@@ -745,11 +762,61 @@ class DNSCache(object):
         except KeyError:
             return []
 
+    def parse_record(self, record_class, text_content):
+        """Parse the text content of a record, only once"""
+        key = (record_class, text_content)
+        record = self.parsed_records.get(key)
+        if record is None:
+            self.stats['parsed_misses'] += 1
+            record = record_class(text_content)
+            self.parsed_records[key] = record
+        else:
+            self.stats['parsed_hits'] += 1
+        return record
+
+    def invalidate_dnskeys(self, domain):
+        """Forget the trusted DNSKEY records of a zone, when its DNSKEY or DS records change"""
+        cached = self.trusted_dnskeys.pop(domain, None)
+        if cached is not None:
+            for dnskey in cached[1]:
+                self.trusted_dnskeys_by_tag.pop((domain, dnskey.key_tag), None)
+
+    def format_stats(self):
+        """Describe the hit rates of the caches of parsed records and trusted DNSKEY records"""
+        return ', '.join(
+            '{} cache: {} hits, {} misses ({:.1f}% hit rate)'.format(
+                name, hits, misses, 100. * hits / (hits + misses) if hits + misses else 0)
+            for name, hits, misses in (
+                ('DNSKEY', self.stats['dnskey_hits'], self.stats['dnskey_misses']),
+                ('parsed records', self.stats['parsed_hits'], self.stats['parsed_misses']),
+            ))
+
     def get_dnskeys(self, domain, refresh=False):
-        """Get DNSKEY records"""
+        """Get the trusted DNSKEY records of a zone
+
+        They are built once and kept until the DNSKEY or DS records of the
+        zone change. Keys which were built without refreshing the records
+        are built again the first time a refresh is requested.
+        """
+        cached = self.trusted_dnskeys.get(domain)
+        if cached is not None and (cached[0] or not refresh):
+            self.stats['dnskey_hits'] += 1
+            return cached[1]
+        self.stats['dnskey_misses'] += 1
+
+        dnskeys = self._build_trusted_dnskeys(domain, refresh=refresh)
+        # Building the keys may have refreshed records, so drop the keys found meanwhile
+        self.invalidate_dnskeys(domain)
+        self.trusted_dnskeys[domain] = (refresh, dnskeys)
+        for dnskey in dnskeys:
+            self.trusted_dnskeys_by_tag.setdefault((domain, dnskey.key_tag), []).append(dnskey)
+        return dnskeys
+
+    def _build_trusted_dnskeys(self, domain, refresh=False):
+        """Build the trusted DNSKEY records of a zone, from the verified ones or from the DS records"""
         records = self.get_dns_records(domain, 'DNSKEY', refresh=refresh)
         if records:
-            return [DNSKeyRecord(r) for r in records]
+            return [self.parse_record(DNSKeyRecord, r) for r in records]
 
         # Load the records which did not succeed the signature check
         try:
@@ -759,13 +826,13 @@ class DNSCache(object):
 
         if domain == '.':
             # Bootstrap root DNS keys using the unverified cache
-            return [DNSKeyRecord(r) for r in unverified_records]
+            return [self.parse_record(DNSKeyRecord, r) for r in unverified_records]
 
         # Try to get a DS record to verify the DNS keys
         delegations = self.get_ds(domain, refresh=refresh)
         dnskeys = []
         for record_text in unverified_records:
-            dnskey = DNSKeyRecord(record_text)
+            dnskey = self.parse_record(DNSKeyRecord, record_text)
             has_been_validated = False
             for ds_record in delegations:
                 if ds_record.key_tag == dnskey.key_tag and ds_record.verify_key(domain, dnskey):
@@ -778,15 +845,16 @@ class DNSCache(object):
 
     def find_dnskey(self, domain, keytag, refresh=False):
         """Get a DNSKEY by its keytag"""
-        for dnskey in self.get_dnskeys(domain, refresh=refresh):
-            if dnskey.key_tag == keytag:
-                return dnskey
+        self.get_dnskeys(domain, refresh=refresh)
+        dnskeys = self.trusted_dnskeys_by_tag.get((domain, keytag))
+        if dnskeys:
+            return dnskeys[0]
         raise KeyError("Unable to find DNSKEY({}, {})".format(repr(domain), keytag))
 
     def get_ds(self, domain, refresh=False):
         """Get DS records"""
         records = self.get_dns_records(domain, 'DS', refresh=refresh)
-        return [DSRecord(r) for r in records]
+        return [self.parse_record(DSRecord, r) for r in records]
 
 
 def verify_dnssec(dns_cache, domain, refresh=False):
@@ -848,6 +916,8 @@ def main(argv=None):
         if not verify_dnssec(dns_cache, domain, refresh=args.refresh):
             is_successful = False
 
+    logger.debug("%s", dns_cache.format_stats())
+
     # Save the updated cache
     if args.refresh:
         dns_cache.save()
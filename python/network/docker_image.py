@@ -42,6 +42,20 @@ Usage example:
     # (https://hub.docker.com/_/microsoft-mssql-server)
     docker_image.py -o docker_cache.out -r mcr.microsoft.com mssql/server:latest-ubuntu
 
+Layers are downloaded concurrently (option -j) through a shared pool of HTTP
+connections. An interrupted download leaves a ".part" file, which is resumed
+with a HTTP Range request the next time the image is downloaded.
+
+With option -s, layers are stored once in a persistent content-addressed store
+and the output directories get hard links (or reflinks, or copies) to them:
+
+    docker_image.py -s blob_store.out -o alpine.out alpine:latest
+
+With option -x, the layers are extracted into a root filesystem while they are
+downloaded, handling whiteout files:
+
+    docker_image.py -x alpine.rootfs alpine:latest
+
 Documentation:
 * https://docs.docker.com/registry/spec/api/
   Specification of Docker registry API
@@ -52,14 +66,23 @@ Documentation:
 @license: MIT
 """
 import argparse
+import concurrent.futures
+import contextlib
+import errno
+import fcntl
 import hashlib
 import json
 import logging
 from pathlib import Path
 import os
 import re
+import shutil
+import stat
+import tarfile
+import threading
 
 import requests
+import requests.adapters
 
 
 # pylint: disable=invalid-name
@@ -68,6 +91,20 @@ logger = logging.getLogger(__name__)
 
 DOCKER_REGISTRY = 'https://registry-1.docker.io'
 
+# Size of the chunks which are read from the network and from files
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Default number of layers which are downloaded concurrently
+DEFAULT_DOWNLOAD_JOBS = 4
+
+# Prefixes of the names of whiteout files, which remove files of the lower layers
+# cf. https://github.com/opencontainers/image-spec/blob/v1.0.1/layer.md#whiteouts
+WHITEOUT_PREFIX = '.wh.'
+WHITEOUT_OPAQUE = '.wh..wh..opq'
+
+# ioctl to clone the content of a file into another one, on Linux (btrfs, XFS...)
+FICLONE = 0x40049409
+
 
 def normalize_docker_registry_name(image_name):
     """Normalize the name of an image for Docker registry"""
@@ -98,9 +135,403 @@ def split_auth_header(header):
     return fields
 
 
+def hash_file(file_path):
+    """Compute the SHA256 digest of a file, returning the hash object and the size"""
+    computed_digest = hashlib.sha256()
+    total_size = 0
+    with file_path.open('rb') as fin:
+        while True:
+            chunk = fin.read(DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            computed_digest.update(chunk)
+            total_size += len(chunk)
+    return computed_digest, total_size
+
+
+def write_all(fout, chunk, file_path):
+    """Write a chunk of data completely into a file, returning its size"""
+    total_size = 0
+    while chunk:
+        written = fout.write(chunk)
+        if written == 0:
+            raise IOError("Unable to write to layer output file {}".format(file_path))
+        total_size += written
+        chunk = chunk[written:]
+    return total_size
+
+
+def hash_and_write(fout, chunk, computed_digest, file_path):
+    """Hash a chunk of data and write it completely into a file, returning its size"""
+    computed_digest.update(chunk)
+    return write_all(fout, chunk, file_path)
+
+
+def hash_and_write_response(response, fout, computed_digest, file_path):
+    """Hash and write the body of a streamed HTTP response, returning its size
+
+    The chunks are hashed and written by a helper thread while the next chunk
+    is received. hashlib and file writes release the GIL, so both overlap.
+    The helper thread handles one chunk at a time, in order.
+    """
+    total_size = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        pending = None
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            if pending is not None:
+                total_size += pending.result()
+            pending = executor.submit(hash_and_write, fout, chunk, computed_digest, file_path)
+        if pending is not None:
+            total_size += pending.result()
+    return total_size
+
+
+def clone_file(src_path, dst_path):
+    """Make dst_path hold the content of src_path, sharing it as much as possible
+
+    Use a hard link if possible, then a reflink, and copy the file otherwise.
+    """
+    try:
+        os.link(str(src_path), str(dst_path))
+        return 'hard link'
+    except OSError as exc:
+        if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+    with src_path.open('rb') as fin:
+        with dst_path.open('wb') as fout:
+            try:
+                fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+                return 'reflink'
+            except OSError:
+                pass
+            shutil.copyfileobj(fin, fout, DOWNLOAD_CHUNK_SIZE)
+    return 'copy'
+
+
+class HashingReader:
+    """Read-only file object over an iterator of chunks, which hashes the data as it is read"""
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.computed_digest = hashlib.sha256()
+        self.size = 0
+        self.buffer = bytearray()
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.computed_digest.update(chunk)
+            self.size += len(chunk)
+            self.buffer += chunk
+        if size < 0 or size >= len(self.buffer):
+            data = bytes(self.buffer)
+            self.buffer.clear()
+        else:
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+        return data
+
+    def drain(self):
+        """Hash the remaining data, which was not read"""
+        for chunk in self.chunks:
+            self.computed_digest.update(chunk)
+            self.size += len(chunk)
+        self.buffer.clear()
+
+
+def split_layer_member_name(name):
+    """Split the path of a member of a layer into components, returning None if it is unsafe"""
+    parts = [part for part in name.split('/') if part and part != '.']
+    if not parts or '..' in parts:
+        return None
+    return parts
+
+
+def find_in_root(root_path, parts):
+    """Get the path of a file in a root directory, without following symbolic links
+
+    Return None if a parent component of the path is not a directory.
+    """
+    path = root_path
+    for part in parts[:-1]:
+        path = path / part
+        if path.is_symlink() or not path.is_dir():
+            return None
+    if parts:
+        path = path / parts[-1]
+    return path
+
+
+def remove_path(path):
+    """Remove a file or a directory tree, without following symbolic links"""
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(str(path))
+    else:
+        path.unlink()
+
+
+class LayerExtractor:
+    """Extract a layer into a staging directory and apply it to a root filesystem
+
+    The files are written once, in the staging directory next to the root
+    filesystem, and are then moved into it. Whiteouts and the attributes of
+    directories are recorded while extracting and applied afterwards, so that
+    discarding the staging directory rolls back the extraction.
+    """
+    def __init__(self, rootfs_path):
+        self.rootfs_path = rootfs_path
+        self.staging_path = rootfs_path.with_name('.{}.layer-tmp'.format(rootfs_path.name))
+        if self.staging_path.exists():
+            shutil.rmtree(str(self.staging_path))
+        self.staging_path.mkdir()
+
+        # Components of the paths of the files to remove from the lower layers
+        self.whiteouts = []
+        # Components of the paths of the directories to empty in the lower layers
+        self.opaque_dirs = []
+        # List of (components of a path, tar member) of the directories
+        self.directories = []
+
+    @staticmethod
+    def set_attributes(path, member):
+        """Set the mode, owner and modification time of an extracted file"""
+        if os.geteuid() == 0:
+            os.lchown(str(path), member.uid, member.gid)
+        if not member.issym():
+            os.chmod(str(path), member.mode & 0o7777)
+        os.utime(str(path), (member.mtime, member.mtime), follow_symlinks=False)
+
+    def extract_member(self, tar, member):
+        """Extract a member of the layer into the staging directory"""
+        parts = split_layer_member_name(member.name)
+        if parts is None:
+            logger.warning("Skipping layer member with unsafe name %r", member.name)
+            return
+        name = parts[-1]
+        if name == WHITEOUT_OPAQUE:
+            self.opaque_dirs.append(parts[:-1])
+            return
+        if name.startswith(WHITEOUT_PREFIX):
+            self.whiteouts.append(parts[:-1] + [name[len(WHITEOUT_PREFIX):]])
+            return
+
+        # Create the parent directories, which are not always present in layers
+        parent_path = self.staging_path
+        for part in parts[:-1]:
+            parent_path = parent_path / part
+            if parent_path.is_symlink() or (parent_path.exists() and not parent_path.is_dir()):
+                logger.warning("Skipping layer member %r in a non-directory", member.name)
+                return
+            parent_path.mkdir(exist_ok=True)
+        path = parent_path / name
+
+        if member.isdir():
+            if os.path.lexists(str(path)) and (path.is_symlink() or not path.is_dir()):
+                path.unlink()
+            path.mkdir(exist_ok=True)
+            self.directories.append((parts, member))
+            return
+
+        if os.path.lexists(str(path)):
+            remove_path(path)
+        if member.isreg():
+            with tar.extractfile(member) as fin:
+                with path.open('wb') as fout:
+                    shutil.copyfileobj(fin, fout, DOWNLOAD_CHUNK_SIZE)
+        elif member.issym():
+            os.symlink(member.linkname, str(path))
+        elif member.islnk():
+            # Hard links can target files of the layer or of the lower layers
+            target_parts = split_layer_member_name(member.linkname)
+            target_path = None
+            if target_parts is not None:
+                target_path = find_in_root(self.staging_path, target_parts)
+                if target_path is None or not os.path.lexists(str(target_path)):
+                    target_path = find_in_root(self.rootfs_path, target_parts)
+            if target_path is None or not os.path.lexists(str(target_path)):
+                logger.warning("Skipping hard link %r to missing %r", member.name, member.linkname)
+                return
+            os.link(str(target_path), str(path), follow_symlinks=False)
+            return
+        elif member.isfifo():
+            os.mkfifo(str(path))
+        elif member.ischr() or member.isblk():
+            if os.geteuid() != 0:
+                logger.debug("Skipping device %r, which requires root privileges", member.name)
+                return
+            file_type = stat.S_IFCHR if member.ischr() else stat.S_IFBLK
+            os.mknod(str(path), file_type | (member.mode & 0o7777), os.makedev(member.devmajor, member.devminor))
+        else:
+            logger.warning("Skipping layer member %r with unsupported type %r", member.name, member.type)
+            return
+        self.set_attributes(path, member)
+
+    def merge_directory(self, src_path, dst_path):
+        """Move the content of a staging directory into the root filesystem"""
+        for entry in os.scandir(str(src_path)):
+            entry_dst_path = dst_path / entry.name
+            if entry.is_dir(follow_symlinks=False) and entry_dst_path.is_dir() and not entry_dst_path.is_symlink():
+                self.merge_directory(Path(entry.path), entry_dst_path)
+                continue
+            if os.path.lexists(str(entry_dst_path)):
+                remove_path(entry_dst_path)
+            os.replace(entry.path, str(entry_dst_path))
+
+    def apply(self):
+        """Apply the extracted layer to the root filesystem"""
+        for parts in self.opaque_dirs:
+            dir_path = find_in_root(self.rootfs_path, parts)
+            if dir_path is not None and dir_path.is_dir() and not dir_path.is_symlink():
+                for child_path in dir_path.iterdir():
+                    remove_path(child_path)
+        for parts in self.whiteouts:
+            path = find_in_root(self.rootfs_path, parts)
+            if path is not None and os.path.lexists(str(path)):
+                remove_path(path)
+
+        self.merge_directory(self.staging_path, self.rootfs_path)
+
+        # Set the attributes of directories after their content, which modifies their mtime
+        for parts, member in reversed(self.directories):
+            path = find_in_root(self.rootfs_path, parts)
+            if path is not None and path.is_dir() and not path.is_symlink():
+                self.set_attributes(path, member)
+        shutil.rmtree(str(self.staging_path))
+
+    def rollback(self):
+        """Discard the extracted files"""
+        if self.staging_path.exists():
+            shutil.rmtree(str(self.staging_path))
+
+
+class BlobStore:
+    """Persistent content-addressed store of layers, shared by several outputs
+
+    Each blob is stored in <directory>/<algorithm>/<hex digest>. The file
+    index.json records the inode, size and modification time of the blobs
+    which have been verified, so that they are not hashed again as long as
+    they are not modified. Several processes can use the same store: blob
+    downloads and index updates are protected by file locks.
+    """
+    INDEX_VERSION = 1
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_path = directory / 'index.json'
+        self.lock_path = directory / 'index.lock'
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        # Dictionary of "sha256:xxxxx" -> {'ino': inode, 'size': size, 'mtime_ns': modification time}
+        self.verified_blobs = {}
+        self.lock = threading.Lock()
+        self.load_index()
+
+    def load_index(self):
+        """Load the index of verified blobs from the disk"""
+        try:
+            with self.index_path.open('r') as fin:
+                data = json.load(fin)
+        except FileNotFoundError:
+            return
+        if data.get('version') != self.INDEX_VERSION:
+            logger.warning("Ignoring blob store index %s with unsupported version %r",
+                           self.index_path, data.get('version'))
+            return
+        with self.lock:
+            self.verified_blobs = data['blobs']
+
+    def get_blob_path(self, digest_name):
+        """Get the path of the blob with the given digest"""
+        algorithm, hex_digest = digest_name.split(':', 1)
+        return self.directory / algorithm / hex_digest
+
+    @contextlib.contextmanager
+    def lock_blob(self, digest_name):
+        """Prevent other processes from downloading the same blob concurrently"""
+        blob_path = self.get_blob_path(digest_name)
+        blob_path.parent.mkdir(exist_ok=True)
+        lock_path = blob_path.with_name(blob_path.name + '.lock')
+        with lock_path.open('a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield blob_path
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def is_verified(self, digest_name, file_path):
+        """Check whether the given file is a verified copy of a blob, returning its size or None"""
+        with self.lock:
+            entry = self.verified_blobs.get(digest_name)
+        if entry is None:
+            # Another process may have verified the blob
+            self.load_index()
+            with self.lock:
+                entry = self.verified_blobs.get(digest_name)
+            if entry is None:
+                return None
+        try:
+            st = file_path.stat()
+        except FileNotFoundError:
+            return None
+        if (st.st_ino, st.st_size, st.st_mtime_ns) != (entry['ino'], entry['size'], entry['mtime_ns']):
+            return None
+        return st.st_size
+
+    def set_verified(self, digest_name):
+        """Record that the blob with the given digest has been verified"""
+        blob_path = self.get_blob_path(digest_name)
+        # Prevent modifications through the hard links of the outputs
+        blob_path.chmod(stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        st = blob_path.stat()
+        entry = {'ino': st.st_ino, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+        # Merge the index with the one of other processes and write it atomically
+        with self.lock_path.open('a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                self.load_index()
+                with self.lock:
+                    self.verified_blobs[digest_name] = entry
+                    data = {'version': self.INDEX_VERSION, 'blobs': self.verified_blobs.copy()}
+                tmp_path = self.index_path.with_name(self.index_path.name + '.tmp')
+                with tmp_path.open('w') as fout:
+                    json.dump(data, fout, indent=2, sort_keys=True)
+                    fout.write('\n')
+                os.replace(tmp_path, self.index_path)
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+        return st.st_size
+
+    def import_file(self, digest_name, file_path):
+        """Add an already-verified file to the store"""
+        blob_path = self.get_blob_path(digest_name)
+        tmp_path = blob_path.with_name(blob_path.name + '.tmp')
+        if tmp_path.exists():
+            tmp_path.unlink()
+        clone_file(file_path, tmp_path)
+        os.replace(tmp_path, blob_path)
+        return self.set_verified(digest_name)
+
+    def link_blob(self, digest_name, output_path):
+        """Make output_path hold the content of a blob of the store"""
+        blob_path = self.get_blob_path(digest_name)
+        try:
+            if output_path.samefile(blob_path):
+                return
+        except FileNotFoundError:
+            pass
+        tmp_path = output_path.with_name(output_path.name + '.tmp')
+        if tmp_path.exists():
+            tmp_path.unlink()
+        method = clone_file(blob_path, tmp_path)
+        os.replace(tmp_path, output_path)
+        logger.debug("Linked %s to %s (%s)", output_path, blob_path, method)
+
+
 class DockerRegistry:
     """Handle information about a connection to a docker registry"""
-    def __init__(self, url, trust_filesystem=False):
+    def __init__(self, url, trust_filesystem=False, jobs=DEFAULT_DOWNLOAD_JOBS, blob_store=None):
         url = url.rstrip('/')
         # Prepend https:// automatically
         if '://' not in url:
@@ -110,6 +541,17 @@ class DockerRegistry:
         self.headers = {}
         self.last_auth_scope = None
         self.trust_filesystem = trust_filesystem
+        self.jobs = jobs
+        self.blob_store = blob_store
+
+        # Share a pool of connections among all requests, including concurrent layer downloads
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=jobs, pool_maxsize=jobs)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # Serialize the authentication procedures of concurrent downloads
+        self.auth_lock = threading.RLock()
 
         # Set of layer digests that have already been validated in cache
         # Dictionary of "sha256:xxxxx" -> size of layer
@@ -133,7 +575,7 @@ class DockerRegistry:
             del self.headers['Authorization']
 
         ping_url = '{}/v2/'.format(self.url)
-        ping_response = requests.get(ping_url, headers=self.headers, allow_redirects=False)
+        ping_response = self.session.get(ping_url, headers=self.headers, allow_redirects=False)
         if ping_response.status_code == 200:
             logger.debug("Ping OK, result=%r", ping_response.json())
             return ping_response.json()
@@ -156,7 +598,7 @@ class DockerRegistry:
                 if scope:
                     auth_params['scope'] = scope
 
-                auth_response = requests.get(auth_realm, params=auth_params, allow_redirects=False)
+                auth_response = self.session.get(auth_realm, params=auth_params, allow_redirects=False)
                 if auth_response.status_code != 200:
                     logger.error("Unexpected auth response code %d", auth_response.status_code)
                     raise ValueError("Unexpected auth response")
@@ -168,7 +610,7 @@ class DockerRegistry:
                 self.last_auth_scope = scope
 
                 # Try pinging again
-                ping_response = requests.get(ping_url, headers=self.headers, allow_redirects=False)
+                ping_response = self.session.get(ping_url, headers=self.headers, allow_redirects=False)
                 if ping_response.status_code != 200:
                     logger.error("Unsuccessful authenticated ping response code %d", ping_response.status_code)
                     raise ValueError("Unsuccessful authenticated ping response")
@@ -183,13 +625,13 @@ class DockerRegistry:
     def get_with_scope(self, url, scope, headers=None, allow_redirects=False, stream=False):
         """Perform a HTTP GET request with the specified scope"""
         assert scope
-        if self.last_auth_scope != scope:
-            self.ping(scope=scope)
-        used_headers = self.headers
+        with self.auth_lock:
+            if self.last_auth_scope != scope:
+                self.ping(scope=scope)
+            used_headers = self.headers.copy()
         if headers:
-            used_headers = used_headers.copy()
             used_headers.update(headers)
-        response = requests.get(
+        response = self.session.get(
             url,
             headers=used_headers,
             allow_redirects=allow_redirects,
@@ -197,15 +639,18 @@ class DockerRegistry:
         if response.status_code == 401:
             # Launch an authentication procedure (the token may have expired)
             logger.debug("Trying to authenticate again, to get %r", url)
-            self.last_auth_scope = None
-            self.ping(scope=scope)
-
-            # Recompute the headers with the new authentication header value
-            used_headers = self.headers
+            response.close()
+            with self.auth_lock:
+                if self.headers.get('Authorization') == used_headers.get('Authorization'):
+                    # Another thread did not already renew the token
+                    self.last_auth_scope = None
+                    self.ping(scope=scope)
+
+                # Recompute the headers with the new authentication header value
+                used_headers = self.headers.copy()
             if headers:
-                used_headers = used_headers.copy()
                 used_headers.update(headers)
-            response = requests.get(
+            response = self.session.get(
                 url,
                 headers=used_headers,
                 allow_redirects=allow_redirects,
@@ -289,8 +734,49 @@ class DockerRegistry:
 
         raise ValueError("Unimplemented manifest content type {}".format(repr(content_type)))
 
+    def request_layer(self, image_name, digest_name, urls=None, resume_size=0):
+        """Send a streamed HTTP request to retrieve a layer, from the given offset"""
+        headers = None
+        if resume_size:
+            headers = {'Range': 'bytes={}-'.format(resume_size)}
+
+        if not urls:
+            # Allow redirections, here
+            return self.get_with_scope(
+                '{}/v2/{}/blobs/{}'.format(self.url, image_name, digest_name),
+                scope='repository:{}:pull'.format(image_name),
+                headers=headers,
+                allow_redirects=True,
+                stream=True)
+
+        # Use other URLs that the registry
+        for foreign_url in urls:
+            response = self.get_with_scope(
+                foreign_url,
+                scope='repository:{}:pull'.format(image_name),
+                headers=headers,
+                allow_redirects=True,
+                stream=True)
+            if response.status_code in (200, 206) or (resume_size and response.status_code == 416):
+                return response
+            logger.warning("Unable to retrieve layer %r:%r from %r: HTTP error %d",
+                           image_name, digest_name, foreign_url, response.status_code)
+            try:
+                logger.warning("... Response JSON: %r", response.json())
+            except json.JSONDecodeError:
+                # Some HTTP 404 errors do not provide a JSON response
+                logger.warning("... Response (not JSON): %r", response.content)
+            # Continuing with other foreign URL...
+            continue
+        logger.error("Unable to retrieve layer %r:%r using foreign URL: HTTP error %d",
+                     image_name, digest_name, response.status_code)
+        raise ValueError("HTTP error {}".format(response.status_code))
+
     def download_layer(self, image_name, digest_name, output_path, urls=None):
         """Download a layer according to the specified digest"""
+        if self.blob_store is not None:
+            return self.download_layer_to_store(image_name, digest_name, output_path, urls=urls)
+
         # If the layer is already known, return its size
         cached_layer_size = self.cached_layer_digests.get(digest_name)
         if cached_layer_size:
@@ -307,15 +793,7 @@ class DockerRegistry:
                 self.cached_layer_digests[digest_name] = total_size
                 return total_size
 
-            computed_digest = hashlib.sha256()
-            total_size = 0
-            with output_path.open('rb') as fout:
-                while True:
-                    chunk = fout.read(4096)
-                    if not chunk:
-                        break
-                    computed_digest.update(chunk)
-                    total_size += len(chunk)
+            computed_digest, total_size = hash_file(output_path)
             resulting_name = 'sha256:{}'.format(computed_digest.hexdigest())
             if resulting_name != digest_name:
                 raise ValueError("Invalid file {} with mismatched SHA256 digest: {} != {}".format(
@@ -324,96 +802,183 @@ class DockerRegistry:
             self.cached_layer_digests[digest_name] = total_size
             return total_size
 
+        total_size = self.fetch_layer(image_name, digest_name, output_path, urls=urls)
+        self.cached_layer_digests[digest_name] = total_size
+        return total_size
+
+    def download_layer_to_store(self, image_name, digest_name, output_path, urls=None):
+        """Download a layer into the blob store, and link it to the output path"""
+        blob_store = self.blob_store
+        with blob_store.lock_blob(digest_name) as blob_path:
+            total_size = blob_store.is_verified(digest_name, blob_path)
+            if total_size is not None:
+                logger.info("Using already-validated %d bytes from %s", total_size, blob_path)
+            elif blob_path.exists() and self.trust_filesystem:
+                total_size = blob_store.set_verified(digest_name)
+                logger.info("Trusting cached %d bytes from %s", total_size, blob_path)
+            elif output_path.exists():
+                # Import the layers of outputs which were downloaded without the store
+                computed_digest, total_size = hash_file(output_path)
+                resulting_name = 'sha256:{}'.format(computed_digest.hexdigest())
+                if resulting_name != digest_name:
+                    raise ValueError("Invalid file {} with mismatched SHA256 digest: {} != {}".format(
+                        output_path, repr(resulting_name), repr(digest_name)))
+                blob_store.import_file(digest_name, output_path)
+                logger.info("Imported %d bytes from %s to %s", total_size, output_path, blob_path)
+            else:
+                if blob_path.exists():
+                    # The blob was modified since it was verified
+                    computed_digest, total_size = hash_file(blob_path)
+                    resulting_name = 'sha256:{}'.format(computed_digest.hexdigest())
+                    if resulting_name != digest_name:
+                        logger.warning("Removing corrupted blob %s", blob_path)
+                        blob_path.unlink()
+                if not blob_path.exists():
+                    self.fetch_layer(image_name, digest_name, blob_path, urls=urls)
+                total_size = blob_store.set_verified(digest_name)
+        blob_store.link_blob(digest_name, output_path)
+        self.cached_layer_digests[digest_name] = total_size
+        return total_size
+
+    def fetch_layer(self, image_name, digest_name, output_path, urls=None):
+        """Download a layer from the registry into the given path, resuming an interrupted download"""
         image_name = self.normalize_name_if_needed(image_name)
 
-        # Download into a ".part" file
+        # Download into a ".part" file, resuming an interrupted download if there is one
         output_part_path = output_path.with_name(output_path.name + '.part')
-
-        if not urls:
-            # Allow redirections, here
-            response = self.get_with_scope(
-                '{}/v2/{}/blobs/{}'.format(self.url, image_name, digest_name),
-                scope='repository:{}:pull'.format(image_name),
-                allow_redirects=True,
-                stream=True)
+        if output_part_path.exists():
+            computed_digest, total_size = hash_file(output_part_path)
         else:
-            # Use other URLs that the registry
-            for foreign_url in urls:
-                response = self.get_with_scope(
-                    foreign_url,
-                    scope='repository:{}:pull'.format(image_name),
-                    allow_redirects=True,
-                    stream=True)
-                if response.status_code == 200:
-                    break
-                logger.warning("Unable to retrieve layer %r:%r from %r: HTTP error %d",
-                               image_name, digest_name, foreign_url, response.status_code)
-                try:
-                    logger.warning("... Response JSON: %r", response.json())
-                except json.JSONDecodeError:
-                    # Some HTTP 404 errors do not provide a JSON response
-                    logger.warning("... Response (not JSON): %r", response.content)
-                # Continuing with other foreign URL...
-                continue
-            if response.status_code != 200:
-                logger.error("Unable to retrieve layer %r:%r using foreign URL: HTTP error %d",
-                             image_name, digest_name, response.status_code)
-                raise ValueError("HTTP error {}".format(response.status_code))
+            computed_digest = hashlib.sha256()
+            total_size = 0
 
-        if response.status_code != 200:
+        response = self.request_layer(image_name, digest_name, urls=urls, resume_size=total_size)
+        if total_size and response.status_code == 416:
+            # The partial file may hold the whole layer, if the download was interrupted just before renaming it
+            response.close()
+            resulting_name = 'sha256:{}'.format(computed_digest.hexdigest())
+            if resulting_name == digest_name:
+                os.replace(output_part_path, output_path)
+                logger.info("Completed %d bytes to %s", total_size, output_path)
+                return total_size
+            logger.warning("Discarding invalid partial download %s", output_part_path)
+            computed_digest = hashlib.sha256()
+            total_size = 0
+            response = self.request_layer(image_name, digest_name, urls=urls)
+
+        if total_size and response.status_code == 206:
+            content_range = response.headers.get('Content-Range', '')
+            if not content_range.startswith('bytes {}-'.format(total_size)):
+                response.close()
+                logger.error("Unexpected Content-Range %r when resuming layer %r:%r at %d",
+                             content_range, image_name, digest_name, total_size)
+                raise ValueError("Unexpected Content-Range {}".format(repr(content_range)))
+            logger.info("Resuming download of %s after %d bytes", output_path, total_size)
+            open_mode = 'ab'
+        elif response.status_code == 200:
+            if total_size:
+                logger.info("Unable to resume download of %s, restarting it", output_path)
+                computed_digest = hashlib.sha256()
+                total_size = 0
+            open_mode = 'wb'
+        else:
             logger.error("Unable to retrieve layer %r:%r: HTTP error %d",
                          image_name, digest_name, response.status_code)
             logger.error("... Response JSON: %r", response.json())
             raise ValueError("HTTP error {}".format(response.status_code))
 
-        total_size = 0
-        computed_digest = hashlib.sha256()
-        with output_part_path.open('wb') as fout:
-            for chunk in response.iter_content(chunk_size=4096):
-                computed_digest.update(chunk)
-                while chunk:
-                    written = fout.write(chunk)
-                    if written == 0:
-                        raise IOError("Unable to write to layer output file {}".format(output_part_path))
-                    total_size += written
-                    chunk = chunk[written:]
+        with response:
+            with output_part_path.open(open_mode) as fout:
+                total_size += hash_and_write_response(response, fout, computed_digest, output_part_path)
         resulting_name = 'sha256:{}'.format(computed_digest.hexdigest())
         if resulting_name != digest_name:
+            # Do not try resuming a corrupted download
+            output_part_path.unlink()
             raise ValueError("Mismatched SHA256 digest: {} != {}".format(
                 repr(resulting_name), repr(digest_name)))
         os.replace(output_part_path, output_path)
         logger.info("Downloaded %d bytes to %s", total_size, output_path)
-        self.cached_layer_digests[digest_name] = total_size
         return total_size
 
-    def download_image(self, image_name, tag_name, output_path):
-        """Download an image into the given output directory and return its manifest"""
-        # Start by downloading the manifest
+    def extract_layer(self, image_name, digest_name, rootfs_path, urls=None, expected_size=None):
+        """Extract a layer into a root filesystem while downloading it, and return its size
+
+        The layer is hashed, decompressed and extracted in a single pass. If
+        its digest does not match, the extracted files are discarded.
+        """
+        image_name = self.normalize_name_if_needed(image_name)
+        response = None
+        blob_file = None
+        if self.blob_store is not None:
+            blob_path = self.blob_store.get_blob_path(digest_name)
+            if self.blob_store.is_verified(digest_name, blob_path) is not None:
+                logger.info("Extracting layer %s from %s", digest_name, blob_path)
+                blob_file = blob_path.open('rb')
+                reader = HashingReader(iter(lambda: blob_file.read(DOWNLOAD_CHUNK_SIZE), b''))
+        if blob_file is None:
+            response = self.request_layer(image_name, digest_name, urls=urls)
+            if response.status_code != 200:
+                logger.error("Unable to retrieve layer %r:%r: HTTP error %d",
+                             image_name, digest_name, response.status_code)
+                raise ValueError("HTTP error {}".format(response.status_code))
+            logger.info("Extracting layer %s while downloading it", digest_name)
+            reader = HashingReader(response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE))
+
+        extractor = LayerExtractor(rootfs_path)
+        try:
+            # Layers are usually compressed with gzip, but may also be plain tar archives
+            with tarfile.open(fileobj=reader, mode='r|*') as tar:
+                for member in tar:
+                    extractor.extract_member(tar, member)
+            # Hash the end of the stream, after the end-of-archive marker
+            reader.drain()
+            resulting_name = 'sha256:{}'.format(reader.computed_digest.hexdigest())
+            if resulting_name != digest_name:
+                raise ValueError("Mismatched SHA256 digest: {} != {}".format(
+                    repr(resulting_name), repr(digest_name)))
+            if expected_size is not None and reader.size != expected_size:
+                raise ValueError("Mismatched downloaded size for layer {}: {} != {}".format(
+                    digest_name, expected_size, reader.size))
+        except BaseException:
+            logger.error("Rolling back the extraction of layer %s", digest_name)
+            extractor.rollback()
+            raise
+        finally:
+            if response is not None:
+                response.close()
+            if blob_file is not None:
+                blob_file.close()
+        extractor.apply()
+        logger.info("Extracted %d bytes of layer %s to %s", reader.size, digest_name, rootfs_path)
+        return reader.size
+
+    def extract_image(self, image_name, tag_name, rootfs_path):
+        """Extract the layers of an image into a root filesystem and return its manifest
+
+        The layers are extracted one after the other, as whiteouts depend on their order.
+        """
         image_name = self.normalize_name_if_needed(image_name)
         manifest = self.get_manifest(image_name, tag_name)
+        rootfs_path.mkdir(parents=True, exist_ok=True)
+        v1_keys = () if 'v2' in manifest else ('v1', )
+        for digest_name, foreign_urls, expected_size in self.get_manifest_layers(manifest, v1_keys=v1_keys):
+            self.extract_layer(image_name, digest_name, rootfs_path, urls=foreign_urls, expected_size=expected_size)
+        return manifest
 
-        # Save the manifest somewhere
-        manifest_escaped_name = '{}__{}.manifest.json'.format(image_name, tag_name)
-        manifest_escaped_name = manifest_escaped_name.replace('/', '__')
-        manifest_escaped_name = manifest_escaped_name.replace('\\', '__')
-        manifest_escaped_name = manifest_escaped_name.replace(':', '__')
-        if not re.match(r'^[0-9A-Za-z_.-]+$', manifest_escaped_name):
-            logger.error("Unescaped characters present in name %r from %r:%r",
-                         manifest_escaped_name, image_name, tag_name)
-            raise ValueError("Unable to save manifest to {}".format(repr(manifest_escaped_name)))
-        with (output_path / manifest_escaped_name).open('w') as fout:
-            json.dump(manifest, fout, indent=2)
-            fout.write('\n')
-        logger.info("Saved %s:%s manifest to %r", image_name, tag_name, manifest_escaped_name)
+    @staticmethod
+    def get_manifest_layers(manifest, v1_keys=('v1', 'config')):
+        """Get the layers of a manifest, as a list of (digest, foreign URLs, expected size)
 
-        # Grab all layers
-        downloaded_layers = set()
+        The layers are ordered from the base layer to the top one.
+        """
+        layers = []
+        known_layers = set()
         if 'v2' in manifest:
             for layer in manifest['v2']['layers']:
                 expected_size = layer['size']
                 digest_name = layer['digest']
                 media_type = layer['mediaType']
-                if digest_name in downloaded_layers:
+                if digest_name in known_layers:
                     continue
                 if not re.match(r'^[0-9a-z]+:[0-9a-f]+$', digest_name):
                     raise ValueError("Unexpected layer digest format: {}".format(repr(digest_name)))
@@ -429,25 +994,66 @@ class DockerRegistry:
                 else:
                     logger.warning("Unknown layer media type: %r", layer)
 
-                layer_path = output_path / (digest_name.replace(':', '_') + '.tar.gz')
-                downloaded_size = self.download_layer(image_name, digest_name, layer_path, urls=foreign_urls)
-                if downloaded_size != expected_size:
-                    raise ValueError("Mismatched downloaded size for layer {}: {} != {}".format(
-                        digest_name, expected_size, downloaded_size))
-                downloaded_layers.add(digest_name)
+                layers.append((digest_name, foreign_urls, expected_size))
+                known_layers.add(digest_name)
 
-        for v1_key in ('v1', 'config'):
+        for v1_key in v1_keys:
             if v1_key not in manifest:
                 continue
-            for layer in manifest[v1_key]['fsLayers']:
+            # Manifests v1 list the layers from the top one to the base one
+            for layer in reversed(manifest[v1_key]['fsLayers']):
                 digest_name = layer['blobSum']
-                if digest_name in downloaded_layers:
+                if digest_name in known_layers:
                     continue
                 if not re.match(r'^[0-9a-z]+:[0-9a-f]+$', digest_name):
                     raise ValueError("Unexpected layer digest format: {}".format(repr(digest_name)))
+                layers.append((digest_name, None, None))
+                known_layers.add(digest_name)
+        return layers
+
+    def download_image(self, image_name, tag_name, output_path):
+        """Download an image into the given output directory and return its manifest"""
+        # Start by downloading the manifest
+        image_name = self.normalize_name_if_needed(image_name)
+        manifest = self.get_manifest(image_name, tag_name)
+
+        # Save the manifest somewhere
+        manifest_escaped_name = '{}__{}.manifest.json'.format(image_name, tag_name)
+        manifest_escaped_name = manifest_escaped_name.replace('/', '__')
+        manifest_escaped_name = manifest_escaped_name.replace('\\', '__')
+        manifest_escaped_name = manifest_escaped_name.replace(':', '__')
+        if not re.match(r'^[0-9A-Za-z_.-]+$', manifest_escaped_name):
+            logger.error("Unescaped characters present in name %r from %r:%r",
+                         manifest_escaped_name, image_name, tag_name)
+            raise ValueError("Unable to save manifest to {}".format(repr(manifest_escaped_name)))
+        with (output_path / manifest_escaped_name).open('w') as fout:
+            json.dump(manifest, fout, indent=2)
+            fout.write('\n')
+        logger.info("Saved %s:%s manifest to %r", image_name, tag_name, manifest_escaped_name)
+
+        # Grab all layers
+        layers_to_download = self.get_manifest_layers(manifest)
+
+        # Download the layers concurrently
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = {}
+            for digest_name, foreign_urls, expected_size in layers_to_download:
                 layer_path = output_path / (digest_name.replace(':', '_') + '.tar.gz')
-                self.download_layer(image_name, digest_name, layer_path)
-                downloaded_layers.add(digest_name)
+                future = executor.submit(self.download_layer, image_name, digest_name, layer_path, urls=foreign_urls)
+                futures[future] = (digest_name, expected_size)
+
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    digest_name, expected_size = futures[future]
+                    downloaded_size = future.result()
+                    if expected_size is not None and downloaded_size != expected_size:
+                        raise ValueError("Mismatched downloaded size for layer {}: {} != {}".format(
+                            digest_name, expected_size, downloaded_size))
+            except BaseException:
+                # Do not start the remaining downloads
+                for future in futures:
+                    future.cancel()
+                raise
 
         return manifest
 
@@ -464,16 +1070,33 @@ def main(argv=None):
                         help="Output directory to download layers to")
     parser.add_argument('-r', '--registry', type=str, default=DOCKER_REGISTRY,
                         help="Docker registry to use (default: {})".format(DOCKER_REGISTRY))
+    parser.add_argument('-s', '--blob-store', type=Path,
+                        help="Directory of a persistent store of layers, linked to the output directory")
+    parser.add_argument('-x', '--extract', type=Path,
+                        help="Extract the layers into a root filesystem directory while downloading them")
     parser.add_argument('-t', '--tag', nargs='+', type=str,
                         help="Tags to use (default: latest)")
     parser.add_argument('-T', '--trust-filesystem', action='store_true',
                         help="Blindly trust layer files that are already present in the output directory")
+    parser.add_argument('-j', '--jobs', type=int, default=DEFAULT_DOWNLOAD_JOBS,
+                        help="Number of layers to download concurrently (default: {})".format(
+                            DEFAULT_DOWNLOAD_JOBS))
     args = parser.parse_args(argv)
 
     logging.basicConfig(format='[%(levelname)s] %(message)s',
                         level=logging.DEBUG if args.debug else logging.INFO)
 
-    registry = DockerRegistry(args.registry, trust_filesystem=args.trust_filesystem)
+    if args.output and args.extract:
+        parser.error("options --output and --extract cannot be used together")
+    if args.jobs < 1:
+        parser.error("the number of jobs has to be at least 1")
+
+    blob_store = None
+    if args.blob_store:
+        blob_store = BlobStore(args.blob_store)
+
+    registry = DockerRegistry(args.registry, trust_filesystem=args.trust_filesystem, jobs=args.jobs,
+                              blob_store=blob_store)
     if args.list_tags:
         for image in args.image:
             tags = registry.list_tags(image)
@@ -496,7 +1119,11 @@ def main(argv=None):
             tag_names = ('latest', )
 
         for tag in tag_names:
-            if not args.output:
+            if args.extract:
+                # Extract the layers without saving them
+                logger.info("Extracting {}:{}...".format(image, tag))
+                registry.extract_image(image, tag, args.extract)
+            elif not args.output:
                 # Without an output directory, print the manifest
                 print("Manifest of {}:{}:".format(image, tag))
                 manifest = registry.get_manifest(image, tag)
@@ -29,7 +29,7 @@ import subprocess
 import sys
 import urllib.parse
 
-import requests
+from paginated_api import DEFAULT_PAGE_JOBS, PaginatedApiClient
 
 
 # pylint: disable=invalid-name
@@ -86,55 +86,55 @@ def selfchecks_parse_link_headers():
 selfchecks_parse_link_headers()
 
 
-def list_github_user_repos(github_api_url, username, per_page=100):
+def set_url_page(url, page):
+    """Set the page parameter of an URL from a Link header"""
+    obj = urllib.parse.urlparse(url)
+    query = urllib.parse.parse_qs(obj.query)
+    query['page'] = [str(page)]
+    return urllib.parse.urlunparse(obj._replace(query=urllib.parse.urlencode(query, doseq=True)))
+
+
+def list_github_user_repos(github_api_url, username, per_page=100, client=None):
     """Use GitHub's API to list the repositories of a user
 
     https://developer.github.com/v3/repos/#list-user-repositories
     """
+    if client is None:
+        client = PaginatedApiClient()
     endpoint_url = '{}/users/{}/repos?per_page={}'.format(github_api_url, username, per_page)
-    response = requests.get(endpoint_url, allow_redirects=False)
-    if response.status_code != 200:
-        raise ValueError("unsuccessful HTTP status code {}".format(response.status_code))
-
-    # Craft the result using pagination
-    result = response.json()
-
-    # Grab pagination headers
-    if 'Link' not in response.headers:
-        return result
-
-    links = parse_link_headers(response.headers['Link'])
-    # Truncate the results if the pagination headers are invalid
-    if 'next' not in links or links['next']['per_page'] != per_page or links['next']['page'] != 2:
-        logger.error("Invalid next part in Link header: %r", response.headers['Link'])
-        return result
-    if 'last' not in links or links['last']['per_page'] != per_page or links['last']['page'] < 2:
-        logger.error("Invalid last part in Link header: %r", response.headers['Link'])
-        return result
-    last_page = links['last']['page']
-
-    while True:
-        next_page = links['next']['page']
-        logger.debug("Requesting page %d/%d", next_page, last_page)
-        response = requests.get(
-            links['next']['url'],
-            allow_redirects=False)
-        if response.status_code != 200:
-            raise ValueError("unsuccessful HTTP status code {}".format(response.status_code))
-        result += response.json()
-
-        links = parse_link_headers(response.headers['Link'])
-        if 'next' not in links:
-            break
 
-        if links['next']['page'] != next_page + 1:
-            logger.error("Invalid next part in Link header of page %d: %r", next_page, response.headers['Link'])
-            break
+    def get_page_urls(first_response):
+        """Get the URLs of the other pages, from the Link header of the first one"""
+        # Grab pagination headers
+        if 'Link' not in first_response.headers:
+            return []
+
+        links = parse_link_headers(first_response.headers['Link'])
+        # Truncate the results if the pagination headers are invalid
+        if 'next' not in links or links['next']['per_page'] != per_page or links['next']['page'] != 2:
+            logger.error("Invalid next part in Link header: %r", first_response.headers['Link'])
+            return []
+        if 'last' not in links or links['last']['per_page'] != per_page or links['last']['page'] < 2:
+            logger.error("Invalid last part in Link header: %r", first_response.headers['Link'])
+            return []
+        last_page = links['last']['page']
+        return [set_url_page(links['next']['url'], page) for page in range(2, last_page + 1)]
+
+    def check_page(page_number, response):
+        """Check the Link header of a page, truncating the results if it is not consistent"""
+        links = parse_link_headers(response.headers.get('Link', ''))
+        if 'next' not in links:
+            # This is the last page
+            return True
+        if links['next']['page'] != page_number + 1:
+            logger.error("Invalid next part in Link header of page %d: %r", page_number, response.headers['Link'])
+            return False
         if 'last' not in links or links['last']['per_page'] != per_page:
-            logger.error("Invalid last part in Link header of page %d: %r", next_page, response.headers['Link'])
-            break
+            logger.error("Invalid last part in Link header of page %d: %r", page_number, response.headers['Link'])
+            return False
+        return True
 
-    return result
+    return client.fetch_all_pages(endpoint_url, get_page_urls, check_page)
 
 
 def main(argv=None):
@@ -143,10 +143,14 @@ def main(argv=None):
                         help="username to list the repositories from")
     parser.add_argument('-c', '--clone', action='store_true',
                         help="clone the repositories")
+    parser.add_argument('-C', '--cache-dir', metavar='CACHE_DIR', type=Path,
+                        help="cache the API responses in this directory, revalidating them with their ETag")
     parser.add_argument('-j', '--json-out', metavar='OUTPUT_FILE', type=Path,
                         help="write the JSON metadata to this file")
     parser.add_argument('-o', '--output', metavar='OUTPUT_DIR', type=Path,
                         help="output directory where to clone the repositories")
+    parser.add_argument('-J', '--jobs', type=int, default=DEFAULT_PAGE_JOBS,
+                        help="number of pages to request concurrently ({} by default)".format(DEFAULT_PAGE_JOBS))
     parser.add_argument('-p', '--perpage', type=int, default=100,
                         help="number of results on each page, for the API (100 by default)")
     parser.add_argument('-s', '--ssh', action='store_true',
@@ -158,7 +162,8 @@ def main(argv=None):
     logging.basicConfig(format='[%(levelname)s] %(message)s', level=logging.DEBUG)
 
     try:
-        repos = list_github_user_repos(args.url, args.user, per_page=args.perpage)
+        client = PaginatedApiClient(cache_dir=args.cache_dir, jobs=args.jobs)
+        repos = list_github_user_repos(args.url, args.user, per_page=args.perpage, client=client)
     except ValueError as exc:
         logger.error("Error: %s", exc)
         return 1
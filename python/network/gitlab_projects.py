@@ -27,65 +27,62 @@ from pathlib import Path
 import re
 import subprocess
 import sys
+import urllib.parse
 
-import requests
+from paginated_api import DEFAULT_PAGE_JOBS, PaginatedApiClient
 
 
 # pylint: disable=invalid-name
 logger = logging.getLogger(__name__)
 
 
-def list_gitlab_user_projects(gitlab_url, username):
+def list_gitlab_user_projects(gitlab_url, username, client=None):
     """Use Gitlab's API to list the projects of a user
 
     https://docs.gitlab.com/ee/api/projects.html#list-user-projects
     """
+    if client is None:
+        client = PaginatedApiClient()
     endpoint_url = '{}/api/v4/users/{}/projects'.format(gitlab_url, username)
-    response = requests.get(endpoint_url, allow_redirects=False)
-    if response.status_code != 200:
-        raise ValueError("unsuccessful HTTP status code {}".format(response.status_code))
-
-    # Craft the result using pagination
-    result = response.json()
-
-    # Grab pagination headers
-    if response.headers['X-Page'] != '1':
-        raise ValueError("unexpected X-Page header: {} != 1".format(repr(response.headers['X-Page'])))
-    total_number = int(response.headers['X-Total'])
-    total_pages = int(response.headers['X-Total-Pages'])
-    per_page = int(response.headers['X-Per-Page'])
-    current_page = 1
-    while response.headers['X-Next-Page']:
-        if response.headers['X-Next-Page'] != str(current_page + 1):
-            raise ValueError("unexpected X-Next-Page header: {} != {}".format(
-                repr(response.headers['X-Next-Page']), current_page + 1))
-
-        current_page += 1
-        response = requests.get(
-            endpoint_url,
-            params={'page': current_page, 'per_page': per_page},
-            allow_redirects=False)
-        if response.status_code != 200:
-            raise ValueError("unsuccessful HTTP status code {}".format(response.status_code))
-
-        if response.headers['X-Page'] != str(current_page):
+    pagination = {}
+
+    def get_page_urls(first_response):
+        """Get the URLs of the other pages, from the pagination headers of the first one"""
+        if first_response.headers['X-Page'] != '1':
+            raise ValueError("unexpected X-Page header: {} != 1".format(repr(first_response.headers['X-Page'])))
+        pagination['total_number'] = int(first_response.headers['X-Total'])
+        pagination['total_pages'] = int(first_response.headers['X-Total-Pages'])
+        pagination['per_page'] = int(first_response.headers['X-Per-Page'])
+        if not first_response.headers['X-Next-Page']:
+            return []
+        if first_response.headers['X-Next-Page'] != '2':
+            raise ValueError("unexpected X-Next-Page header: {} != 2".format(
+                repr(first_response.headers['X-Next-Page'])))
+        return [
+            '{}?{}'.format(endpoint_url, urllib.parse.urlencode({'page': page, 'per_page': pagination['per_page']}))
+            for page in range(2, pagination['total_pages'] + 1)
+        ]
+
+    def check_page(page_number, response):
+        """Check that the pagination headers of a page are consistent with the first one"""
+        if response.headers['X-Page'] != str(page_number):
             raise ValueError("unexpected X-Page header: {} != {}".format(
-                repr(response.headers['X-Page']), current_page))
-        if response.headers['X-Total'] != str(total_number):
+                repr(response.headers['X-Page']), page_number))
+        if response.headers['X-Total'] != str(pagination['total_number']):
             raise ValueError("unexpected X-Total header: {} != {}".format(
-                repr(response.headers['X-Total']), total_number))
-        if response.headers['X-Total-Pages'] != str(total_pages):
+                repr(response.headers['X-Total']), pagination['total_number']))
+        if response.headers['X-Total-Pages'] != str(pagination['total_pages']):
             raise ValueError("unexpected X-Total-Pages header: {} != {}".format(
-                repr(response.headers['X-Total-Pages']), total_pages))
-        if response.headers['X-Per-Page'] != str(per_page):
+                repr(response.headers['X-Total-Pages']), pagination['total_pages']))
+        if response.headers['X-Per-Page'] != str(pagination['per_page']):
             raise ValueError("unexpected X-Per-Page header: {} != {}".format(
-                repr(response.headers['X-Per-Page']), per_page))
+                repr(response.headers['X-Per-Page']), pagination['per_page']))
+        return True
 
-        result += response.json()
-
-    if len(result) != total_number:
+    result = client.fetch_all_pages(endpoint_url, get_page_urls, check_page)
+    if len(result) != pagination['total_number']:
         logger.warning("X-Total header does not match the number of results: %d != %d",
-                       total_number, len(result))
+                       pagination['total_number'], len(result))
     return result
 
 
@@ -95,6 +92,10 @@ def main(argv=None):
                         help="username to list the projects from")
     parser.add_argument('-c', '--clone', action='store_true',
                         help="clone the projects")
+    parser.add_argument('-C', '--cache-dir', metavar='CACHE_DIR', type=Path,
+                        help="cache the API responses in this directory, revalidating them with their ETag")
+    parser.add_argument('-J', '--jobs', type=int, default=DEFAULT_PAGE_JOBS,
+                        help="number of pages to request concurrently ({} by default)".format(DEFAULT_PAGE_JOBS))
     parser.add_argument('-j', '--json-out', metavar='OUTPUT_FILE', type=Path,
                         help="write the JSON metadata to this file")
     parser.add_argument('-o', '--output', metavar='OUTPUT_DIR', type=Path,
@@ -108,7 +109,8 @@ def main(argv=None):
     logging.basicConfig(format='[%(levelname)s] %(message)s', level=logging.DEBUG)
 
     try:
-        projects = list_gitlab_user_projects(args.url, args.user)
+        client = PaginatedApiClient(cache_dir=args.cache_dir, jobs=args.jobs)
+        projects = list_gitlab_user_projects(args.url, args.user, client=client)
     except ValueError as exc:
         logger.error("Error: %s", exc)
         return 1
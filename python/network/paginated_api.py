@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# -*- coding:UTF-8 -*-
+# Copyright (c) 2020 Nicolas Iooss
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""Fetch all the pages of a paginated JSON API
+
+This is used by github_repos.py and gitlab_projects.py. Once the first page
+tells how many pages there are, the other ones are requested concurrently,
+through a shared pool of HTTP connections.
+
+Responses can be cached in a directory. They are then revalidated with
+If-None-Match headers, and a "304 Not Modified" response reuses the cached
+data. This makes repeated runs cheap, as 304 responses do not count in the
+rate limits of GitHub's API.
+
+Usage example:
+
+    # Fetch a single API endpoint, with a cache
+    paginated_api.py -c api_cache.out https://api.github.com/users/github
+
+Without any URL, the pagination of GitHub and GitLab is tested against a local
+stub server.
+"""
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import http.server
+import json
+import logging
+from pathlib import Path
+import os
+import re
+import tempfile
+import threading
+import urllib.parse
+
+import requests
+import requests.adapters
+import requests.structures
+
+
+# pylint: disable=invalid-name
+logger = logging.getLogger(__name__)
+
+
+# Default number of pages which are fetched concurrently
+DEFAULT_PAGE_JOBS = 8
+
+
+ApiResponse = collections.namedtuple('ApiResponse', ('url', 'headers', 'data', 'from_cache'))
+
+
+class ApiResponseCache:
+    """Cache of the responses of an API, revalidated with their ETag
+
+    Each response is stored in a JSON file named after the SHA256 digest of its URL.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def get_path(self, url):
+        """Get the path of the cache file of an URL"""
+        return self.directory / '{}.json'.format(hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+    def load(self, url):
+        """Load a cached response, returning None if there is none"""
+        try:
+            with self.get_path(url).open('r') as fin:
+                cached = json.load(fin)
+        except FileNotFoundError:
+            return None
+        except ValueError as exc:
+            logger.warning("Ignoring invalid cache file for %r: %s", url, exc)
+            return None
+        if cached.get('url') != url:
+            return None
+        return cached
+
+    def save(self, url, etag, headers, data):
+        """Save a response, using a temporary file to never leave a partial file"""
+        cache_path = self.get_path(url)
+        tmp_path = cache_path.with_name('{}.{}.tmp'.format(cache_path.name, os.getpid()))
+        with tmp_path.open('w') as fout:
+            json.dump({'url': url, 'etag': etag, 'headers': dict(headers), 'data': data}, fout)
+        os.replace(tmp_path, cache_path)
+
+
+class PaginatedApiClient:
+    """Client of a paginated JSON API"""
+    def __init__(self, cache_dir=None, jobs=DEFAULT_PAGE_JOBS):
+        self.jobs = jobs
+        self.cache = ApiResponseCache(cache_dir) if cache_dir else None
+
+        # Share a pool of connections among the concurrent requests
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=jobs, pool_maxsize=jobs)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get_json(self, url):
+        """Perform a HTTP GET request and decode its JSON response, using the cache if possible"""
+        cached = self.cache.load(url) if self.cache else None
+        headers = {}
+        if cached and cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+
+        response = self.session.get(url, headers=headers, allow_redirects=False)
+        if response.status_code == 304 and cached:
+            logger.debug("Using cached response of %r", url)
+            # The headers of a 304 response update the cached ones, such as the pagination headers
+            cached_headers = requests.structures.CaseInsensitiveDict(cached['headers'])
+            cached_headers.update(response.headers)
+            return ApiResponse(url=url, headers=cached_headers, data=cached['data'], from_cache=True)
+        if response.status_code != 200:
+            raise ValueError("unsuccessful HTTP status code {}".format(response.status_code))
+
+        data = response.json()
+        etag = response.headers.get('ETag')
+        if self.cache and etag:
+            self.cache.save(url, etag, response.headers, data)
+        return ApiResponse(url=url, headers=response.headers, data=data, from_cache=False)
+
+    def fetch_all_pages(self, first_url, get_page_urls, check_page=None):
+        """Fetch all the pages of a list, concatenating their results
+
+        get_page_urls(first_response) returns the URLs of the pages after the
+        first one. Once all pages are received, check_page(page_number, response)
+        can verify their consistency with the first one. Raising an exception
+        aborts the fetch and returning False truncates the results before
+        the page.
+        """
+        first_response = self.get_json(first_url)
+        result = list(first_response.data)
+        page_urls = get_page_urls(first_response)
+        if not page_urls:
+            return result
+
+        logger.debug("Requesting %d more pages from %r", len(page_urls), first_url)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            responses = list(executor.map(self.get_json, page_urls))
+
+        cached_count = sum(1 for response in responses if response.from_cache)
+        if first_response.from_cache:
+            cached_count += 1
+        logger.debug("%d/%d pages were not modified", cached_count, len(responses) + 1)
+
+        for page_number, response in enumerate(responses, 2):
+            if check_page is not None and check_page(page_number, response) is False:
+                break
+            result += response.data
+        return result
+
+
+class StubApiRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Handle the requests to a PaginatedApiStubServer"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        status, headers, body = self.server.stub.get_response(self.path, self.headers.get('If-None-Match'))
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logger.debug("Stub server: %s", format % args)
+
+
+class PaginatedApiStubServer:
+    """HTTP server for tests, paginating a list of items like GitHub and GitLab
+
+    It listens on a random port of the loopback interface. The pages of
+    /users/NAME/repos have a Link header like GitHub's API, and the pages of
+    /api/v4/users/NAME/projects have X-Page headers like GitLab's API. Every
+    response has an ETag, and 304 responses only contain this ETag.
+    """
+    def __init__(self, items, default_per_page=4):
+        self.items = items
+        self.default_per_page = default_per_page
+        self.status_counts = collections.Counter()
+        self.lock = threading.Lock()
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubApiRequestHandler)
+        self.httpd.stub = self
+        self.url = 'http://127.0.0.1:{}'.format(self.httpd.server_port)
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_pagination_headers(self, path, page, per_page):
+        """Get the pagination headers of a page, or None if the path is not known"""
+        total_pages = max(1, (len(self.items) + per_page - 1) // per_page)
+        if re.match(r'^/users/[^/]+/repos$', path):
+            links = []
+            if page < total_pages:
+                links += [('next', page + 1), ('last', total_pages)]
+            if page > 1:
+                links += [('first', 1), ('prev', page - 1)]
+            return {
+                'Link': ', '.join(
+                    '<{}{}?per_page={}&page={}>; rel="{}"'.format(self.url, path, per_page, link_page, rel)
+                    for rel, link_page in links),
+            }
+        if re.match(r'^/api/v4/users/[^/]+/projects$', path):
+            return {
+                'X-Page': str(page),
+                'X-Per-Page': str(per_page),
+                'X-Total': str(len(self.items)),
+                'X-Total-Pages': str(total_pages),
+                'X-Next-Page': str(page + 1) if page < total_pages else '',
+                'X-Prev-Page': str(page - 1) if page > 1 else '',
+            }
+        return None
+
+    def get_response(self, url_path, if_none_match):
+        """Get the status, the headers and the body of the response to a request"""
+        url_parts = urllib.parse.urlsplit(url_path)
+        query = urllib.parse.parse_qs(url_parts.query)
+        per_page = int(query.get('per_page', [self.default_per_page])[0])
+        page = int(query.get('page', [1])[0])
+        headers = self.get_pagination_headers(url_parts.path, page, per_page)
+        if headers is None:
+            status = 404
+            headers = {}
+            body = b''
+        else:
+            body = json.dumps(self.items[(page - 1) * per_page:page * per_page]).encode('utf-8')
+            etag = '"{}"'.format(hashlib.sha256(body).hexdigest()[:16])
+            if if_none_match == etag:
+                status = 304
+                headers = {'ETag': etag}
+                body = b''
+            else:
+                status = 200
+                headers['ETag'] = etag
+                headers['Content-Type'] = 'application/json; charset=utf-8'
+        with self.lock:
+            self.status_counts[status] += 1
+        return status, headers, body
+
+
+def self_test():
+    """Fetch paginated lists from a stub server twice, the second time from the cache"""
+    # These modules import this one, so import them only when testing
+    from github_repos import list_github_user_repos
+    from gitlab_projects import list_gitlab_user_projects
+
+    items = [{'id': index, 'name': 'project{}'.format(index)} for index in range(23)]
+    with tempfile.TemporaryDirectory(prefix='paginated_api-') as cache_dir:
+        with PaginatedApiStubServer(items) as server:
+            for expected_status in (200, 304):
+                client = PaginatedApiClient(cache_dir=Path(cache_dir), jobs=3)
+                # Do not use the proxies of the environment to reach the local server
+                client.session.trust_env = False
+                github_result = list_github_user_repos(server.url, 'user', per_page=5, client=client)
+                assert github_result == items, github_result
+                gitlab_result = list_gitlab_user_projects(server.url, 'user', client=client)
+                assert gitlab_result == items, gitlab_result
+                client.session.close()
+                # 5 GitHub pages of 5 items and 6 GitLab pages of 4 items
+                assert server.status_counts[expected_status] == 11, server.status_counts
+    logger.info("Fetched %d items with two kinds of pagination, then again with %d 304 responses",
+                len(items), server.status_counts[304])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fetch a JSON API endpoint")
+    parser.add_argument('url', metavar="URL", nargs='?', type=str,
+                        help="URL of the API endpoint (default: test against a local stub server)")
+    parser.add_argument('-c', '--cache-dir', type=Path,
+                        help="cache the responses in this directory")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='[%(levelname)s] %(message)s', level=logging.DEBUG)
+
+    if args.url is None:
+        self_test()
+        return
+
+    client = PaginatedApiClient(cache_dir=args.cache_dir)
+    response = client.get_json(args.url)
+    logger.info("Response %s", "from cache" if response.from_cache else "received")
+    print(json.dumps(response.data, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -32,12 +32,31 @@ Usage on Linux:
 
     ./parse_tcpchannel.py clean_capture.pcap
 
+4. Or export the reassembled data of each TCP stream, with an index of the
+   flows in index.json (option --container writes all the data in a single
+   file, flows.bin, where each direction of a flow is a list of extents):
+
+    ./parse_tcpchannel.py -o flows_dir clean_capture.pcap
+
+5. With option --jobs, the TCP segments of pcap files are read without scapy
+   and the streams are reassembled in several worker processes:
+
+    ./parse_tcpchannel.py -j 32 -o flows_dir clean_capture.pcap
+
 @author Nicolas Iooss
 @license: MIT
 """
 import argparse
 from contextlib import suppress
+import heapq
+import json
 import logging
+import multiprocessing
+import os
+import queue
+import socket
+import struct
+import traceback
 
 from scapy.all import PcapReader, Padding
 
@@ -45,103 +64,227 @@ from scapy.all import PcapReader, Padding
 # pylint: disable=invalid-name
 logger = logging.getLogger(__name__)
 
+# Number of seconds without packets after which a TCP stream is forgotten
+DEFAULT_IDLE_TIMEOUT = 600
+
+# TCP flags
+TCP_FLAG_FIN = 0x01
+TCP_FLAG_SYN = 0x02
+TCP_FLAG_RST = 0x04
+TCP_FLAGS_SA = 0x12  # SYN + ACK
+
+# Byte order and timestamp divisor of classic pcap files, for each magic number
+PCAP_MAGIC = {
+    b'\xa1\xb2\xc3\xd4': ('>', 1000000),
+    b'\xd4\xc3\xb2\xa1': ('<', 1000000),
+    b'\xa1\xb2\x3c\x4d': ('>', 1000000000),  # nanosecond precision
+    b'\x4d\x3c\xb2\xa1': ('<', 1000000000),  # nanosecond precision
+}
+
+# Link types of pcap files which can be read without scapy:
+# Ethernet, raw IP, Linux cooked capture (v1 and v2), raw IPv4 and raw IPv6
+RAW_LINKTYPES = frozenset((1, 101, 113, 228, 229, 276))
+
+# IPv6 extension headers which use the generic format (next header, length in 8-octet units - 1):
+# Hop-by-Hop Options, Routing, Destination Options, Mobility, Host Identity Protocol, Shim6
+IPV6_GENERIC_EXTENSION_HEADERS = frozenset((0, 43, 60, 135, 139, 140))
+
+# Number of segments sent at once to a worker process
+SHARD_BATCH_SIZE = 256
+
 
 def repr_0(value, basecolor=''):
     """Represent binary data by replacing \0 with a colored underscore"""
     return basecolor + repr(value).replace('\\x00', '\033[36m_\033[m' + basecolor) + '\033[m'
 
 
+class TcpReassemblyBuffer:
+    """Reassemble the payloads of one direction of a TCP stream
+
+    Sequence numbers are converted to offsets from the first known sequence
+    number, relatively to the next expected offset, which handles wraparounds
+    and streams larger than 4 GiB. Segments received in advance are kept in an
+    interval map (a dict indexed by offset with a heap of the offsets) until
+    the missing data arrives. If too much data is waiting, the missing bytes
+    are skipped, so that memory usage remains bounded.
+    """
+    MAX_BUFFERED_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, initial_seq=None):
+        self.initial_seq = initial_seq
+        # Offset of the next expected byte, which is the number of reassembled bytes
+        self.next_offset = 0
+        # Out-of-order segments: offset -> data, and heap of the offsets
+        self.future_segments = {}
+        self.future_offsets = []
+        self.buffered_size = 0
+        self.skipped_size = 0
+        # Offset after the last byte, when a FIN flag has been received
+        self.fin_offset = None
+        # Reassembled data which has not been parsed yet, extended in place
+        self.unparsed = bytearray()
+
+    def seq_to_offset(self, seq):
+        """Convert a sequence number to an offset in the stream"""
+        if self.initial_seq is None:
+            self.initial_seq = seq
+        delta = (seq - self.initial_seq - self.next_offset) & 0xffffffff
+        if delta >= 0x80000000:
+            delta -= 0x100000000
+        return self.next_offset + delta
+
+    def add_segment(self, seq, data):
+        """Add a segment and return the list of the payloads which can be parsed in order"""
+        start = self.seq_to_offset(seq)
+        end = start + len(data)
+        if end <= self.next_offset:
+            # Ignore repeated packets
+            return []
+
+        if start > self.next_offset:
+            logger.debug("Keeping out-of-order segment at offset %d (expected %d)", start, self.next_offset)
+            previous = self.future_segments.get(start)
+            if previous is None:
+                heapq.heappush(self.future_offsets, start)
+                self.future_segments[start] = data
+                self.buffered_size += len(data)
+            elif len(previous) < len(data):
+                self.future_segments[start] = data
+                self.buffered_size += len(data) - len(previous)
+            if self.buffered_size <= self.MAX_BUFFERED_SIZE:
+                return []
+            missing_size = self.future_offsets[0] - self.next_offset
+            logger.warning("Skipping %d missing bytes, after buffering %d bytes", missing_size, self.buffered_size)
+            self.skipped_size += missing_size
+            self.next_offset = self.future_offsets[0]
+            payloads = []
+        else:
+            payloads = [data[self.next_offset - start:] if start < self.next_offset else data]
+            self.next_offset = end
+
+        # Unstack the segments which are now in order
+        while self.future_offsets and self.future_offsets[0] <= self.next_offset:
+            seg_start = heapq.heappop(self.future_offsets)
+            seg_data = self.future_segments.pop(seg_start)
+            self.buffered_size -= len(seg_data)
+            seg_end = seg_start + len(seg_data)
+            if seg_end > self.next_offset:
+                logger.debug("Found out-of-order segment at offset %d", seg_start)
+                payloads.append(seg_data[self.next_offset - seg_start:])
+                self.next_offset = seg_end
+        return payloads
+
+    def got_fin(self, seq, data_size):
+        """Got a FIN flag on a segment"""
+        self.fin_offset = self.seq_to_offset(seq) + data_size
+
+    def is_finished(self):
+        """Tell whether all the data until a FIN flag has been reassembled"""
+        return self.fin_offset is not None and self.next_offset >= self.fin_offset
+
+    def pending_size(self):
+        """Get the number of bytes which have been received but not parsed"""
+        return len(self.unparsed) + self.buffered_size
+
+
 class TcpStream:
-    """Hold information about a TCP stream"""
+    """Hold information about a TCP stream
+
+    Subclasses can override process_packets in order to parse the data of a
+    protocol. It is called with the reassembled data in order, and returns
+    the data which needs more bytes to be parsed. When this data is the
+    bytearray it was called with, the next payload is appended to it without
+    copying the previous bytes.
+    """
 
     def __init__(self, ipsrc, ipdst, tcpsrc, tcpdst):
         self.ipsrc = ipsrc
         self.ipdst = ipdst
         self.tcpsrc = tcpsrc
         self.tcpdst = tcpdst
-        self.last_tcpseq_c2s = None
-        self.last_tcpseq_s2c = None
-        self.current_data_c2s = b''
-        self.current_data_s2c = b''
-        self.expected_tcpseq_c2s = None
-        self.expected_tcpseq_s2c = None  # Server2Client may be fragmented
-        self.future_paquets_s2c = []
+        self.got_synack_packet = False
+        self.buffer_c2s = TcpReassemblyBuffer()
+        self.buffer_s2c = TcpReassemblyBuffer()
+        self.first_time = None
+        self.last_time = None
         self.pkt_idx = 0
 
         logger.info("Initiating TCP conn to %s:%s", ipdst, tcpdst)
 
+    def got_syn(self, seq_c2s):
+        """Got the initial sequence number of the client from a SYN packet"""
+        if self.buffer_c2s.initial_seq is None:
+            self.buffer_c2s.initial_seq = (seq_c2s + 1) & 0xffffffff
+
     def got_synack(self, seq_s2c, ack_c2s):
         """Got sequence numbers from a SYN+ACK packet"""
-        if self.last_tcpseq_s2c is not None:
+        if self.got_synack_packet:
             logger.warning("Got a duplicated TCP SYN+ACK for %s:%d > %s:%d",
                            self.ipsrc, self.tcpsrc, self.ipdst, self.tcpdst)
-        elif self.last_tcpseq_c2s is not None:
+            return
+        self.got_synack_packet = True
+
+        if self.buffer_c2s.next_offset:
             # TCP Fast open
-            if self.last_tcpseq_c2s + 1 == ack_c2s:
+            expected_ack = (self.buffer_c2s.initial_seq + self.buffer_c2s.next_offset) & 0xffffffff
+            if self.buffer_c2s.initial_seq == ack_c2s:
                 logger.warning("Rejected TCP SYN+ACK with TCP Fast Open for %s:%d > %s:%d",
                                self.ipsrc, self.tcpsrc, self.ipdst, self.tcpdst)
-            else:
+            elif expected_ack != ack_c2s:
                 logger.warning(
-                    "Got an unexpected TCP SYN+ACK with TCP Fast Open for %s:%d > %s:%d: %d + 1 != %d",
-                    self.ipsrc, self.tcpsrc, self.ipdst, self.tcpdst, self.last_tcpseq_c2s, ack_c2s)
+                    "Got an unexpected TCP SYN+ACK with TCP Fast Open for %s:%d > %s:%d: %#x != %#x",
+                    self.ipsrc, self.tcpsrc, self.ipdst, self.tcpdst, expected_ack, ack_c2s)
+        elif self.buffer_c2s.initial_seq != ack_c2s:
+            self.buffer_c2s = TcpReassemblyBuffer(ack_c2s)
 
-        self.last_tcpseq_c2s = ack_c2s
-        self.last_tcpseq_s2c = seq_s2c
-        self.expected_tcpseq_c2s = ack_c2s
-        self.expected_tcpseq_s2c = seq_s2c + 1
+        if self.buffer_s2c.next_offset == 0 and not self.buffer_s2c.future_segments:
+            self.buffer_s2c = TcpReassemblyBuffer((seq_s2c + 1) & 0xffffffff)
 
     def add_payload(self, data, client_to_server, seq):
         """Got a new TCP packet, adding it to the internal buffers"""
         if client_to_server:
-            if self.last_tcpseq_c2s == seq and self.expected_tcpseq_c2s != seq:
-                # Ignore repeated packets
-                return
+            buffer, other_buffer = self.buffer_c2s, self.buffer_s2c
+        else:
+            buffer, other_buffer = self.buffer_s2c, self.buffer_c2s
 
-            if self.current_data_s2c:  # Drop recv bytes when sending
-                logger.warning("Ignoring %d recv bytes", len(self.current_data_s2c))
-                self.current_data_s2c = b''
+        payloads = buffer.add_segment(seq, data)
+        if not payloads:
+            return
 
-            self.last_tcpseq_c2s = seq
-            # print("[>] %d + %d = %d" % (seq, len(data), seq + len(data))); data = b''
-            data = self.process_packets(self.current_data_c2s + data, client_to_server)
-            self.current_data_c2s = data
-        else:
-            if self.last_tcpseq_s2c == seq and self.expected_tcpseq_s2c != seq:
-                # Ignore repeated packets
-                return
+        if other_buffer.unparsed:  # Drop the bytes of the other direction when changing direction
+            logger.warning("Ignoring %d %s bytes",
+                           len(other_buffer.unparsed), 'recv' if client_to_server else 'sent')
+            other_buffer.unparsed = bytearray()
 
-            if self.current_data_c2s:  # Drop sent bytes when receiving
-                logger.warning("Ignoring %d sent bytes", len(self.current_data_s2c))
-                self.current_data_c2s = b''
-
-            if self.expected_tcpseq_s2c != seq:
-                logger.warning("Bad order of packets: %#x vs. %#x", self.expected_tcpseq_s2c, seq)
-                if self.expected_tcpseq_s2c < seq:
-                    # The packet is a future one... keep it
-                    self.future_paquets_s2c.append((seq, data))
-                    return
-
-            self.last_tcpseq_s2c = seq
-            self.expected_tcpseq_s2c = seq + len(data)
-            # print("[TCP<] %#x + %d = %#x" % (seq, len(data), seq + len(data)))
-            data = self.process_packets(self.current_data_s2c + data, client_to_server)
-            self.current_data_s2c = data
-            # Unstack stashed packets
-            if self.future_paquets_s2c:
-                unstashed_packet_idx = None
-                for idx, pkt in enumerate(self.future_paquets_s2c):
-                    if pkt[0] == self.expected_tcpseq_s2c:
-                        unstashed_packet_idx = idx
-                        break
-                if unstashed_packet_idx is not None:
-                    seq, new_data = self.future_paquets_s2c.pop(unstashed_packet_idx)
-                    logger.warning("Found out-of-order now :) %#x, sending %d+%d=%d=%#x bytes",
-                                   seq, len(data), len(new_data),
-                                   len(data) + len(new_data),
-                                   len(data) + len(new_data))
-                    # The data is already in self.current_data_s2c
-                    self.add_payload(new_data, client_to_server, seq)
-                    return
+        for payload in payloads:
+            if buffer.unparsed:
+                buffer.unparsed += payload
+                remaining = self.process_packets(buffer.unparsed, client_to_server)
+            else:
+                remaining = self.process_packets(payload, client_to_server)
+            if remaining is not buffer.unparsed:
+                buffer.unparsed = bytearray(remaining)
+
+    def got_fin(self, client_to_server, seq, data_size):
+        """Got a FIN flag, after data_size bytes of payload"""
+        (self.buffer_c2s if client_to_server else self.buffer_s2c).got_fin(seq, data_size)
+
+    def is_finished(self):
+        """Tell whether both directions have been closed with FIN flags and reassembled"""
+        return self.buffer_c2s.is_finished() and self.buffer_s2c.is_finished()
+
+    def pending_size(self):
+        """Get the number of bytes which have been received but not parsed"""
+        return self.buffer_c2s.pending_size() + self.buffer_s2c.pending_size()
+
+    def close(self, reason='end'):
+        """The stream is no longer followed, because of a FIN or RST flag, a timeout or the end of the capture"""
+        pending_size = self.pending_size()
+        if pending_size:
+            logger.warning("Closing TCP conn to %s:%s (%s) with %d pending bytes",
+                           self.ipdst, self.tcpdst, reason, pending_size)
+        else:
+            logger.debug("Closing TCP conn to %s:%s (%s)", self.ipdst, self.tcpdst, reason)
 
     def process_packets(self, data, client_to_server):
         """Process parts of a packet and return the remaining (unparsed data)"""
@@ -154,6 +297,142 @@ class TcpStream:
         return b''
 
 
+class TcpStreamExporter:
+    """Export the reassembled data of TCP streams, with a JSON index of the flows
+
+    Each direction of a flow is either written to its own file, or appended
+    to a container file (flows.bin) as soon as its data is flushed. In the
+    container, the data of a direction is described by a list of extents
+    [offset, length], as the flows are interleaved. index.json describes the
+    flows, with the location of their data.
+
+    When the streams are sharded across several workers, each worker uses its
+    own exporter, with its own container file and flow identifiers.
+    """
+    INDEX_FILENAME = 'index.json'
+    CONTAINER_FILENAME = 'flows.bin'
+
+    def __init__(self, output_dir, container=False, worker_id=None, workers_count=1):
+        self.output_dir = output_dir
+        os.makedirs(output_dir, exist_ok=True)
+        self.container = None
+        self.container_filename = None
+        if container:
+            if worker_id is None:
+                self.container_filename = self.CONTAINER_FILENAME
+            else:
+                self.container_filename = 'flows-{:02d}.bin'.format(worker_id)
+            self.container = open(os.path.join(output_dir, self.container_filename), 'wb')
+        self.next_flow_id = worker_id or 0
+        self.flow_id_step = workers_count
+        self.flows = []
+
+    def create_stream(self, ipsrc, ipdst, tcpsrc, tcpdst):
+        """Create a TCP stream which exports its data (to be used as stream_factory)"""
+        flow_id = self.next_flow_id
+        self.next_flow_id += self.flow_id_step
+        return ExportedTcpStream(self, flow_id, ipsrc, ipdst, tcpsrc, tcpdst)
+
+    def close_container(self):
+        """Close the container file, after all the flows have been closed"""
+        if self.container is not None:
+            self.container.close()
+            self.container = None
+
+    def close(self):
+        """Write the index of the flows"""
+        self.close_container()
+        write_flows_index(self.output_dir, self.flows)
+
+
+def write_flows_index(output_dir, flows):
+    """Write the JSON index of exported flows"""
+    index_path = os.path.join(output_dir, TcpStreamExporter.INDEX_FILENAME)
+    logger.debug("Writing %s with %d flows", index_path, len(flows))
+    with open(index_path, 'w') as findex:
+        json.dump({
+            'containers': sorted({flow['container'] for flow in flows if 'container' in flow}),
+            'flows': sorted(flows, key=lambda flow: flow['id']),
+        }, findex, indent=2)
+        findex.write('\n')
+
+
+class ExportedTcpStream(TcpStream):
+    """TCP stream which writes its reassembled data to files"""
+    # Size of the data of a direction kept in memory before writing it
+    FLUSH_SIZE = 64 * 1024
+
+    def __init__(self, exporter, flow_id, ipsrc, ipdst, tcpsrc, tcpdst):
+        super().__init__(ipsrc, ipdst, tcpsrc, tcpdst)
+        self.exporter = exporter
+        self.flow_id = flow_id
+        # Direction (client_to_server) -> buffered data, extents in the container and size
+        self.pending_data = {True: bytearray(), False: bytearray()}
+        self.extents = {True: [], False: []}
+        self.output_sizes = {True: 0, False: 0}
+
+    def get_filename(self, client_to_server):
+        """Get the name of the file of a direction"""
+        return 'flow{:06d}.{}'.format(self.flow_id, 'c2s' if client_to_server else 's2c')
+
+    def flush(self, client_to_server):
+        """Write the buffered data of a direction"""
+        data = self.pending_data[client_to_server]
+        if not data:
+            return
+        if self.exporter.container is not None:
+            offset = self.exporter.container.tell()
+            self.exporter.container.write(data)
+            extents = self.extents[client_to_server]
+            if extents and extents[-1][0] + extents[-1][1] == offset:
+                # No other flow wrote data since the previous extent
+                extents[-1][1] += len(data)
+            else:
+                extents.append([offset, len(data)])
+        else:
+            # Open the file only when writing, in order not to use a file descriptor per flow
+            file_path = os.path.join(self.exporter.output_dir, self.get_filename(client_to_server))
+            with open(file_path, 'ab' if self.output_sizes[client_to_server] else 'wb') as fout:
+                fout.write(data)
+        self.output_sizes[client_to_server] += len(data)
+        self.pending_data[client_to_server] = bytearray()
+
+    def process_packets(self, data, client_to_server):
+        self.pending_data[client_to_server] += data
+        if len(self.pending_data[client_to_server]) >= self.FLUSH_SIZE:
+            self.flush(client_to_server)
+        return b''
+
+    def close(self, reason='end'):
+        super().close(reason)
+        flow = {
+            'id': self.flow_id,
+            'src': self.ipsrc,
+            'sport': self.tcpsrc,
+            'dst': self.ipdst,
+            'dport': self.tcpdst,
+            'first_time': self.first_time,
+            'last_time': self.last_time,
+            'close_reason': reason,
+        }
+        if self.exporter.container is not None:
+            flow['container'] = self.exporter.container_filename
+        for client_to_server, buffer in ((True, self.buffer_c2s), (False, self.buffer_s2c)):
+            self.flush(client_to_server)
+            size = self.output_sizes[client_to_server]
+            direction = {
+                'size': size,
+                'skipped': buffer.skipped_size,
+                'lost': buffer.pending_size(),
+            }
+            if self.exporter.container is not None:
+                direction['extents'] = self.extents[client_to_server]
+            elif size:
+                direction['file'] = self.get_filename(client_to_server)
+            flow['c2s' if client_to_server else 's2c'] = direction
+        self.exporter.flows.append(flow)
+
+
 def get_ip_layer(packet):
     """Return the IPv4 or IPv6 layer of a packet, if it exists. Otherwise None"""
     with suppress(IndexError):
@@ -163,50 +442,342 @@ def get_ip_layer(packet):
     return None
 
 
-def analyze_pcap_for_tcp(pcap_file):
-    """Analyze a PCAP file with TCP communications"""
-    tcp_streams = {}
-    for packet in PcapReader(pcap_file):
-        ippkt = get_ip_layer(packet)
-        if ippkt is None or ippkt.proto != 6:  # TCP protocol is 6
-            continue
-        tcppkt = ippkt['TCP']
-
-        # Gather packet metadata
-        ipsrc = ippkt.src
-        ipdst = ippkt.dst
-        tcpsrc = tcppkt.sport
-        tcpdst = tcppkt.dport
+class TcpStreamTracker:
+    """Follow the TCP streams of a capture, from the fields of their segments
+
+    The TCP streams are created by calling stream_factory(ipsrc, ipdst, tcpsrc, tcpdst).
+    """
+
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT, stream_factory=TcpStream):
+        self.idle_timeout = idle_timeout
+        self.stream_factory = stream_factory
+        self.tcp_streams = {}
+        self.last_eviction_time = None
+        self.streams_count = 0
+
+    def evict_idle_streams(self, current_time):
+        """Close and forget the streams which have been idle for too long"""
+        for tcpip_tuple, stream in list(self.tcp_streams.items()):
+            if current_time - stream.last_time > self.idle_timeout:
+                logger.debug("Evicting idle TCP stream %r", tcpip_tuple)
+                stream.close('timeout')
+                del self.tcp_streams[tcpip_tuple]
+
+    def add_segment(self, packet_time, ipsrc, ipdst, tcpsrc, tcpdst, flags, seq, ack, payload_bytes):
+        """Analyze a TCP segment"""
+        # Forget the streams without any packet for some time, to bound memory usage
+        if self.last_eviction_time is None:
+            self.last_eviction_time = packet_time
+        elif self.idle_timeout and packet_time - self.last_eviction_time >= self.idle_timeout / 10.:
+            self.evict_idle_streams(packet_time)
+            self.last_eviction_time = packet_time
 
         # Match the packet with existing streams in tcp_streams
         client_to_server = None
         tcpip_tuple = (ipdst, ipsrc, tcpdst, tcpsrc)
-        if tcpip_tuple in tcp_streams:
+        if tcpip_tuple in self.tcp_streams:
             client_to_server = False
-            if tcppkt.flags.SA:  # SYN=2 + ACK=0x10
-                tcp_streams[tcpip_tuple].got_synack(tcppkt.seq, tcppkt.ack)
+            if flags & TCP_FLAGS_SA == TCP_FLAGS_SA:
+                self.tcp_streams[tcpip_tuple].got_synack(seq, ack)
         else:
             tcpip_tuple = (ipsrc, ipdst, tcpsrc, tcpdst)
-            if tcpip_tuple in tcp_streams:
+            if tcpip_tuple in self.tcp_streams:
                 client_to_server = True
-            elif tcppkt.flags.S:  # SYN
-                tcp_streams[tcpip_tuple] = TcpStream(ipsrc, ipdst, tcpsrc, tcpdst)
+            elif flags & TCP_FLAG_SYN:
+                self.tcp_streams[tcpip_tuple] = self.stream_factory(ipsrc, ipdst, tcpsrc, tcpdst)
+                self.streams_count += 1
                 client_to_server = True
             else:
                 logger.debug("Ignoring non-SYN first TCP packet %r", tcpip_tuple)
-                continue
+                return
 
         assert client_to_server is not None  # Ensure that the direction has been found
+        stream = self.tcp_streams[tcpip_tuple]
+        if stream.first_time is None:
+            stream.first_time = packet_time
+        stream.last_time = packet_time
 
-        # Ignore Ethernet padding that might slips into the TCP packet
-        if isinstance(tcppkt.payload, Padding):
-            continue
+        # The SYN flag uses a sequence number, before the data (with TCP Fast Open)
+        if flags & TCP_FLAG_SYN:
+            if client_to_server:
+                stream.got_syn(seq)
+            seq = (seq + 1) & 0xffffffff
 
-        payload_bytes = bytes(tcppkt.payload)
         if payload_bytes:
-            tcp_streams[tcpip_tuple].add_payload(payload_bytes, client_to_server, tcppkt.seq)
+            stream.add_payload(payload_bytes, client_to_server, seq)
+
+        # Close the stream when it is reset, or when both directions are finished
+        if flags & TCP_FLAG_RST:
+            stream.close('rst')
+            del self.tcp_streams[tcpip_tuple]
+            return
+        if flags & TCP_FLAG_FIN:
+            stream.got_fin(client_to_server, seq, len(payload_bytes))
+        if stream.is_finished():
+            stream.close('fin')
+            del self.tcp_streams[tcpip_tuple]
+
+    def close(self):
+        """Close all the streams"""
+        for stream in self.tcp_streams.values():
+            stream.close()
+        self.tcp_streams = {}
+
+
+def analyze_pcap_for_tcp(pcap_file, idle_timeout=DEFAULT_IDLE_TIMEOUT, stream_factory=TcpStream):
+    """Analyze a PCAP file with TCP communications
+
+    The TCP streams are created by calling stream_factory(ipsrc, ipdst, tcpsrc, tcpdst).
+    """
+    tracker = TcpStreamTracker(idle_timeout, stream_factory)
+    for packet in PcapReader(pcap_file):
+        ippkt = get_ip_layer(packet)
+        if ippkt is None or (ippkt.proto if ippkt.version == 4 else ippkt.nh) != 6:  # TCP protocol is 6
+            continue
+        tcppkt = ippkt['TCP']
+
+        # Ignore Ethernet padding that might slips into the TCP packet
+        payload_bytes = b'' if isinstance(tcppkt.payload, Padding) else bytes(tcppkt.payload)
+        tracker.add_segment(float(packet.time), ippkt.src, ippkt.dst, tcppkt.sport, tcppkt.dport,
+                            int(tcppkt.flags), tcppkt.seq, tcppkt.ack, payload_bytes)
+
+    tracker.close()
+    logger.debug("Analyzed %d TCP streams", tracker.streams_count)
+
+
+def iter_raw_tcp_segments(pcap_file):
+    """Read the TCP segments of a pcap file without dissecting them with scapy
+
+    Yield the arguments of TcpStreamTracker.add_segment for the TCP segments
+    over IPv4 and IPv6 (with extension headers), captured on Ethernet (with
+    VLAN tags), Linux cooked capture or raw IP links. IP fragments are
+    ignored. When the IP length is zero or larger than the captured data, as
+    with segmentation offload, the payload ends with the frame.
+    """
+    with open(pcap_file, 'rb') as fcap:
+        endianness, time_divisor = PCAP_MAGIC[fcap.read(4)]
+        linktype = struct.unpack(endianness + 'I', fcap.read(20)[16:20])[0]
+        record_header = struct.Struct(endianness + 'IIII')
+        while True:
+            header = fcap.read(16)
+            if len(header) < 16:
+                return
+            ts_sec, ts_frac, incl_len, _ = record_header.unpack(header)
+            data = fcap.read(incl_len)
+
+            # Find the IP header
+            if linktype == 1:  # Ethernet
+                if len(data) < 14:
+                    continue
+                ip_offset = 14
+                ether_type = struct.unpack_from('>H', data, 12)[0]
+                while ether_type in (0x8100, 0x88a8) and len(data) >= ip_offset + 4:  # VLAN
+                    ether_type = struct.unpack_from('>H', data, ip_offset + 2)[0]
+                    ip_offset += 4
+                if ether_type not in (0x800, 0x86dd):
+                    continue
+            elif linktype == 113:  # Linux cooked capture
+                ip_offset = 16
+            elif linktype == 276:  # Linux cooked capture v2
+                ip_offset = 20
+            else:  # Raw IP
+                ip_offset = 0
+
+            if len(data) < ip_offset + 20:
+                continue
+            ip_version = data[ip_offset] >> 4
+            if ip_version == 4:
+                ihl = (data[ip_offset] & 0xf) * 4
+                total_len, flags_frag, ip_proto = struct.unpack_from('>xxHxxHxB', data, ip_offset)
+                if ip_proto != 6 or flags_frag & 0x3fff or ihl < 20:
+                    continue
+                ipsrc = socket.inet_ntoa(data[ip_offset + 12:ip_offset + 16])
+                ipdst = socket.inet_ntoa(data[ip_offset + 16:ip_offset + 20])
+                tcp_offset = ip_offset + ihl
+                ip_end = ip_offset + total_len
+            elif ip_version == 6:
+                if len(data) < ip_offset + 40:
+                    continue
+                ipsrc = socket.inet_ntop(socket.AF_INET6, data[ip_offset + 8:ip_offset + 24])
+                ipdst = socket.inet_ntop(socket.AF_INET6, data[ip_offset + 24:ip_offset + 40])
+                total_len = struct.unpack_from('>H', data, ip_offset + 4)[0]
+                ip_end = ip_offset + 40 + total_len
+                # Skip the extension headers
+                next_header = data[ip_offset + 6]
+                tcp_offset = ip_offset + 40
+                while next_header != 6 and len(data) >= tcp_offset + 8:
+                    if next_header in IPV6_GENERIC_EXTENSION_HEADERS:
+                        header_len = (data[tcp_offset + 1] + 1) * 8
+                    elif next_header == 44:  # Fragment
+                        if struct.unpack_from('>H', data, tcp_offset + 2)[0] & 0xfff9:
+                            break
+                        header_len = 8
+                    elif next_header == 51:  # Authentication Header
+                        header_len = (data[tcp_offset + 1] + 2) * 4
+                    else:
+                        break
+                    next_header = data[tcp_offset]
+                    tcp_offset += header_len
+                if next_header != 6:
+                    continue
+            else:
+                continue
 
-    logger.debug("Analyzed %d TCP streams", len(tcp_streams))
+            if total_len == 0 or ip_end > len(data):
+                ip_end = len(data)
+            if len(data) < tcp_offset + 20:
+                continue
+            tcpsrc, tcpdst, seq, ack, data_offset, flags = struct.unpack_from('>HHIIBB', data, tcp_offset)
+            payload = data[tcp_offset + (data_offset >> 4) * 4:ip_end]
+            yield (ts_sec + ts_frac / time_divisor, ipsrc, ipdst, tcpsrc, tcpdst, flags, seq, ack, payload)
+
+
+def get_raw_pcap_linktype(pcap_file):
+    """Get the link type of a pcap file which iter_raw_tcp_segments can read, or None"""
+    with open(pcap_file, 'rb') as fcap:
+        header = fcap.read(24)
+    if len(header) < 24 or header[:4] not in PCAP_MAGIC:
+        return None
+    linktype = struct.unpack(PCAP_MAGIC[header[:4]][0] + 'I', header[20:24])[0]
+    return linktype if linktype in RAW_LINKTYPES else None
+
+
+def shard_worker(worker_id, workers_count, segments_queue, results_queue, idle_timeout, output_dir, container,
+                 debug):
+    """Reassemble the TCP streams of a shard, in a worker process
+
+    The result is a tuple (worker_id, error, streams_count, flows), where error
+    is the traceback of the exception which stopped the worker, or None.
+    """
+    setup_logging(debug)
+    try:
+        exporter = None
+        stream_factory = TcpStream
+        if output_dir:
+            exporter = TcpStreamExporter(output_dir, container, worker_id, workers_count)
+            stream_factory = exporter.create_stream
+
+        tracker = TcpStreamTracker(idle_timeout, stream_factory)
+        streams_count = 0
+        while True:
+            segments = segments_queue.get()
+            if segments is None:
+                break
+            if not segments:
+                # End of a capture file
+                tracker.close()
+                streams_count += tracker.streams_count
+                tracker = TcpStreamTracker(idle_timeout, stream_factory)
+                continue
+            for segment in segments:
+                tracker.add_segment(*segment)
+        tracker.close()
+        streams_count += tracker.streams_count
+
+        if exporter is not None:
+            exporter.close_container()
+    except Exception:
+        # Report the error to the main process, which may be waiting to send segments to this worker
+        results_queue.put((worker_id, traceback.format_exc(), 0, []))
+        raise
+    results_queue.put((worker_id, None, streams_count, exporter.flows if exporter is not None else []))
+
+
+def analyze_pcaps_sharded(pcap_files, jobs, idle_timeout=DEFAULT_IDLE_TIMEOUT, output_dir=None, container=False,
+                          debug=False):
+    """Reassemble the TCP streams of pcap files in several worker processes
+
+    The segments are read without scapy, and dispatched to the workers using
+    their IP addresses and ports, so that both directions of a stream go to
+    the same worker. Return the list of exported flows.
+    """
+    segments_queues = [multiprocessing.Queue(maxsize=64) for _ in range(jobs)]
+    results_queue = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(
+            target=shard_worker,
+            args=(worker_id, jobs, segments_queues[worker_id], results_queue, idle_timeout, output_dir, container,
+                  debug))
+        for worker_id in range(jobs)
+    ]
+    for worker in workers:
+        worker.start()
+
+    def check_workers():
+        """Fail if a worker process stopped with an error"""
+        for worker_id, worker in enumerate(workers):
+            if worker.exitcode:
+                error = "exit code {}".format(worker.exitcode)
+                # Find the error reported by the worker, as the other results are not needed anymore
+                with suppress(queue.Empty):
+                    while True:
+                        reported_id, reported_error, _, _ = results_queue.get(timeout=1)
+                        if reported_id == worker_id and reported_error is not None:
+                            error = reported_error
+                            break
+                raise RuntimeError("Worker process {} stopped: {}".format(worker_id, error))
+
+    def send_segments(worker_id, segments):
+        """Send segments to a worker, without blocking forever if it stopped"""
+        while True:
+            try:
+                segments_queues[worker_id].put(segments, timeout=1)
+                return
+            except queue.Full:
+                check_workers()
+
+    try:
+        for pcap_file in pcap_files:
+            logger.debug("Reading %s", pcap_file)
+            batches = [[] for _ in range(jobs)]
+            for segment in iter_raw_tcp_segments(pcap_file):
+                endpoint1 = (segment[1], segment[3])
+                endpoint2 = (segment[2], segment[4])
+                worker_id = hash((endpoint1, endpoint2) if endpoint1 < endpoint2 else (endpoint2, endpoint1)) % jobs
+                batch = batches[worker_id]
+                batch.append(segment)
+                if len(batch) >= SHARD_BATCH_SIZE:
+                    send_segments(worker_id, batch)
+                    batches[worker_id] = []
+            for worker_id, batch in enumerate(batches):
+                if batch:
+                    send_segments(worker_id, batch)
+                send_segments(worker_id, [])
+        for worker_id in range(jobs):
+            send_segments(worker_id, None)
+
+        flows = []
+        streams_count = 0
+        for _ in range(jobs):
+            while True:
+                try:
+                    worker_id, error, worker_streams_count, worker_flows = results_queue.get(timeout=1)
+                    break
+                except queue.Empty:
+                    check_workers()
+            if error is not None:
+                raise RuntimeError("Worker process {} stopped: {}".format(worker_id, error))
+            streams_count += worker_streams_count
+            flows += worker_flows
+        for worker in workers:
+            worker.join()
+    except BaseException:
+        # Do not wait at exit for the segments which stopped workers will never receive
+        for segments_queue in segments_queues:
+            segments_queue.cancel_join_thread()
+        raise
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+    logger.debug("Analyzed %d TCP streams with %d workers", streams_count, jobs)
+    return flows
+
+
+def setup_logging(debug=False):
+    """Configure the logging messages, in the main process and in workers"""
+    logging.basicConfig(format='[%(levelname)s] %(message)s',
+                        level=logging.DEBUG if debug else logging.INFO)
 
 
 def main(argv=None):
@@ -215,13 +786,45 @@ def main(argv=None):
                         help="network capture files to parse")
     parser.add_argument('-d', '--debug', action='store_true',
                         help="show debug messages")
+    parser.add_argument('-t', '--idle-timeout', metavar='SECONDS', type=float, default=DEFAULT_IDLE_TIMEOUT,
+                        help="forget TCP streams idle for this duration (0 to keep them, default: %(default)s)")
+    parser.add_argument('-o', '--output-dir', metavar='DIRECTORY', type=str,
+                        help="export the data of the TCP streams to files in this directory, with an index")
+    parser.add_argument('-C', '--container', action='store_true',
+                        help="export the data of all the TCP streams into a single file, with offsets in the index")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="number of worker processes reassembling the TCP streams of pcap files")
     args = parser.parse_args(argv)
 
-    logging.basicConfig(format='[%(levelname)s] %(message)s',
-                        level=logging.DEBUG if args.debug else logging.INFO)
+    setup_logging(args.debug)
+
+    if args.container and not args.output_dir:
+        parser.error("--container requires an output directory")
+    if args.jobs < 1:
+        parser.error("the number of jobs needs to be positive")
+
+    if args.jobs > 1:
+        for pcap_file_path in args.file:
+            if get_raw_pcap_linktype(pcap_file_path) is None:
+                parser.error("{} is not a pcap file with a supported link type, which is required by --jobs "
+                             "(it can be converted with: editcap -F pcap)".format(pcap_file_path))
+        flows = analyze_pcaps_sharded(args.file, args.jobs, args.idle_timeout, args.output_dir, args.container,
+                                      args.debug)
+        if args.output_dir:
+            write_flows_index(args.output_dir, flows)
+        return
+
+    exporter = None
+    stream_factory = TcpStream
+    if args.output_dir:
+        exporter = TcpStreamExporter(args.output_dir, container=args.container)
+        stream_factory = exporter.create_stream
 
     for pcap_file_path in args.file:
-        analyze_pcap_for_tcp(pcap_file_path)
+        analyze_pcap_for_tcp(pcap_file_path, idle_timeout=args.idle_timeout, stream_factory=stream_factory)
+
+    if exporter is not None:
+        exporter.close()
 
 
 if __name__ == '__main__':
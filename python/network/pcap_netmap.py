@@ -34,28 +34,48 @@ traffic (HTTP, HTTPS, SSH), the following command can be used:
 
     tshark -ni any -w my_capture.pcap -f 'not tcp port 80 and not tcp port 443 and not tcp port 22'
 
+When such common traffic has been captured anyway, option --prefilter makes the
+analysis much faster by reading the packets without scapy and only dissecting
+those which may carry interesting information (ARP, DHCP, DNS, TLS Client
+Hello, etc.). The speed-up can be measured with --benchmark-prefilter.
+
+In order to update a map regularly, option --checkpoint keeps the state of the
+analysis in a file, with the capture files which have already been analyzed.
+Only the new files and the packets appended to growing pcap files are then
+analyzed:
+
+    pcap_netmap.py --checkpoint netmap.state -g netmap.svg captures/*.pcap
+
 @author: Nicolas Iooss
 @license: MIT
 """
 import argparse
 import binascii
 import collections
+import functools
+import hashlib
 import itertools
 import ipaddress
 import json
 import logging
+import multiprocessing
 import os.path
+import pickle
 import re
 import socket
+import struct
 import subprocess
 import sys
+import tempfile
+import time
 
-from scapy.all import ARP, BOOTP, CookedLinux, DHCP, DNS, Dot1Q, Dot3, Ether, \
-    ICMPv6ND_NA, ICMPv6ND_RA, IP, IPv6, NBTDatagram, PcapReader, Raw, STP, UDP
+from scapy.all import ARP, BOOTP, CookedLinux, DHCP, DNS, DNSQR, DNSRR, Dot1Q, Dot3, Ether, \
+    ICMPv6ND_NA, ICMPv6ND_RA, IP, IPv6, NBTDatagram, PcapReader, Raw, STP, TCP, UDP
 from scapy.all import conf as scapy_conf
+from scapy.data import MTU
 
 try:
-    from scapy.layers.tls.all import TLS_Ext_ServerName
+    from scapy.layers.tls.all import ServerName, TLS, TLSClientHello, TLS_Ext_ServerName
     HAVE_SCAPY_TLS = True
 except ImportError:
     # TLS support has been introduced in scapy 2.4.0
@@ -66,6 +86,35 @@ except ImportError:
 logger = logging.getLogger(__name__)
 
 
+def get_scapy_bound_ports(layer, payload_class=None):
+    """Get the TCP or UDP ports for which scapy dissects the payload of a packet
+
+    If payload_class is given, only consider the payloads of this class.
+    Return None if scapy also binds a payload using something else than ports.
+    """
+    ports = set()
+    for fields, cls in layer.payload_guess:
+        if payload_class is not None and not issubclass(cls, payload_class):
+            continue
+        bound_ports = [value for key, value in fields.items() if key in ('sport', 'dport')]
+        if not bound_ports:
+            return None
+        ports.update(bound_ports)
+    return frozenset(ports)
+
+
+# Ports of the UDP and TCP packets which may carry interesting data, according
+# to scapy's bindings. TLS payloads on TCP are only interesting when they begin
+# with a handshake record (which may contain a Server Name Indication)
+UDP_DISSECTED_PORTS = get_scapy_bound_ports(UDP)
+TLS_DISSECTED_PORTS = get_scapy_bound_ports(TCP, TLS) if HAVE_SCAPY_TLS else frozenset()
+TCP_DISSECTED_PORTS = get_scapy_bound_ports(TCP)
+if TCP_DISSECTED_PORTS is not None and TLS_DISSECTED_PORTS:
+    TCP_DISSECTED_PORTS = TCP_DISSECTED_PORTS.difference(
+        port for port in TLS_DISSECTED_PORTS
+        if not any(port in fields.values() and not issubclass(cls, TLS) for fields, cls in TCP.payload_guess))
+
+
 GRAPH_COLORS = {
     'hwmanuf': 'cyan',
     'hwaddr': 'lightblue',
@@ -157,9 +206,11 @@ def get_mac_manuf_desc(mac_addr, default='?'):
 
 
 class GraphvizSafeLabel(str):
+    CONTROL_CHARS_RE = re.compile(r'[\x00-\x1f]')
+
     @classmethod
     def escape(cls, value):
-        return cls((repr(value) if any(ord(c) < 32 for c in value) else value)
+        return cls((repr(value) if cls.CONTROL_CHARS_RE.search(value) else value)
                    .replace('\\', '\\\\')
                    .replace('{', '\\{')
                    .replace('}', '\\}')
@@ -174,13 +225,163 @@ def graphviz_records(records):
     return GraphvizSafeLabel(' | '.join(GraphvizSafeLabel.escape(r) for r in records))
 
 
-class Graph(object):
-    """Graph of node and directed edges"""
+class IpRadixTreeNode(object):
+    """Node of a radix tree, for a prefix which may be associated with a value"""
+    __slots__ = ('key', 'prefixlen', 'value', 'has_value', 'children')
+
+    def __init__(self, key, prefixlen):
+        self.key = key
+        self.prefixlen = prefixlen
+        self.value = None
+        self.has_value = False
+        self.children = [None, None]
+
+
+class IpRadixTree(object):
+    """Radix tree (path-compressed binary trie) of IP prefixes of a given size
+
+    The prefixes are given as integers with their length in bits, and the
+    lookup of an address walks through the prefixes which contain it, from the
+    least specific to the most specific one (longest prefix match).
+    """
+    def __init__(self, max_prefixlen):
+        self.max_prefixlen = max_prefixlen
+        self.root = None
+
+    def get_bit(self, key, position):
+        """Get the bit of the key at the given position, from the most significant bit"""
+        return (key >> (self.max_prefixlen - 1 - position)) & 1
+
+    def common_prefixlen(self, key1, key2, max_len):
+        """Compute the length of the common prefix of two keys, up to max_len bits"""
+        diff = (key1 ^ key2) >> (self.max_prefixlen - max_len)
+        return max_len - diff.bit_length()
+
+    def insert(self, key, prefixlen, value):
+        """Associate a value to a prefix, replacing any previous value"""
+        parent = None
+        parent_bit = 0
+        node = self.root
+        while node is not None:
+            common_len = self.common_prefixlen(key, node.key, min(prefixlen, node.prefixlen))
+            if common_len < node.prefixlen:
+                break
+            if node.prefixlen == prefixlen:
+                node.value = value
+                node.has_value = True
+                return
+            parent = node
+            parent_bit = self.get_bit(key, node.prefixlen)
+            node = node.children[parent_bit]
+
+        new_node = IpRadixTreeNode(key, prefixlen)
+        new_node.value = value
+        new_node.has_value = True
+        if node is not None:
+            if common_len == prefixlen:
+                # The new prefix contains the one of the current node
+                new_node.children[self.get_bit(node.key, prefixlen)] = node
+            else:
+                # Split the current node with a node for the common prefix
+                mask = ((1 << common_len) - 1) << (self.max_prefixlen - common_len)
+                glue_node = IpRadixTreeNode(key & mask, common_len)
+                glue_node.children[self.get_bit(key, common_len)] = new_node
+                glue_node.children[self.get_bit(node.key, common_len)] = node
+                new_node = glue_node
+        if parent is None:
+            self.root = new_node
+        else:
+            parent.children[parent_bit] = new_node
+
+    def remove(self, key, prefixlen):
+        """Remove the value of a prefix, and return whether it existed"""
+        path = []
+        node = self.root
+        while node is not None and node.prefixlen < prefixlen:
+            if self.common_prefixlen(key, node.key, node.prefixlen) < node.prefixlen:
+                return False
+            bit = self.get_bit(key, node.prefixlen)
+            path.append((node, bit))
+            node = node.children[bit]
+        if node is None or node.prefixlen != prefixlen or node.key != key or not node.has_value:
+            return False
+        node.value = None
+        node.has_value = False
+
+        # Remove the nodes which became useless, bottom-up
+        while node is not None and not node.has_value:
+            remaining_children = [child for child in node.children if child is not None]
+            if len(remaining_children) == 2:
+                break
+            replacement = remaining_children[0] if remaining_children else None
+            if not path:
+                self.root = replacement
+                break
+            parent, bit = path.pop()
+            parent.children[bit] = replacement
+            if replacement is not None:
+                break
+            node = parent
+        return True
+
+    def iter_matches(self, key):
+        """Enumerate the values of the prefixes containing the key, from the shortest prefix"""
+        node = self.root
+        while node is not None:
+            if (key ^ node.key) >> (self.max_prefixlen - node.prefixlen):
+                return
+            if node.has_value:
+                yield node.value
+            if node.prefixlen == self.max_prefixlen:
+                return
+            node = node.children[self.get_bit(key, node.prefixlen)]
+
+
+class IpNetworkIndex(object):
+    """Index of values associated with IPv4 and IPv6 network objects, for longest prefix matching"""
     def __init__(self):
-        self.nodes = {}
-        self.edges = {}
+        self.trees = {
+            4: IpRadixTree(32),
+            6: IpRadixTree(128),
+        }
+
+    def add(self, net_obj, value):
+        """Associate a value with an ipaddress network object"""
+        self.trees[net_obj.version].insert(int(net_obj.network_address), net_obj.prefixlen, value)
+
+    def remove(self, net_obj):
+        """Remove the value associated with an ipaddress network object"""
+        return self.trees[net_obj.version].remove(int(net_obj.network_address), net_obj.prefixlen)
+
+    def get_all_matches(self, addr_obj):
+        """Get the values of the networks containing an ipaddress address object, from the largest network"""
+        return list(self.trees[addr_obj.version].iter_matches(int(addr_obj)))
+
+    def get_longest_match(self, addr_obj):
+        """Get the value of the most specific network containing an ipaddress address object, or None"""
+        value = None
+        for value in self.trees[addr_obj.version].iter_matches(int(addr_obj)):
+            pass
+        return value
+
+
+class Graph(object):
+    """Graph of node and directed edges
+
+    The nodes and the edges are kept in insertion order. If a stream is given,
+    the graph is written to it in DOT format while it is built, and close()
+    needs to be called to terminate it.
+    """
+    def __init__(self, stream=None):
+        self.nodes = collections.OrderedDict()
+        self.edges = collections.OrderedDict()
+        self.stream = stream
+        if stream is not None:
+            self.write_dot_header(stream)
         # IP network node -> ipaddress object
         self.ip_networks = {}
+        # Index of the IP network nodes
+        self.ip_networks_index = IpNetworkIndex()
         self.already_added_ipaddr_nodes = set()
 
     def add_node(self, node_type, base_key, value):
@@ -190,6 +391,8 @@ class Graph(object):
             if value is None:
                 value = GraphvizSafeLabel.escape(base_key)
             self.nodes[full_key] = (node_type, value)
+            if self.stream is not None:
+                self.write_dot_node(self.stream, full_key, node_type, value)
         elif value is not None and self.nodes[full_key] != (node_type, value):
             logger.warning("Graph node %r has two values: %r and %r",
                            full_key, self.nodes[full_key], (node_type, value))
@@ -199,6 +402,8 @@ class Graph(object):
         """Add an edge to the graph"""
         if (node1, node2) not in self.edges:
             self.edges[(node1, node2)] = label
+            if self.stream is not None:
+                self.write_dot_edge(self.stream, (node1, node2), label)
         elif self.edges[(node1, node2)] != label:
             logger.warning("Graph label (%s,%s) has two labels: %r and %r",
                            node1, node2, self.edges[(node1, node2)], label)
@@ -218,15 +423,14 @@ class Graph(object):
         # Add the node to a network, if it is a new one
         if ip_addr_node not in self.already_added_ipaddr_nodes:
             self.already_added_ipaddr_nodes.add(ip_addr_node)
-            # Find the possible networks of the given address
+            # Find the possible networks of the given address, from the largest one
             addr_obj = ipaddress.ip_address(unicode_ip_addr(ip_addr))
-            possible_nets = [(node, obj) for node, obj in self.ip_networks.items() if addr_obj in obj]
+            possible_nets = self.ip_networks_index.get_all_matches(addr_obj)
             if possible_nets:
-                possible_nets.sort(key=lambda x: x[1].prefixlen)
-                self.add_edge(possible_nets[-1][0], ip_addr_node, 'member-net')
+                self.add_edge(possible_nets[-1], ip_addr_node, 'member-net')
                 # Add edges between subnets
                 for idx in range(len(possible_nets) - 1):
-                    self.add_edge(possible_nets[idx][0], possible_nets[idx + 1][0], 'subnet')
+                    self.add_edge(possible_nets[idx], possible_nets[idx + 1], 'subnet')
         return ip_addr_node
 
     def add_ip_network(self, net_obj, description):
@@ -235,37 +439,60 @@ class Graph(object):
         if net_node not in self.ip_networks:
             # Record the IP network for IP address edges
             self.ip_networks[net_node] = net_obj
+            self.ip_networks_index.add(net_obj, net_node)
         return net_node
 
-    def dump_dot(self, stream):
-        """Produce a graph in dot format to the given stream"""
+    @staticmethod
+    def write_dot_header(stream):
+        """Write the beginning of a graph in dot format"""
         stream.write('digraph {\n')
         stream.write('    overlap=prism;\n')
         stream.write('    rankdir=LR;\n')
         stream.write('    node [shape=record,style=filled];\n')
 
-        # Dump nodes
-        for key, type_value in sorted(self.nodes.items()):
-            node_type, value = type_value
-            color = GRAPH_COLORS.get(node_type)
-            if not isinstance(value, GraphvizSafeLabel):
-                logger.error("A label has been added without passing through the sanitizer: (%r, %r, %r)",
-                             key, node_type, value)
-                continue
-            stream.write('    "{}" [label="{}"'.format(key, value))
-            if color is not None:
-                stream.write(',fillcolor="{}"'.format(color))
-            stream.write('];\n')
-
-        # Dump edges
-        for key, edge_label in sorted(self.edges.items()):
-            if edge_label in ('member-net', 'subnet'):
-                # Reverse the rank for ip-subnet link
-                stream.write('    "{0[1]}" -> "{0[0]}" [dir="back"];\n'.format(key))
-            else:
-                stream.write('    "{0[0]}" -> "{0[1]}";\n'.format(key))
+    @staticmethod
+    def write_dot_node(stream, key, node_type, value):
+        """Write a node in dot format"""
+        if not isinstance(value, GraphvizSafeLabel):
+            logger.error("A label has been added without passing through the sanitizer: (%r, %r, %r)",
+                         key, node_type, value)
+            return
+        color = GRAPH_COLORS.get(node_type)
+        if color is not None:
+            stream.write('    "{}" [label="{}",fillcolor="{}"];\n'.format(key, value, color))
+        else:
+            stream.write('    "{}" [label="{}"];\n'.format(key, value))
+
+    @staticmethod
+    def write_dot_edge(stream, key, edge_label):
+        """Write an edge in dot format"""
+        if edge_label in ('member-net', 'subnet'):
+            # Reverse the rank for ip-subnet link
+            stream.write('    "{0[1]}" -> "{0[0]}" [dir="back"];\n'.format(key))
+        else:
+            stream.write('    "{0[0]}" -> "{0[1]}";\n'.format(key))
+
+    def dump_dot(self, stream, sort=True):
+        """Produce a graph in dot format to the given stream
+
+        By default, the nodes and the edges are sorted, to produce stable
+        outputs. Otherwise they are written in insertion order, which is faster.
+        """
+        self.write_dot_header(stream)
+        nodes = sorted(self.nodes.items()) if sort else self.nodes.items()
+        for key, type_value in nodes:
+            self.write_dot_node(stream, key, type_value[0], type_value[1])
+        edges = sorted(self.edges.items()) if sort else self.edges.items()
+        for key, edge_label in edges:
+            self.write_dot_edge(stream, key, edge_label)
         stream.write('}\n')
 
+    def close(self):
+        """Terminate the graph which is written to a stream"""
+        if self.stream is not None:
+            self.stream.write('}\n')
+            self.stream = None
+
 
 class HwAddrDatabase(object):
     """Database of hardware addresses (ethernet MAC address, for Media Access Control)"""
@@ -397,8 +624,6 @@ class HwAddrDatabase(object):
                 self.bridges.add(hw_addr)
             ip_addrs = hw_data.get('ip')
             if ip_addrs:
-                if hw_addr not in self.ip_for_hw:
-                    self.ip_for_hw[hw_addr] = set()
                 for ip_addr in ip_addrs:
                     if ip_addr in self.known_ip_addresses:
                         continue
@@ -409,7 +634,11 @@ class HwAddrDatabase(object):
                         self.known_ip_addresses.add(ip_addr)
                         ip_addr = new_ip_addr
                         if ip_addr in self.known_ip_addresses:
-                            return
+                            continue
+                    # Only record the hardware address when it gets an IP
+                    # address, like add_ip_addr does
+                    if hw_addr not in self.ip_for_hw:
+                        self.ip_for_hw[hw_addr] = set()
                     self.ip_for_hw[hw_addr].add(ip_addr)
                     self.known_ip_addresses.add(ip_addr)
             names = hw_data.get('names')
@@ -534,6 +763,8 @@ class IpNetworkDatabase(object):
         self.ipv6_networks = {}
         # CIDR -> name
         self.network_names = {}
+        # Radix trees of the networks, for longest prefix matching
+        self.networks_index = IpNetworkIndex()
 
     def add_network(self, address, name=None, silent=False):
         """Add an IP network"""
@@ -549,11 +780,24 @@ class IpNetworkDatabase(object):
             if not silent:
                 logger.info("Adding network %s (%s)", net_cidr, net_obj.with_netmask)
             networks[net_cidr] = net_obj
+            self.networks_index.add(net_obj, net_obj)
         if name and not self.network_names.get(net_cidr):
             if not silent:
                 logger.info("Adding network name %r for %s", name, net_cidr)
             self.network_names[net_cidr] = name
 
+    def remove_network(self, net_cidr):
+        """Remove an IP network, given in CIDR notation"""
+        for networks in (self.ipv4_networks, self.ipv6_networks):
+            net_obj = networks.pop(net_cidr, None)
+            if net_obj is not None:
+                self.networks_index.remove(net_obj)
+
+    def get_network(self, ip_addr):
+        """Get the most specific known network containing the given IP address, or None"""
+        addr_obj = ipaddress.ip_address(unicode_ip_addr(ip_addr))
+        return self.networks_index.get_longest_match(addr_obj)
+
     def to_dict(self):
         """Export the data as an exportable dict"""
         sorted_ipv4_nets = sorted(
@@ -641,10 +885,8 @@ class AnalysisContext(object):
     def remove_multicast_addresses(self):
         """Remove multicast addresses from the databases"""
         self.hwaddrdb.remove_multicast_addresses()
-        if '224.0.0.0/4' in self.ipnetdb.ipv4_networks:
-            del self.ipnetdb.ipv4_networks['224.0.0.0/4']
-        if 'ff00::/12' in self.ipnetdb.ipv6_networks:
-            del self.ipnetdb.ipv6_networks['ff00::/12']
+        self.ipnetdb.remove_network('224.0.0.0/4')
+        self.ipnetdb.remove_network('ff00::/12')
 
     def remove_non_hw_ip(self):
         """Remove IP addresses which were not seen in any local connections
@@ -658,14 +900,11 @@ class AnalysisContext(object):
 
     def filter_by_known_networks(self):
         """Only keep IP addresses that belong to a network"""
-        known_networks = set(self.ipnetdb.ipv4_networks.values())
-        known_networks.update(self.ipnetdb.ipv6_networks.values())
         logger.info("Filtering IP addresses to only include those which belong to %d known networks",
-                    len(known_networks))
+                    len(self.ipnetdb.ipv4_networks) + len(self.ipnetdb.ipv6_networks))
         for ips in self.hwaddrdb.ip_for_hw.values():
             for ip_addr in list(ips):
-                ip_addr_obj = ipaddress.ip_address(unicode_ip_addr(ip_addr))
-                if all(ip_addr_obj not in net_obj for net_obj in known_networks):
+                if self.ipnetdb.get_network(ip_addr) is None:
                     ips.remove(ip_addr)
                     try:
                         self.hwaddrdb.known_ip_addresses.remove(ip_addr)
@@ -697,6 +936,55 @@ class AnalysisContext(object):
             return
         logger.warning("Unknown packet type %r", pkt)
 
+    def analyze_raw_frame(self, linktype, data):
+        """Analyze a frame read from a capture file, before it is dissected
+
+        Most captured packets are ordinary TCP or UDP packets over Ethernet,
+        which only give their addresses. Extracting these from the raw headers
+        is much faster than dissecting the packets with scapy, which is only
+        used for the packets which may carry more information.
+        """
+        if linktype == 1 and self.analyze_raw_ether_frame(data):
+            return
+        self.analyze_read_packet(dissect_raw_frame(linktype, data))
+
+    def analyze_raw_ether_frame(self, data):
+        """Analyze a raw Ethernet frame, if it contains an uninteresting IP packet
+
+        Return False if the frame needs to be dissected.
+        """
+        if len(data) < 14:
+            return False
+        ether_type = struct.unpack_from('>H', data, 12)[0]
+        if ether_type == 0x800:  # IPv4
+            if len(data) < 34:
+                return False
+            ver_ihl, total_len, flags_frag, ip_proto = struct.unpack_from('>BxHxxHxB', data, 14)
+            ihl = (ver_ihl & 0xf) * 4
+            if ver_ihl >> 4 != 4 or ihl < 20 or total_len < ihl or flags_frag & 0x3fff:
+                # Fragments and invalid headers are left to scapy
+                return False
+            if not is_uninteresting_transport(ip_proto, data[14 + ihl:14 + total_len]):
+                return False
+            hw_src, hw_dst = format_raw_hw_addresses(data)
+            self.hwaddrdb.add_ipv4(socket.inet_ntoa(data[26:30]), hw_src, 'IPv4 packet source')
+            self.hwaddrdb.add_ipv4(socket.inet_ntoa(data[30:34]), hw_dst, 'IPv4 packet destination')
+            return True
+        if ether_type == 0x86dd:  # IPv6
+            if len(data) < 54:
+                return False
+            ver_tc, payload_len, next_header = struct.unpack_from('>BxxxHB', data, 14)
+            if ver_tc >> 4 != 6 or payload_len == 0:
+                # Jumbograms and invalid headers are left to scapy
+                return False
+            if not is_uninteresting_transport(next_header, data[54:54 + payload_len]):
+                return False
+            hw_src, hw_dst = format_raw_hw_addresses(data)
+            self.hwaddrdb.add_ipv6(socket.inet_ntop(socket.AF_INET6, data[22:38]), hw_src, 'IPv6 packet source')
+            self.hwaddrdb.add_ipv6(socket.inet_ntop(socket.AF_INET6, data[38:54]), hw_dst, 'IPv6 packet destination')
+            return True
+        return False
+
     def analyze_ether_packet(self, ethpkt, is_cookedlinux=False):
         """Analyze an Ethernet packet or a Cooked Linux one"""
         base_pkt = ethpkt
@@ -1069,6 +1357,478 @@ class AnalysisContext(object):
         logger.warning("Unknown DNS packet type %r for %r: %r", dns_type, rrname, dns_record)
 
 
+def format_raw_hw_addresses(data):
+    """Format the source and destination addresses of a raw Ethernet frame like scapy does"""
+    hex_hw_addrs = binascii.hexlify(data[:12]).decode('ascii')
+    hw_dst = ':'.join(hex_hw_addrs[i:i + 2] for i in range(0, 12, 2))
+    hw_src = ':'.join(hex_hw_addrs[i:i + 2] for i in range(12, 24, 2))
+    return hw_src, hw_dst
+
+
+def is_uninteresting_transport(ip_proto, payload):
+    """Tell whether the payload of an IP packet is a TCP or UDP packet that scapy would not dissect further"""
+    if ip_proto == 17:  # UDP
+        if len(payload) < 8 or UDP_DISSECTED_PORTS is None:
+            return False
+        sport, dport = struct.unpack_from('>HH', payload)
+        return sport not in UDP_DISSECTED_PORTS and dport not in UDP_DISSECTED_PORTS
+    if ip_proto == 6:  # TCP
+        if len(payload) < 20 or TCP_DISSECTED_PORTS is None:
+            return False
+        sport, dport = struct.unpack_from('>HH', payload)
+        if sport in TCP_DISSECTED_PORTS or dport in TCP_DISSECTED_PORTS:
+            return False
+        if sport in TLS_DISSECTED_PORTS or dport in TLS_DISSECTED_PORTS:
+            # Only dissect TLS handshake records, which contain TLS Client Hello messages
+            data_offset = (struct.unpack_from('>B', payload, 12)[0] >> 4) * 4
+            return data_offset >= 20 and payload[data_offset:data_offset + 1] != b'\x16'
+        return True
+    return False
+
+
+def dissect_raw_frame(linktype, data):
+    """Dissect a raw frame with scapy, like PcapReader does"""
+    try:
+        return scapy_conf.l2types.num2layer[linktype](data)
+    except KeyboardInterrupt:
+        raise
+    except Exception:  # pylint: disable=broad-except
+        return scapy_conf.raw_layer(data)
+
+
+# Byte order of classic pcap files, for each magic number
+PCAP_MAGIC_ENDIANNESS = {
+    b'\xa1\xb2\xc3\xd4': '>',
+    b'\xd4\xc3\xb2\xa1': '<',
+    b'\xa1\xb2\x3c\x4d': '>',  # nanosecond precision
+    b'\x4d\x3c\xb2\xa1': '<',  # nanosecond precision
+}
+
+# Byte order of pcapng sections, for each byte-order magic
+PCAPNG_BOM_ENDIANNESS = {
+    b'\x1a\x2b\x3c\x4d': '>',
+    b'\x4d\x3c\x2b\x1a': '<',
+}
+
+
+def split_capture_file(filepath, chunk_size):
+    """Split a capture file in chunks of about chunk_size bytes
+
+    Return a list of (filepath, start_offset, end_offset) describing packet
+    records. Only uncompressed classic pcap files can be split, by walking
+    through the record headers. Other files (like pcapng ones) are returned as
+    a single chunk (filepath, None, None).
+    """
+    file_size = os.path.getsize(filepath)
+    with open(filepath, 'rb') as fpcap:
+        endianness = PCAP_MAGIC_ENDIANNESS.get(fpcap.read(4))
+        if endianness is None or not chunk_size or file_size <= chunk_size:
+            return [(filepath, None, None)]
+
+        chunks = []
+        chunk_start = offset = 24  # Size of the global header
+        while offset + 16 <= file_size:
+            if offset - chunk_start >= chunk_size:
+                chunks.append((filepath, chunk_start, offset))
+                chunk_start = offset
+            fpcap.seek(offset + 8)
+            incl_len = struct.unpack(endianness + 'I', fpcap.read(4))[0]
+            offset += 16 + incl_len
+        chunks.append((filepath, chunk_start, file_size))
+    return chunks
+
+
+def split_pcap_records(filepath, start_offset, chunk_size):
+    """Split the complete records of a pcap file which follow start_offset in chunks
+
+    Return the list of chunks (filepath, start_offset, end_offset) and the
+    offset after the last complete record. The last record of a file which is
+    being written may be incomplete, and is then left for a later analysis.
+    """
+    file_size = os.path.getsize(filepath)
+    chunks = []
+    with open(filepath, 'rb') as fpcap:
+        endianness = PCAP_MAGIC_ENDIANNESS[fpcap.read(4)]
+        chunk_start = offset = max(start_offset, 24)
+        while offset + 16 <= file_size:
+            fpcap.seek(offset + 8)
+            incl_len = struct.unpack(endianness + 'I', fpcap.read(4))[0]
+            if offset + 16 + incl_len > file_size:
+                break
+            if chunk_size and offset - chunk_start >= chunk_size:
+                chunks.append((filepath, chunk_start, offset))
+                chunk_start = offset
+            offset += 16 + incl_len
+    if offset > chunk_start:
+        chunks.append((filepath, chunk_start, offset))
+    return chunks, offset
+
+
+class AnalysisCheckpoint(object):
+    """State of an incremental analysis: the analysis context and the files folded into it
+
+    Each capture file is identified by its path, size, modification time and
+    the hash of its first bytes. Files which did not change are skipped, and
+    only the new records which were appended to a pcap file are analyzed.
+    """
+    VERSION = 1
+    HEAD_HASH_SIZE = 1024 * 1024
+
+    def __init__(self):
+        self.context = AnalysisContext()
+        # Absolute path -> dict describing the analyzed content
+        self.files = {}
+
+    @classmethod
+    def load(cls, path):
+        """Load a checkpoint file, or create a new checkpoint if it does not exist"""
+        if not os.path.exists(path):
+            logger.debug("Creating checkpoint %s", path)
+            return cls()
+        logger.debug("Loading checkpoint %s", path)
+        with open(path, 'rb') as fckpt:
+            data = pickle.load(fckpt)
+        if data.get('version') != cls.VERSION:
+            raise ValueError("Unsupported checkpoint version in {}".format(path))
+        checkpoint = cls()
+        checkpoint.context = data['context']
+        checkpoint.files = data['files']
+        return checkpoint
+
+    def save(self, path):
+        """Save the checkpoint into a file, atomically"""
+        logger.debug("Writing checkpoint %s", path)
+        data = {
+            'version': self.VERSION,
+            'files': self.files,
+            'context': self.context,
+        }
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fckpt:
+            pickle.dump(data, fckpt, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def hash_head(cls, filepath, size):
+        """Compute the SHA256 digest of the first bytes of a file"""
+        with open(filepath, 'rb') as fcap:
+            return hashlib.sha256(fcap.read(size)).hexdigest()
+
+    def plan_file(self, filepath, chunk_size=0):
+        """Find the chunks of a capture file which have not been analyzed yet
+
+        Return the list of chunks and the new state of the file, which needs to
+        be recorded with set_file_state once the chunks are analyzed.
+        """
+        abs_path = os.path.abspath(filepath)
+        file_stat = os.stat(abs_path)
+        old_state = self.files.get(abs_path)
+        if old_state and old_state['size'] == file_stat.st_size and old_state['mtime'] == file_stat.st_mtime:
+            logger.debug("Skipping %s, which has already been analyzed", filepath)
+            return [], None
+
+        start_offset = None
+        if old_state:
+            if (old_state['size'] <= file_stat.st_size and
+                    self.hash_head(abs_path, old_state['head_size']) == old_state['head_sha256']):
+                start_offset = old_state['offset']
+                if start_offset is None:
+                    logger.info("%s changed and cannot be resumed, analyzing it again", filepath)
+            else:
+                logger.warning("%s has been modified, analyzing it again", filepath)
+
+        head_size = min(file_stat.st_size, self.HEAD_HASH_SIZE)
+        new_state = {
+            'size': file_stat.st_size,
+            'mtime': file_stat.st_mtime,
+            'head_size': head_size,
+            'head_sha256': self.hash_head(abs_path, head_size),
+            'offset': None,
+        }
+        with open(abs_path, 'rb') as fcap:
+            is_pcap = fcap.read(4) in PCAP_MAGIC_ENDIANNESS
+        if is_pcap:
+            chunks, new_state['offset'] = split_pcap_records(filepath, start_offset or 0, chunk_size)
+            if start_offset:
+                logger.debug("Analyzing %s from offset %d", filepath, start_offset)
+        else:
+            # Compressed and pcapng files are analyzed as a whole
+            chunks = [(filepath, None, None)]
+        return chunks, new_state
+
+    def set_file_state(self, filepath, state):
+        """Record that a capture file has been analyzed"""
+        if state is not None:
+            self.files[os.path.abspath(filepath)] = state
+
+
+def iter_capture_packets(filepath, start_offset=None, end_offset=None):
+    """Read the packets of a capture file, or of a chunk of a pcap file"""
+    reader = PcapReader(filepath)  # pylint: disable=no-value-for-parameter
+    try:
+        if start_offset is None:
+            for pkt in reader:
+                yield pkt
+            return
+
+        # Use the reader to dissect the packets the same way as when reading
+        # the whole file
+        reader.f.seek(start_offset)
+        while reader.f.tell() < end_offset:
+            try:
+                yield reader.read_packet()
+            except EOFError:
+                break
+    finally:
+        reader.close()
+
+
+def iter_raw_pcap_frames(fcap, endianness, start_offset=None, end_offset=None):
+    """Read the (link type, frame data) records of a classic pcap file"""
+    linktype = struct.unpack(endianness + 'I', fcap.read(20)[16:20])[0]
+    offset = 24
+    if start_offset is not None:
+        fcap.seek(start_offset)
+        offset = start_offset
+    record_header = struct.Struct(endianness + 'IIII')
+    while end_offset is None or offset < end_offset:
+        header = fcap.read(16)
+        if len(header) < 16:
+            return
+        incl_len = record_header.unpack(header)[2]
+        data = fcap.read(incl_len)
+        offset += 16 + incl_len
+        yield linktype, data[:MTU]
+
+
+def iter_raw_pcapng_frames(fcap):
+    """Read the (link type, frame data) blocks of a pcapng file"""
+    endianness = None
+    interfaces = []
+    while True:
+        block_header = fcap.read(8)
+        if len(block_header) < 8:
+            return
+        if block_header[:4] == b'\x0a\x0d\x0d\x0a':  # Section Header Block
+            endianness = PCAPNG_BOM_ENDIANNESS.get(fcap.read(4))
+            if endianness is None:
+                logger.warning("Invalid pcapng section header in %s", fcap.name)
+                return
+            block_len = struct.unpack(endianness + 'I', block_header[4:])[0]
+            fcap.seek(block_len - 12, os.SEEK_CUR)
+            interfaces = []
+            continue
+        if endianness is None:
+            return
+        block_type, block_len = struct.unpack(endianness + 'II', block_header)
+        if block_len < 12:
+            logger.warning("Invalid pcapng block length in %s", fcap.name)
+            return
+        block = fcap.read(block_len - 8)
+        if len(block) < block_len - 8:
+            return
+        if block_type == 1:  # Interface Description Block
+            interfaces.append(struct.unpack_from(endianness + 'HxxI', block))
+        elif block_type == 6:  # Enhanced Packet Block
+            intid, caplen = struct.unpack_from(endianness + 'I8xI', block)
+            if intid < len(interfaces):
+                yield interfaces[intid][0], block[20:20 + caplen][:MTU]
+        elif block_type == 3:  # Simple Packet Block
+            if interfaces:
+                caplen = min(struct.unpack_from(endianness + 'I', block)[0], interfaces[0][1])
+                yield interfaces[0][0], block[4:4 + caplen][:MTU]
+        elif block_type == 2:  # (Obsolete) Packet Block
+            intid, caplen = struct.unpack_from(endianness + 'H10xI', block)
+            if intid < len(interfaces):
+                yield interfaces[intid][0], block[20:20 + caplen][:MTU]
+
+
+def iter_raw_capture_frames(filepath, start_offset=None, end_offset=None):
+    """Read the (link type, frame data) records of a capture file, or of a chunk of a pcap file
+
+    Only uncompressed pcap and pcapng files are supported. For other files,
+    nothing is returned and a ValueError is raised.
+    """
+    with open(filepath, 'rb') as fcap:
+        magic = fcap.read(4)
+        endianness = PCAP_MAGIC_ENDIANNESS.get(magic)
+        if endianness is not None:
+            for frame in iter_raw_pcap_frames(fcap, endianness, start_offset, end_offset):
+                yield frame
+        elif magic == b'\x0a\x0d\x0d\x0a' and start_offset is None:
+            fcap.seek(0)
+            for frame in iter_raw_pcapng_frames(fcap):
+                yield frame
+        else:
+            raise ValueError("unsupported capture file format for {}".format(filepath))
+
+
+def is_raw_capture_supported(filepath):
+    """Tell whether iter_raw_capture_frames can read a capture file"""
+    with open(filepath, 'rb') as fcap:
+        magic = fcap.read(4)
+    return magic in PCAP_MAGIC_ENDIANNESS or magic == b'\x0a\x0d\x0d\x0a'
+
+
+def analyze_capture(ctx, filepath, start_offset=None, end_offset=None, prefilter=False):
+    """Analyze a capture file, or a chunk of a pcap file, in the given context
+
+    With prefilter, the frames are read without scapy, which only dissects the
+    ones which may carry interesting information.
+    """
+    if prefilter and is_raw_capture_supported(filepath):
+        for linktype, data in iter_raw_capture_frames(filepath, start_offset, end_offset):
+            ctx.analyze_raw_frame(linktype, data)
+    else:
+        for pkt in iter_capture_packets(filepath, start_offset, end_offset):
+            ctx.analyze_read_packet(pkt)
+
+
+def analyze_capture_chunk(chunk, prefilter=False):
+    """Analyze a chunk of a capture file in a new context, and export its data"""
+    filepath, start_offset, end_offset = chunk
+    if start_offset is None:
+        logger.debug("Reading %s", filepath)
+    else:
+        logger.debug("Reading %s from offset %d to %d", filepath, start_offset, end_offset)
+    ctx = AnalysisContext()
+    analyze_capture(ctx, filepath, start_offset, end_offset, prefilter=prefilter)
+    return ctx.to_dict()
+
+
+def build_benchmark_frames(num_hosts=64):
+    """Build a list of raw Ethernet frames which look like common network traffic
+
+    Most frames are ordinary TCP and UDP packets, and one out of 16 is an ARP
+    request, a DNS response or a TLS Client Hello, which need to be dissected.
+    """
+    common_frames = []
+    interesting_frames = []
+    for host in range(num_hosts):
+        hw_addr = '02:00:00:00:{:02x}:{:02x}'.format(host >> 8, host & 0xff)
+        gateway_hw_addr = '02:00:00:ff:ff:fe'
+        ipv4_addr = '10.{}.{}.{}'.format(host >> 16, (host >> 8) & 0xff, host & 0xff)
+        ipv6_addr = 'fd00::{:x}'.format(host + 1)
+        remote_ipv4 = '198.51.100.{}'.format(host % 250 + 1)
+        eth = Ether(src=hw_addr, dst=gateway_hw_addr)
+        common_frames += [
+            eth / IP(src=ipv4_addr, dst=remote_ipv4) / TCP(sport=40000 + host, dport=443) /
+            (b'\x17\x03\x03' + 1200 * b'x'),
+            eth / IP(src=ipv4_addr, dst=remote_ipv4) / TCP(sport=40000 + host, dport=22) / (500 * b'x'),
+            eth / IP(src=ipv4_addr, dst=remote_ipv4) / TCP(sport=40000 + host, dport=80, flags='A'),
+            eth / IP(src=ipv4_addr, dst=remote_ipv4) / UDP(sport=40000 + host, dport=51820) / (150 * b'x'),
+            eth / IPv6(src=ipv6_addr, dst='2001:db8::1') / TCP(sport=40000 + host, dport=443) / (1000 * b'x'),
+        ]
+        interesting_frames += [
+            Ether(src=hw_addr, dst='ff:ff:ff:ff:ff:ff') / ARP(op=1, hwsrc=hw_addr, psrc=ipv4_addr, pdst='10.0.0.1'),
+            Ether(src=gateway_hw_addr, dst=hw_addr) / IP(src='10.0.0.1', dst=ipv4_addr) / UDP(sport=53, dport=40000) /
+            DNS(qr=1, qd=DNSQR(qname='host{}.example.org'.format(host)),
+                an=DNSRR(rrname='host{}.example.org'.format(host), rdata=remote_ipv4)),
+        ]
+        if HAVE_SCAPY_TLS:
+            interesting_frames.append(
+                eth / IP(src=ipv4_addr, dst=remote_ipv4) / TCP(sport=40000 + host, dport=443) /
+                TLS(msg=[TLSClientHello(ext=[TLS_Ext_ServerName(
+                    servernames=[ServerName(servername='www{}.example.org'.format(host).encode('ascii'))])])]))
+    common_frames = [bytes(frame) for frame in common_frames]
+    interesting_frames = [bytes(frame) for frame in interesting_frames]
+    frames = []
+    for idx in range(max(len(common_frames), len(interesting_frames) * 16)):
+        if idx % 16 == 15:
+            frames.append(interesting_frames[(idx // 16) % len(interesting_frames)])
+        else:
+            frames.append(common_frames[idx % len(common_frames)])
+    return frames
+
+
+def benchmark_prefilter(num_packets):
+    """Compare the analysis of a generated capture file, with and without the prefilter"""
+    frames = build_benchmark_frames()
+    with tempfile.NamedTemporaryFile(prefix='pcap_netmap_bench_', suffix='.pcap') as fcap:
+        fcap.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, MTU, 1))
+        for idx in range(num_packets):
+            frame = frames[idx % len(frames)]
+            fcap.write(struct.pack('<IIII', 1500000000 + idx // 1000, (idx % 1000) * 1000, len(frame), len(frame)))
+            fcap.write(frame)
+        fcap.flush()
+        logger.info("Generated %d packets in %s (%d bytes)", num_packets, fcap.name, fcap.tell())
+
+        results = []
+        for prefilter in (False, True):
+            ctx = AnalysisContext()
+            start_time = time.time()
+            analyze_capture(ctx, fcap.name, prefilter=prefilter)
+            duration = time.time() - start_time
+            logger.info("%s: %.3f seconds (%.0f packets/s)",
+                        "With prefilter" if prefilter else "Scapy only", duration, num_packets / duration)
+            results.append(ctx.to_dict())
+
+    if results[0] != results[1]:
+        logger.error("The prefilter changed the result of the analysis")
+        return False
+    logger.info("Both analyses gave the same result")
+    return True
+
+
+def write_graph(ctx, stream, streaming=False):
+    """Write the graph of an analysis context in DOT format"""
+    if streaming:
+        graph = Graph(stream)
+        ctx.populate_graph(graph)
+        graph.close()
+    else:
+        graph = Graph()
+        ctx.populate_graph(graph)
+        graph.dump_dot(stream)
+
+
+def build_benchmark_graph(num_ip_addresses, stream=None):
+    """Build a graph looking like a large network map, with a /24 network for every 200 IP addresses"""
+    graph = Graph(stream)
+    num_networks = max(1, num_ip_addresses // 200)
+    for net_idx in range(num_networks):
+        net_obj = ipaddress.ip_network(u'10.{}.{}.0/24'.format(net_idx >> 8, net_idx & 0xff))
+        graph.add_ip_network(net_obj, GraphvizSafeLabel.escape(net_obj.with_prefixlen))
+    graph.add_ip_network(ipaddress.ip_network(u'10.0.0.0/8'), GraphvizSafeLabel.escape('10.0.0.0/8'))
+    for idx in range(num_ip_addresses):
+        net_idx = idx % num_networks
+        ip_addr = '10.{}.{}.{}'.format(net_idx >> 8, net_idx & 0xff, idx // num_networks % 254 + 1)
+        hw_addr = '02:00:{:02x}:{:02x}:{:02x}:{:02x}'.format(
+            idx >> 24, (idx >> 16) & 0xff, (idx >> 8) & 0xff, idx & 0xff)
+        hw_addr_node = graph.add_hw_addr(hw_addr, graphviz_records([hw_addr, 'Locally administered']))
+        ip_addr_node = graph.add_ip_addr(ip_addr)
+        graph.add_edge(hw_addr_node, ip_addr_node, 'network interface')
+    return graph
+
+
+def benchmark_graph(num_ip_addresses):
+    """Measure how long it takes to build and write a generated graph"""
+    with open(os.devnull, 'w') as fdevnull:
+        start_time = time.time()
+        graph = build_benchmark_graph(num_ip_addresses)
+        logger.info("Built a graph with %d nodes and %d edges in %.3f seconds",
+                    len(graph.nodes), len(graph.edges), time.time() - start_time)
+
+        start_time = time.time()
+        graph.dump_dot(fdevnull)
+        logger.info("Wrote the sorted graph in %.3f seconds", time.time() - start_time)
+
+        start_time = time.time()
+        graph.dump_dot(fdevnull, sort=False)
+        logger.info("Wrote the graph in insertion order in %.3f seconds", time.time() - start_time)
+
+        start_time = time.time()
+        graph = build_benchmark_graph(num_ip_addresses, fdevnull)
+        graph.close()
+        logger.info("Built and wrote a streamed graph in %.3f seconds", time.time() - start_time)
+
+
+def setup_logging(debug=False):
+    """Configure the logging messages, in the main process and in workers"""
+    logging.basicConfig(format='[%(levelname)s] %(message)s',
+                        level=logging.DEBUG if debug else logging.INFO)
+
+
 def main(argv=None):
     parser = argparse.ArgumentParser(description="Map a network from a capture file")
     parser.add_argument('file', metavar="PCAPFILE", nargs='*', type=str,
@@ -1093,10 +1853,36 @@ def main(argv=None):
                         help="format of the graph (dot, png, svg, etc.)")
     parser.add_argument('-t', '--tree', action='store_true',
                         help="output the graph as a flat tree")
+    parser.add_argument('--stream-graph', action='store_true',
+                        help="write the graph while building it, in insertion order (faster for large graphs)")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="number of worker processes analyzing capture files in parallel")
+    parser.add_argument('--chunk-size', metavar='MiB', type=float, default=256,
+                        help="split pcap files in chunks of this size for the workers (0 to disable)")
+    parser.add_argument('-c', '--checkpoint', metavar='CHECKPOINT_FILE', type=str,
+                        help="state of an incremental analysis, updated with the new content of the capture files")
+    parser.add_argument('-P', '--prefilter', action='store_true',
+                        help="only dissect with scapy the packets which may carry interesting information")
+    parser.add_argument('--benchmark-prefilter', metavar='NUM_PACKETS', type=int,
+                        help="compare the analysis of a generated capture with and without the prefilter")
+    parser.add_argument('--benchmark-graph', metavar='NUM_IP_ADDRESSES', type=int,
+                        help="measure how long it takes to build and write a generated graph")
     args = parser.parse_args(argv)
 
-    if not args.file and not args.input:
-        parser.error("a network capture file or a JSON import is required")
+    if args.benchmark_graph:
+        setup_logging(args.debug)
+        benchmark_graph(args.benchmark_graph)
+        return 0
+
+    if args.benchmark_prefilter:
+        setup_logging(args.debug)
+        return 0 if benchmark_prefilter(args.benchmark_prefilter) else 1
+
+    if args.jobs < 1:
+        parser.error("the number of jobs needs to be positive")
+
+    if not args.file and not args.input and not args.checkpoint:
+        parser.error("a network capture file, a JSON import or a checkpoint is required")
 
     if args.graph:
         graph_format = args.graph_format
@@ -1107,10 +1893,14 @@ def main(argv=None):
         if graph_format not in ('dot', 'fig', 'jpg', 'jpeg', 'json', 'pdf', 'png', 'ps', 'svg', 'svgz', 'xdot'):
             parser.error("unknown graph format {}".format(graph_format))
 
-    logging.basicConfig(format='[%(levelname)s] %(message)s',
-                        level=logging.DEBUG if args.debug else logging.INFO)
+    setup_logging(args.debug)
 
-    ctx = AnalysisContext()
+    checkpoint = None
+    if args.checkpoint:
+        checkpoint = AnalysisCheckpoint.load(args.checkpoint)
+        ctx = checkpoint.context
+    else:
+        ctx = AnalysisContext()
 
     if args.input:
         for jsonpath in args.input:
@@ -1118,10 +1908,40 @@ def main(argv=None):
             with open(jsonpath, 'r') as fjson:
                 ctx.load_dict(json.load(fjson))
 
+    chunk_size = int(args.chunk_size * 1024 * 1024) if args.jobs > 1 else 0
+    chunks = []
+    new_file_states = []
     for filepath in args.file:
-        logger.debug("Reading %s", filepath)
-        for pkt in PcapReader(filepath):  # pylint: disable=no-value-for-parameter
-            ctx.analyze_read_packet(pkt)
+        if checkpoint is not None:
+            file_chunks, file_state = checkpoint.plan_file(filepath, chunk_size)
+            chunks += file_chunks
+            new_file_states.append((filepath, file_state))
+        elif args.jobs > 1:
+            chunks += split_capture_file(filepath, chunk_size)
+        else:
+            chunks.append((filepath, None, None))
+
+    if args.jobs > 1 and chunks:
+        # Analyze the chunks in worker processes with their own context, and
+        # merge the results in order, like if the packets were read sequentially
+        logger.debug("Analyzing %d chunks of %d files with %d workers", len(chunks), len(args.file), args.jobs)
+        pool = multiprocessing.Pool(args.jobs, initializer=setup_logging, initargs=(args.debug, ))
+        try:
+            for chunk_data in pool.imap(functools.partial(analyze_capture_chunk, prefilter=args.prefilter), chunks):
+                ctx.load_dict(chunk_data)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for filepath, start_offset, end_offset in chunks:
+            logger.debug("Reading %s", filepath)
+            analyze_capture(ctx, filepath, start_offset, end_offset, prefilter=args.prefilter)
+
+    if checkpoint is not None:
+        # Save the state before the post-processing, which modifies it
+        for filepath, file_state in new_file_states:
+            checkpoint.set_file_state(filepath, file_state)
+        checkpoint.save(args.checkpoint)
 
     ctx.post_processing(add_local_networks=args.add_local_networks)
     if args.known_networks:
@@ -1141,12 +1961,10 @@ def main(argv=None):
                 ctx.remove_multicast_addresses()
             ctx.simplify_for_graph()
 
-        graph = Graph()
-        ctx.populate_graph(graph)
         if graph_format == 'dot':
             logger.debug("Drawing %s (xdot can render it)", args.graph)
             with open(args.graph, 'w') as fdot:
-                graph.dump_dot(fdot)
+                write_graph(ctx, fdot, args.stream_graph)
         else:
             # Run graphviz
             if args.tree:
@@ -1155,7 +1973,7 @@ def main(argv=None):
                 cmdline = ['sfdp', '-Goverlap=prism', '-T' + graph_format, '-o' + args.graph]
             logger.info("Running %s", ' '.join(cmdline))
             proc = subprocess.Popen(cmdline, stdin=subprocess.PIPE, universal_newlines=True)
-            graph.dump_dot(proc.stdin)
+            write_graph(ctx, proc.stdin, args.stream_graph)
             proc.stdin.close()
             exitcode = proc.wait()
             if exitcode:
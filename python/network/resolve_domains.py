@@ -26,22 +26,39 @@ domains.txt, a cache in directory dns/, writing results in results.out.txt:
 
     ./resolve_domains.py -gMOs -o dns_resolutions.out.txt -d cache_dns domains.txt
 
+In order to send several queries concurrently, option -j/--jobs configures the
+number of queries in flight and option -r/--rate limits the number of queries
+per second sent to the upstream server (instead of sleeping between queries).
+Without -r/--rate nor -t/--time-sleep, the concurrent queries are not rate-limited:
+
+    ./resolve_domains.py -gMOs -j 32 -r 50 -o dns_resolutions.out.txt -d cache_dns domains.txt
+
+With many domains, option -b/--sqlite-cache stores the cache in an indexed
+SQLite database (cache_dns/cache.sqlite3) instead of one JSON file per question.
+Option --migrate-cache moves existing JSON files into this database.
+
 @author: Nicolas Iooss
 @license: MIT
 """
 import argparse
+import asyncio
 import binascii
+import concurrent.futures
+import heapq
+import http.client
 import ipaddress
 import itertools
 import json
 from pathlib import Path
 import random
 import re
+import sqlite3
 import ssl
 import struct
+import tempfile
+import threading
 import time
 import urllib.parse
-import urllib.request
 
 try:
     import dns.resolver
@@ -60,6 +77,17 @@ else:
 DNS_TYPES = ('A', 'AAAA', 'MX', 'NS', 'PTR', 'TXT', 'ANY')
 DNS_SRV_TYPES = ('NS', 'SRV', 'TXT', 'ANY')
 
+# Types of DNS records which are hidden by option --hide-dnssec
+DNSSEC_RTYPES = ('DNSKEY', 'NSEC3PARAM', 'NSEC3', 'RRSIG')
+
+# Find out wildcard domains using resolutions for "b.domain", "random.domain"
+# and "xyz.domain"
+WILDCARD_DETECTORS = ('b.', 'random.', 'xyz.')
+
+# Endpoints of the DNS-over-HTTPS JSON APIs
+GOOGLE_DOH_URL = 'https://dns.google.com/resolve'
+CLOUDFLARE_DOH_URL = 'https://cloudflare-dns.com/dns-query'
+
 # Identifiers of record data types
 DNS_RDATA_TYPES = {
     'NONE': 0,
@@ -504,94 +532,287 @@ def dns_sortkey(name):
     return (reversed_parts, name)
 
 
-class Resolver:
-    def __init__(self, cache_directory, time_sleep=1, use_google=False, use_cloudflare=False, no_ssl=False):
-        self.cache_directory = cache_directory
-        self.time_sleep = time_sleep
-        assert not (use_google and use_cloudflare)
-        self.use_google = use_google
-        self.use_cloudflare = use_cloudflare
-        self.no_ssl = no_ssl
-        self.dns_questions = None
-        self.dns_records = None
-        self.is_cache_dirty = True
-        self.has_show_dnspython_any_warning = False
-        self.load_cache(if_dirty=False)
-
-    def load_cache(self, if_dirty=True):
-        """Load cached DNS results from the cache directory"""
-        if if_dirty and not self.is_cache_dirty:
-            # Do not reload the cache if it has not been modified
-            return
-
-        self.dns_questions = set()
-        self.dns_records = set()
-        for filepath in self.cache_directory.glob('*.json'):
-            with filepath.open(mode='r') as fjson:
-                for line in fjson:
-                    json_data = json.loads(line)
+def dump_sortkey(record):
+    """Get the sort key of a record, placing rPTR entries right after A and AAAA ones"""
+    return (dns_sortkey(record[0]), record[1].replace('rPTR', 'ArPTR'), record[2])
+
+
+def iter_response_records(json_data, source, warn=True):
+    """Enumerate the (name, type, data) records of a JSON response, with fake reverse-PTR entries"""
+    # Ignore failed responses
+    rcode_name = DNS_RESPONSE_CODES.get(json_data['Status'])
+    if rcode_name in ('SERVFAIL', 'NXDOMAIN', 'NOTIMP', 'REFUSED'):
+        return
+    if rcode_name != 'NOERROR':
+        raise ValueError("Invalid status {} ({}) in {}".format(
+            json_data['Status'], rcode_name, repr(source)))
+
+    # Ignore empty responses
+    if 'Answer' not in json_data:
+        return
+
+    for answer in json_data['Answer']:
+        asc_type = DNS_TYPE_ITOA[answer['type']]
+        yield (answer['name'], asc_type, answer['data'])
+
+        # Add fake reverse-PTR entry
+        if asc_type == 'PTR':
+            matches = re.match(
+                r'^([0-9]+)\.([0-9]+)\.([0-9]+)\.([0-9]+)\.in-addr\.arpa\.$',
+                answer['name'], re.I)
+            if matches:
+                # IPv4 PTR record
+                ip_addr = '.'.join(matches.groups()[::-1])
+                yield (answer['data'], 'rPTR', ip_addr)
+                continue
 
-                    # Add the question to the list of asked ones
-                    for question in json_data['Question']:
-                        self.dns_questions.add(
-                            (question['name'].lower().strip('.'), DNS_TYPE_ITOA[question['type']])
-                        )
+            matches = re.match(r'^(([0-9a-f]+\.){32})ip6\.arpa\.$', answer['name'])
+            if matches:
+                # IPv6 PTR record
+                packed_addr = binascii.unhexlify(matches.group(1).replace('.', '')[::-1])
+                ip_addr_expanded = ':'.join(
+                    '{:04x}'.format(x) for x in struct.unpack('>8H', packed_addr))
+                ip_addr = ipaddress.IPv6Address(ip_addr_expanded).compressed
+                yield (answer['data'], 'rPTR', ip_addr)
+                continue
 
-                    # Ignore failed responses
-                    rcode_name = DNS_RESPONSE_CODES.get(json_data['Status'])
-                    if rcode_name in ('SERVFAIL', 'NXDOMAIN', 'NOTIMP', 'REFUSED'):
-                        continue
-                    if rcode_name != 'NOERROR':
-                        raise ValueError("Invalid status {} ({}) in {}".format(
-                            json_data['Status'], rcode_name, repr(filepath)))
+            if warn:
+                print("Warning: invalid PTR record name {}".format(repr(answer['name'])))
+
+
+class WildcardSuffixTrie:
+    """Index the suffixes of wildcard records by their labels, from the last one
+
+    Each node is a dict mapping a label to a child node. The (type, data) of
+    the wildcard records of the suffix leading to a node are stored in the
+    node with key None. Finding out whether a record is covered by a wildcard
+    takes a time proportional to the number of labels of its domain name,
+    whatever the number of wildcards sharing its data.
+    """
+    def __init__(self):
+        self.root = {}
+
+    def add(self, wild_suffix, rtype, data):
+        """Add the wildcard record *.wild_suffix"""
+        node = self.root
+        for label in reversed(wild_suffix.split('.')):
+            node = node.setdefault(label, {})
+        if None not in node:
+            node[None] = set()
+        node[None].add((rtype, data))
+
+    def covers(self, record):
+        """Is the record a subdomain of a wildcard record with the same type and data?
+
+        This is like testing domain.endswith('.' + wild_suffix) for all the
+        wildcard suffixes with the same (type, data), except for the wildcard
+        record itself.
+        """
+        domain, rtype, data = record
+        labels = domain.split('.')
+        node = self.root
+        # Only walk through strict suffixes of the domain name
+        for index in range(len(labels) - 1, 0, -1):
+            node = node.get(labels[index])
+            if node is None:
+                return False
+            wildcards = node.get(None)
+            if wildcards and (rtype, data) in wildcards:
+                if index == 1 and labels[0] == '*':
+                    # The record is the wildcard record
+                    return False
+                return True
+        return False
+
+
+class TokenBucket:
+    """Limit the rate of some operations, while allowing short bursts
+
+    This needs to be created from a coroutine, as it uses an asyncio lock.
+    """
+    def __init__(self, rate, burst=1):
+        assert rate > 0
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Wait until a token is available and consume it"""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class DohConnectionPool:
+    """Pool of persistent HTTP/1.1 connections to a DNS-over-HTTPS server
+
+    The connections are kept alive between requests, so that the TCP and TLS
+    handshakes are only performed when a new connection is opened. This is
+    thread-safe, and at most pool_size requests are sent concurrently.
+    """
+    def __init__(self, url, pool_size=1, no_ssl=False, timeout=30):
+        url_parts = urllib.parse.urlsplit(url)
+        self.scheme = url_parts.scheme
+        self.host = url_parts.hostname
+        self.port = url_parts.port
+        self.path = url_parts.path or '/'
+        self.netloc = url_parts.netloc
+        self.timeout = timeout
+        if self.scheme == 'https':
+            self.ssl_context = ssl.create_default_context()
+            if no_ssl:
+                # Disable HTTPS certificate verification, for example when recording
+                # the requests using a HTTPS proxy such as BurpSuite.
+                self.ssl_context.check_hostname = False
+                self.ssl_context.verify_mode = ssl.CERT_NONE  # noqa
+        elif self.scheme == 'http':
+            self.ssl_context = None
+        else:
+            raise ValueError("Unsupported URL scheme in {}".format(repr(url)))
+
+        self.pool_size = pool_size
+        self.available_slots = threading.BoundedSemaphore(pool_size)
+        self.lock = threading.Lock()
+        self.idle_connections = []
+        self.stats = {
+            'connections': 0,  # Number of opened connections
+            'requests': 0,  # Number of sent requests
+            'reused': 0,  # Number of requests sent on a connection which was already used
+            'retries': 0,  # Number of requests sent again after the server closed an idle connection
+        }
 
-                    # Ignore empty responses
-                    if 'Answer' not in json_data:
-                        continue
+    def get_url(self, params):
+        """Get the URL of a request with the given parameters"""
+        return '{}://{}{}?{}'.format(self.scheme, self.netloc, self.path, urllib.parse.urlencode(params))
+
+    def increment_stat(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def open_connection(self):
+        """Open a new connection to the server"""
+        self.increment_stat('connections')
+        if self.ssl_context is None:
+            return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout, context=self.ssl_context)
+
+    def send_request(self, conn, params, headers):
+        """Send a GET request and read its response"""
+        self.increment_stat('requests')
+        conn.request('GET', self.path + '?' + urllib.parse.urlencode(params), headers=headers)
+        resp = conn.getresponse()
+        return resp, resp.read()
+
+    def get(self, params, headers=None):
+        """Perform a GET request with the given query parameters, returning the HTTP status and the body"""
+        headers = headers or {}
+        with self.available_slots:
+            with self.lock:
+                conn = self.idle_connections.pop() if self.idle_connections else None
+            if conn is None:
+                conn = self.open_connection()
+                resp, data = self.send_request(conn, params, headers)
+            else:
+                self.increment_stat('reused')
+                try:
+                    resp, data = self.send_request(conn, params, headers)
+                except (http.client.HTTPException, ConnectionError):
+                    # The server closed the idle connection: retry the request
+                    # (which is idempotent) on a new connection
+                    conn.close()
+                    self.increment_stat('retries')
+                    conn = self.open_connection()
+                    resp, data = self.send_request(conn, params, headers)
+
+            if resp.will_close:
+                conn.close()
+            else:
+                with self.lock:
+                    self.idle_connections.append(conn)
+        return resp.status, data
+
+    def close(self):
+        """Close all the idle connections"""
+        with self.lock:
+            idle_connections = self.idle_connections
+            self.idle_connections = []
+        for conn in idle_connections:
+            conn.close()
+
+    def format_stats(self):
+        """Describe how the connections were used"""
+        with self.lock:
+            stats = self.stats.copy()
+        return "{} requests to {} using {} connections ({} reused, {} retried, pool size {})".format(
+            stats['requests'], self.netloc, stats['connections'], stats['reused'], stats['retries'],
+            self.pool_size)
+
+
+class DirectoryCacheStore:
+    """Store the responses to DNS queries in a directory, with one JSON file per question"""
+    is_indexed = False
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.loaded_files = set()
+
+    def get_cache_file(self, name, rtype):
+        return self.directory / '{}_{}.json'.format(name, rtype)
+
+    def has_response(self, name, rtype):
+        """Check whether the response to a question has been cached"""
+        return self.get_cache_file(name, rtype).exists()
+
+    def add_response(self, name, rtype, response):
+        """Cache the JSON response (as bytes) to a question
+
+        The response is considered as already loaded.
+        """
+        cache_file = self.get_cache_file(name, rtype)
+        with cache_file.open(mode='wb') as fout:
+            fout.write(response)
+            fout.write(b'\n')
+        self.loaded_files.add(cache_file)
 
-                    for answer in json_data['Answer']:
-                        asc_type = DNS_TYPE_ITOA[answer['type']]
-                        self.dns_records.add((answer['name'], asc_type, answer['data']))
-
-                        # Add fake reverse-PTR entry
-                        if asc_type == 'PTR':
-                            matches = re.match(
-                                r'^([0-9]+)\.([0-9]+)\.([0-9]+)\.([0-9]+)\.in-addr\.arpa\.$',
-                                answer['name'], re.I)
-                            if matches:
-                                # IPv4 PTR record
-                                ip_addr = '.'.join(matches.groups()[::-1])
-                                self.dns_records.add((answer['data'], 'rPTR', ip_addr))
-                                continue
-
-                            matches = re.match(r'^(([0-9a-f]+\.){32})ip6\.arpa\.$', answer['name'])
-                            if matches:
-                                # IPv6 PTR record
-                                packed_addr = binascii.unhexlify(matches.group(1).replace('.', '')[::-1])
-                                ip_addr_expanded = ':'.join(
-                                    '{:04x}'.format(x) for x in struct.unpack('>8H', packed_addr))
-                                ip_addr = ipaddress.IPv6Address(ip_addr_expanded).compressed
-                                self.dns_records.add((answer['data'], 'rPTR', ip_addr))
-                                continue
-
-                            print("Warning: invalid PTR record name {}".format(repr(answer['name'])))
+    def iter_responses(self):
+        """Enumerate (source, JSON line) for all the cached responses"""
+        for filepath in self.directory.glob('*.json'):
+            with filepath.open(mode='r') as fjson:
+                for line in fjson:
+                    yield filepath, line
 
-        self.is_cache_dirty = False
+    def iter_new_responses(self):
+        """Enumerate (source, JSON line) for the cached responses which were not enumerated yet"""
+        for filepath in self.directory.glob('*.json'):
+            if filepath in self.loaded_files:
+                continue
+            self.loaded_files.add(filepath)
+            with filepath.open(mode='r') as fjson:
+                for line in fjson:
+                    yield filepath, line
 
-    def merge_cache_files(self):
+    def compact(self):
         """Merge all cache files into one"""
         # Load all the JSON records, and deduplicate them
         all_files = set()
         all_lines = set()
-        for filepath in self.cache_directory.glob('*.json'):
+        for filepath in self.directory.glob('*.json'):
             all_files.add(filepath)
             with filepath.open(mode='r') as fjson:
                 for line in fjson:
                     all_lines.add(line.strip() + '\n')
 
         all_lines = sorted(all_lines)
-        merged_file = self.cache_directory / 'all.json'
-        new_merged_file = self.cache_directory / 'all.json.new'
+        merged_file = self.directory / 'all.json'
+        new_merged_file = self.directory / 'all.json.new'
         try:
             with new_merged_file.open(mode='w') as fout:
                 fout.write(''.join(all_lines))
@@ -606,37 +827,243 @@ class Resolver:
         for filepath in all_files:
             if filepath != merged_file:
                 filepath.unlink()
+        if all_files <= self.loaded_files:
+            self.loaded_files = {merged_file}
+        else:
+            self.loaded_files = set()
+
+    def close(self):
+        pass
+
+
+class SqliteCacheStore:
+    """Store the responses to DNS queries in a SQLite database, indexed by question
+
+    Checking whether a question has already been answered is a lookup in the
+    index, which does not require loading the cached responses. These are
+    loaded incrementally, following the order in which they were inserted.
+    """
+    is_indexed = True
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(str(db_path))
+        # Commit each response without waiting for a full synchronization
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+            name TEXT NOT NULL,
+            rtype TEXT NOT NULL,
+            response TEXT NOT NULL,
+            PRIMARY KEY (name, rtype))""")
+        self.conn.commit()
+        self.last_loaded_rowid = 0
+        # Rows which were inserted after last_loaded_rowid, and do not need to be loaded
+        self.added_rowids = set()
 
-    def resolve_in_cache(self, domain, rtype):
-        """Resolve a domain name, writing the result in a cache file"""
-        domain = domain.strip('.')
+    @staticmethod
+    def get_key(name, rtype):
+        # Like the names of the files of DirectoryCacheStore, keep the case of the name
+        return name.strip('.'), rtype
+
+    def has_response(self, name, rtype):
+        """Check whether the response to a question has been cached"""
+        cursor = self.conn.execute(
+            'SELECT 1 FROM responses WHERE name = ? AND rtype = ?',
+            self.get_key(name, rtype))
+        return cursor.fetchone() is not None
+
+    def add_response(self, name, rtype, response):
+        """Cache the JSON response (as bytes) to a question
+
+        The response is considered as already loaded.
+        """
+        cursor = self.conn.execute(
+            'INSERT OR REPLACE INTO responses (name, rtype, response) VALUES (?, ?, ?)',
+            self.get_key(name, rtype) + (response.decode('utf-8'), ))
+        self.conn.commit()
+        self.added_rowids.add(cursor.lastrowid)
+
+    def iter_responses(self):
+        """Enumerate (source, JSON line) for all the cached responses"""
+        for rowid, line in self.conn.execute('SELECT rowid, response FROM responses ORDER BY rowid'):
+            yield '{}#{}'.format(self.db_path, rowid), line
+
+    def iter_new_responses(self):
+        """Enumerate (source, JSON line) for the cached responses which were not enumerated yet"""
+        cursor = self.conn.execute(
+            'SELECT rowid, response FROM responses WHERE rowid > ? ORDER BY rowid',
+            (self.last_loaded_rowid, ))
+        for rowid, line in cursor:
+            self.last_loaded_rowid = rowid
+            if rowid in self.added_rowids:
+                continue
+            yield '{}#{}'.format(self.db_path, rowid), line
+        self.added_rowids = set()
+
+    def import_directory(self, directory, remove_files=False):
+        """Import the JSON files of a cache directory, returning the number of imported responses"""
+        count = 0
+        for filepath in directory.glob('*.json'):
+            with filepath.open(mode='r', encoding='utf-8') as fjson:
+                for line in fjson:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    question = json.loads(line)['Question'][0]
+                    key = self.get_key(question['name'], DNS_TYPE_ITOA[question['type']])
+                    self.conn.execute(
+                        'INSERT OR IGNORE INTO responses (name, rtype, response) VALUES (?, ?, ?)',
+                        key + (line, ))
+                    count += 1
+            # Commit before removing each file, in order not to lose data
+            self.conn.commit()
+            if remove_files:
+                filepath.unlink()
+        return count
+
+    def compact(self):
+        """Rebuild the database to reclaim the unused space"""
+        self.conn.execute('VACUUM')
+
+    def close(self):
+        self.conn.close()
+
+
+class Resolver:
+    def __init__(self, cache_store, time_sleep=1, use_google=False, use_cloudflare=False, no_ssl=False,
+                 jobs=1, rate_limit=None, rate_burst=1, google_url=GOOGLE_DOH_URL, cloudflare_url=CLOUDFLARE_DOH_URL,
+                 nameservers=None, dns_port=53, pool_size=None, keep_records=True):
+        self.cache_store = cache_store
+        self.time_sleep = time_sleep
+        assert not (use_google and use_cloudflare)
+        self.use_google = use_google
+        self.use_cloudflare = use_cloudflare
+        self.no_ssl = no_ssl
+        # Number of queries which can be in flight at the same time.
+        # When it is more than one, the queries are rate-limited by a token
+        # bucket for each upstream instead of sleeping after each query.
+        self.jobs = jobs
+        self.rate_limit = rate_limit
+        self.rate_burst = rate_burst
+        self.google_url = google_url
+        self.cloudflare_url = cloudflare_url
+        self.nameservers = nameservers
+        self.dns_port = dns_port
+        self.doh_pool = None
+        if use_google or use_cloudflare:
+            # Share persistent connections between all DNS-over-HTTPS queries
+            self.doh_pool = DohConnectionPool(
+                google_url if use_google else cloudflare_url,
+                pool_size=pool_size or jobs,
+                no_ssl=no_ssl)
+        self.dns_questions = set()
+        self.dns_records = set()
+        # Without keep_records, the records are not kept in memory and are
+        # read again from the cache store when they are needed
+        self.keep_records = keep_records
+        self.is_cache_dirty = True
+        self.has_show_dnspython_any_warning = False
+        if not cache_store.is_indexed:
+            # Questions which were already asked are found in the loaded cache
+            self.load_cache(if_dirty=False)
+
+    def close(self):
+        """Close the connections to the upstream server and the cache"""
+        if self.doh_pool is not None:
+            self.doh_pool.close()
+        self.cache_store.close()
+
+    def load_cache(self, if_dirty=True):
+        """Load the cached DNS results which were not already loaded"""
+        if if_dirty and not self.is_cache_dirty:
+            # Do not reload the cache if it has not been modified
+            return
+
+        # Only the questions are loaded without keep_records, and they are not
+        # needed when the cache store can find responses by itself
+        if self.keep_records or not self.cache_store.is_indexed:
+            for source, line in self.cache_store.iter_new_responses():
+                self.add_response_to_sets(json.loads(line), source)
+
+        self.is_cache_dirty = False
+
+    def add_response_to_sets(self, json_data, source):
+        """Add the question and the records of a JSON response to the in-memory sets"""
+        # Add the question to the list of asked ones
+        for question in json_data['Question']:
+            self.dns_questions.add(
+                (question['name'].lower().strip('.'), DNS_TYPE_ITOA[question['type']])
+            )
+
+        if self.keep_records:
+            self.dns_records.update(iter_response_records(json_data, source))
+
+    def iter_cached_records(self):
+        """Enumerate the records of all the cached responses, without keeping them in memory"""
+        for source, line in self.cache_store.iter_responses():
+            for record in iter_response_records(json.loads(line), source, warn=False):
+                yield record
+
+    def iter_records(self):
+        """Enumerate the known records, from memory or from the cache store"""
+        if self.keep_records:
+            return iter(self.dns_records)
+        return self.iter_cached_records()
+
+    def merge_cache_files(self):
+        """Merge all cache files into one, or compact the cache database"""
+        self.cache_store.compact()
+
+    def needs_query(self, domain, rtype):
+        """Check whether a question needs to be sent to the upstream server"""
         # NB. use dns_questions instead of dns_records in order to perform
         # specific queries (A, AAAA, TXT, etc.) even after an ANY query.
         if (domain, rtype) in self.dns_questions:
-            return
+            return False
 
-        cache_file = self.cache_directory / '{}_{}.json'.format(domain, rtype)
-        if cache_file.exists():
-            print("Warning: cache file exists for {} <{}> but was not loaded".format(domain, rtype))
-            return
+        if self.cache_store.has_response(domain, rtype):
+            if not self.cache_store.is_indexed:
+                print("Warning: cache file exists for {} <{}> but was not loaded".format(domain, rtype))
+            return False
+        return True
+
+    def write_cache_response(self, domain, rtype, response):
+        """Write the response to a DNS query in the cache, and add it to the in-memory sets
 
+        The cache does not become dirty, as the written response is not loaded again.
+        """
+        response = response.strip(b'\n')
+        self.cache_store.add_response(domain, rtype, response)
+        self.add_response_to_sets(json.loads(response.decode('utf-8')), '{} <{}>'.format(domain, rtype))
+
+    def get_upstream_name(self):
+        """Get the name of the upstream server used to perform DNS queries"""
         if self.use_google:
-            response = self.query_google(domain, rtype)
-        elif self.use_cloudflare:
-            response = self.query_cloudflare(domain, rtype)
-        else:
-            response = self.query_dns(domain, rtype)
+            return urllib.parse.urlsplit(self.google_url).netloc
+        if self.use_cloudflare:
+            return urllib.parse.urlsplit(self.cloudflare_url).netloc
+        return 'dns'
 
-        if not response:
+    def query_upstream(self, domain, rtype):
+        """Query the configured upstream server"""
+        if self.use_google:
+            return self.query_google(domain, rtype)
+        if self.use_cloudflare:
+            return self.query_cloudflare(domain, rtype)
+        return self.query_dns(domain, rtype)
+
+    def resolve_in_cache(self, domain, rtype):
+        """Resolve a domain name, writing the result in a cache file"""
+        domain = domain.strip('.')
+        if not self.needs_query(domain, rtype):
             return
 
-        # Write the cache file
-        response = response.strip(b'\n')
-        with cache_file.open(mode='wb') as fout:
-            fout.write(response)
-            fout.write(b'\n')
+        response = self.query_upstream(domain, rtype)
+        if not response:
+            return
 
-        self.is_cache_dirty = True
+        self.write_cache_response(domain, rtype, response)
 
         # Sleep after the DNS query
         if self.time_sleep:
@@ -644,6 +1071,71 @@ class Resolver:
             print('-', end='\r')
             time.sleep(self.time_sleep)
 
+    def resolve_questions(self, questions):
+        """Resolve an iterable of (domain, rtype) questions
+
+        With several jobs, the queries are performed concurrently by an asyncio
+        event loop, which runs the blocking query functions in a thread pool.
+        """
+        if self.jobs <= 1:
+            for domain, rtype in questions:
+                self.resolve_in_cache(domain, rtype)
+            return
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.resolve_questions_async(questions, loop))
+        finally:
+            loop.close()
+
+    async def resolve_questions_async(self, questions, loop):
+        """Resolve questions, keeping at most self.jobs queries in flight"""
+        rate_limiters = {}
+        if self.rate_limit:
+            rate_limiters[self.get_upstream_name()] = TokenBucket(self.rate_limit, self.rate_burst)
+        semaphore = asyncio.Semaphore(self.jobs)
+        seen_questions = set()
+        pending = set()
+
+        async def resolve_one(domain, rtype):
+            try:
+                rate_limiter = rate_limiters.get(self.get_upstream_name())
+                if rate_limiter is not None:
+                    await rate_limiter.acquire()
+                response = await loop.run_in_executor(executor, self.query_upstream, domain, rtype)
+                if response:
+                    # The cache is written from the event loop thread,
+                    # so there is no need to lock it
+                    self.write_cache_response(domain, rtype, response)
+            finally:
+                semaphore.release()
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs)
+        try:
+            for domain, rtype in questions:
+                domain = domain.strip('.')
+                if (domain, rtype) in seen_questions:
+                    continue
+                seen_questions.add((domain, rtype))
+                if not self.needs_query(domain, rtype):
+                    continue
+
+                await semaphore.acquire()
+                # Report errors as soon as possible, instead of sending more queries
+                for task in [t for t in pending if t.done()]:
+                    pending.remove(task)
+                    task.result()
+                pending.add(loop.create_task(resolve_one(domain, rtype)))
+
+            if pending:
+                await asyncio.gather(*pending)
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+            executor.shutdown(wait=True)
+
     @staticmethod
     def get_ptr_name_for_ip(ip_addr, version=None):
         """Get the PTR domain name matching an IP address"""
@@ -686,6 +1178,11 @@ class Resolver:
         print("Querying DNS for {} <{}>...".format(domain, rdtype_text))
         resolver = dns.resolver.Resolver()
         resolver.use_edns(0, dns.flags.DO, 4096)
+        # Set the port before the nameservers, as dnspython>=2.0 uses it when
+        # setting the nameservers
+        resolver.port = self.dns_port
+        if self.nameservers:
+            resolver.nameservers = self.nameservers
         dot_domain = domain + '.'
         rdtype = dns.rdatatype.from_text(rdtype_text)
         rdclass = dns.rdataclass.IN
@@ -732,93 +1229,43 @@ class Resolver:
 
     def query_google(self, domain, rtype):
         """Perform a DNS query using https://dns.google.com/ API"""
-        print("Querying dns.google.com for {} <{}>...".format(domain, rtype))
-        params = {
-            'name': domain,
-            'type': rtype,
-        }
-        url = 'https://dns.google.com/resolve?' + urllib.parse.urlencode(params)
-        ctx = ssl.create_default_context()
-        if self.no_ssl:
-            # Disable HTTPS certificate verification, for example when recording
-            # the requests using a HTTPS proxy such as BurpSuite.
-            ctx.check_hostname = False
-            ctx.verify_mode = ssl.CERT_NONE  # noqa
-        opener = urllib.request.build_opener(urllib.request.HTTPSHandler(context=ctx))
-        req = urllib.request.Request(
-            url,
-            headers={
-                'Accept': 'application/json, text/plain, */*',
-                'Connection': 'close',
-            })
-        with opener.open(req) as resp:
-            if resp.status not in (200, 204):
-                raise ValueError("Request to {} returned HTTP status {}".format(url, resp.status))
-            content_length = resp.getheader('Content-Length')
-            if content_length:
-                data = resp.read(int(content_length))
-            else:
-                data = resp.read()
-        if not data:
-            raise ValueError("No data in response to {}".format(url))
-        return data
+        print("Querying {} for {} <{}>...".format(self.get_upstream_name(), domain, rtype))
+        return self.query_doh_json(domain, rtype, 'application/json, text/plain, */*')
 
     def query_cloudflare(self, domain, rtype):
         """Perform a DNS query using https://cloudflare-dns.com/ API"""
-        print("Querying cloudflare-dns.com for {} <{}>...".format(domain, rtype))
+        print("Querying {} for {} <{}>...".format(self.get_upstream_name(), domain, rtype))
+        return self.query_doh_json(domain, rtype, 'application/dns-json')
+
+    def query_doh_json(self, domain, rtype, accept):
+        """Perform a DNS query using the DNS-over-HTTPS JSON API of the connection pool"""
         params = {
             'name': domain,
             'type': rtype,
         }
-        url = 'https://cloudflare-dns.com/dns-query?' + urllib.parse.urlencode(params)
-        ctx = ssl.create_default_context()
-        if self.no_ssl:
-            # Disable HTTPS certificate verification, for example when recording
-            # the requests using a HTTPS proxy such as BurpSuite.
-            ctx.check_hostname = False
-            ctx.verify_mode = ssl.CERT_NONE  # noqa
-        opener = urllib.request.build_opener(urllib.request.HTTPSHandler(context=ctx))
-        req = urllib.request.Request(
-            url,
-            headers={
-                'Accept': 'application/dns-json',
-                'Connection': 'close',
-            })
-        with opener.open(req) as resp:
-            if resp.status not in (200, 204):
-                raise ValueError("Request to {} returned HTTP status {}".format(url, resp.status))
-            content_length = resp.getheader('Content-Length')
-            if content_length:
-                data = resp.read(int(content_length))
-            else:
-                data = resp.read()
+        status, data = self.doh_pool.get(params, headers={'Accept': accept})
+        if status not in (200, 204):
+            raise ValueError("Request to {} returned HTTP status {}".format(
+                self.doh_pool.get_url(params), status))
         if not data:
-            raise ValueError("No data in response to {}".format(url))
+            raise ValueError("No data in response to {}".format(self.doh_pool.get_url(params)))
         return data
 
-    def dump_records(self, hide_dnssec=False):
-        """Enumerate the DNS records"""
+    @staticmethod
+    def analyze_records_for_dump(records, hide_dnssec=False):
+        """Describe known providers and find out the witnesses of wildcard domains"""
         comments_for_data = {}
-
-        def add_comment(key, comment):
-            if key not in comments_for_data:
-                comments_for_data[key] = set()
-            comments_for_data[key].add(comment)
-
-        # Find out wildcard domains using resolutions for "b.domain",
-        # "random.domain" and "xyz.domain"
-        wildcard_detectors = ('b.', 'random.', 'xyz.')
         wildcard_witness = {}
-
-        # Describe known providers
-        for domain, rtype, data in self.dns_records:
-            if hide_dnssec and rtype in ('DNSKEY', 'NSEC3PARAM', 'NSEC3', 'RRSIG'):
+        for domain, rtype, data in records:
+            if hide_dnssec and rtype in DNSSEC_RTYPES:
                 continue
             comment = get_comment_for_record(domain, rtype, data)
             if comment:
-                add_comment(data, comment)
+                if data not in comments_for_data:
+                    comments_for_data[data] = set()
+                comments_for_data[data].add(comment)
 
-            if domain.startswith(wildcard_detectors):
+            if domain.startswith(WILDCARD_DETECTORS):
                 wild_suffix = domain.split('.', 1)[1]
                 if wild_suffix not in wildcard_witness:
                     wildcard_witness[wild_suffix] = {}
@@ -827,13 +1274,16 @@ class Resolver:
                 if domain not in wildcard_witness[wild_suffix][rtype]:
                     wildcard_witness[wild_suffix][rtype][domain] = set()
                 wildcard_witness[wild_suffix][rtype][domain].add(data)
+        return comments_for_data, wildcard_witness
 
-        # Compute wildcard records
-        all_records = self.dns_records.copy()
-        wildcard_records_by_data = {}
+    @staticmethod
+    def compute_wildcard_records(wildcard_witness):
+        """Compute wildcard records, and index them in a trie"""
+        wildcard_records = set()
+        wildcard_trie = WildcardSuffixTrie()
         for wild_suffix, suffix_types_witnesses in wildcard_witness.items():
             for rtype, witnesses in suffix_types_witnesses.items():
-                if len(witnesses) != len(wildcard_detectors):
+                if len(witnesses) != len(WILDCARD_DETECTORS):
                     continue
                 wild_several_data = None
                 try:
@@ -843,58 +1293,171 @@ class Resolver:
                         if wild_several_data != several_data:
                             raise ValueError
                 except ValueError:
-                    # Not a wildcard
-                    break
+                    # Not a wildcard for this type. Do not stop processing the
+                    # other types of the suffix, as it would make the result
+                    # depend on the iteration order of the records.
+                    continue
                 assert wild_several_data is not None
                 # Add a wildcard record and filter-out existing ones
                 for data in wild_several_data:
-                    all_records.add(('*.' + wild_suffix, rtype, data))
-                    # Identify wildcard records by their data
-                    if (rtype, data) not in wildcard_records_by_data:
-                        wildcard_records_by_data[(rtype, data)] = set()
-                    wildcard_records_by_data[(rtype, data)].add(wild_suffix)
+                    wildcard_records.add(('*.' + wild_suffix, rtype, data))
+                    wildcard_trie.add(wild_suffix, rtype, data)
+        return wildcard_records, wildcard_trie
+
+    @staticmethod
+    def format_dump_line(record, max_domain_len, comments_for_data):
+        domain, rtype, data = record
+        padding = ' ' * (max_domain_len - len(domain)) if len(domain) < max_domain_len else ''
+        line = '{}{} {:6} {}'.format(padding, domain, rtype, data)
+
+        comments = comments_for_data.get(data)
+        if comments:
+            line += '  # ' + ', '.join(sorted(comments))
+        return line
+
+    def dump_records(self, hide_dnssec=False):
+        """Enumerate the DNS records"""
+        comments_for_data, wildcard_witness = self.analyze_records_for_dump(self.dns_records, hide_dnssec)
+        wildcard_records, wildcard_trie = self.compute_wildcard_records(wildcard_witness)
 
         # Filter-out wildcard records and compute the maximum length of a domain name
         max_domain_len = 0
-        deleted_records = set()
-        for domain, rtype, data in all_records:
-            is_deleted = False
-            for possible_wild_suffix in wildcard_records_by_data.get((rtype, data), []):
-                if domain != '*.' + possible_wild_suffix and domain.endswith('.' + possible_wild_suffix):
-                    deleted_records.add((domain, rtype, data))
-                    is_deleted = True
-                    continue
-            if is_deleted:
+        all_records = set()
+        for record in itertools.chain(self.dns_records, wildcard_records):
+            if wildcard_trie.covers(record):
                 continue
-            if rtype == 'PTR':
+            all_records.add(record)
+            if record[1] == 'PTR':
                 # Ignore long PTR records in max_domain_len computation
                 continue
-            if max_domain_len < len(domain):
-                max_domain_len = len(domain)
-
-        for rec in deleted_records:
-            all_records.remove(rec)
-
-        # Sort by domain name, and place rPTR entries right after A and AAAA ones.
-        items = sorted(
-            all_records,
-            key=lambda x: (dns_sortkey(x[0]), x[1].replace('rPTR', 'ArPTR'), x[2]))
-        for domain, rtype, data in items:
-            if hide_dnssec and rtype in ('DNSKEY', 'NSEC3PARAM', 'NSEC3', 'RRSIG'):
+            if max_domain_len < len(record[0]):
+                max_domain_len = len(record[0])
+
+        for record in sorted(all_records, key=dump_sortkey):
+            if hide_dnssec and record[1] in DNSSEC_RTYPES:
                 continue
-            padding = ' ' * (max_domain_len - len(domain)) if len(domain) < max_domain_len else ''
-            line = '{}{} {:6} {}'.format(padding, domain, rtype, data)
+            yield self.format_dump_line(record, max_domain_len, comments_for_data)
+
+    def dump_records_streaming(self, hide_dnssec=False, chunk_size=1000000):
+        """Enumerate the DNS records of the cache, with an external merge sort
+
+        This produces the same lines as dump_records, but reads the records
+        from the cache store instead of the in-memory set, and only keeps
+        chunk_size records in memory. Sorted chunks are written to temporary
+        files, which are merged while producing lines.
+        """
+        comments_for_data, wildcard_witness = self.analyze_records_for_dump(
+            self.iter_cached_records(), hide_dnssec)
+        wildcard_records, wildcard_trie = self.compute_wildcard_records(wildcard_witness)
+
+        with tempfile.TemporaryDirectory(prefix='resolve_domains-') as tmpdir:
+            # Filter-out wildcard records, compute the maximum length of a
+            # domain name and write sorted chunks of records
+            max_domain_len = 0
+            chunk_paths = []
+            chunk = set()
+            for record in itertools.chain(self.iter_cached_records(), wildcard_records):
+                if wildcard_trie.covers(record):
+                    continue
+                if record[1] != 'PTR' and max_domain_len < len(record[0]):
+                    max_domain_len = len(record[0])
+                if hide_dnssec and record[1] in DNSSEC_RTYPES:
+                    continue
+                chunk.add(record)
+                if len(chunk) >= chunk_size:
+                    chunk_paths.append(self.write_sorted_chunk(chunk, tmpdir, len(chunk_paths)))
+                    chunk = set()
+
+            if not chunk_paths:
+                sorted_records = sorted(chunk, key=dump_sortkey)
+            else:
+                if chunk:
+                    chunk_paths.append(self.write_sorted_chunk(chunk, tmpdir, len(chunk_paths)))
+                chunk = None
+                sorted_records = heapq.merge(
+                    *(self.iter_sorted_chunk(path) for path in chunk_paths),
+                    key=dump_sortkey)
+
+            # Records may appear in several chunks
+            previous_record = None
+            for record in sorted_records:
+                if record == previous_record:
+                    continue
+                previous_record = record
+                yield self.format_dump_line(record, max_domain_len, comments_for_data)
 
-            comments = comments_for_data.get(data)
-            if comments:
-                line += '  # ' + ', '.join(sorted(comments))
-            yield line
+    @staticmethod
+    def write_sorted_chunk(chunk, tmpdir, index):
+        """Write a chunk of records in a temporary file, in the order of the dump"""
+        path = Path(tmpdir) / 'chunk-{}.json'.format(index)
+        with path.open(mode='w') as fout:
+            for record in sorted(chunk, key=dump_sortkey):
+                fout.write(json.dumps(record) + '\n')
+        return path
+
+    @staticmethod
+    def iter_sorted_chunk(path):
+        with path.open(mode='r') as fchunk:
+            for line in fchunk:
+                yield tuple(json.loads(line))
+
+
+def benchmark_wildcard_filter(num_zones, names_per_zone=10, num_shared_data=3):
+    """Compare the filtering of wildcard records using a trie with a linear scan
+
+    The synthetic records describe many wildcard zones sharing a few CDN IP
+    addresses, which is the worst case of the linear scan.
+    """
+    rnd = random.Random(42)
+    shared_data = ['192.0.2.{}'.format(i) for i in range(num_shared_data)]
+    records = []
+    for zone_index in range(num_zones):
+        zone = 'zone{}.example.'.format(zone_index)
+        data = shared_data[zone_index % num_shared_data]
+        is_wildcard = zone_index % 2 == 0
+        for prefix in WILDCARD_DETECTORS:
+            records.append((prefix + zone, 'A', data if is_wildcard else '198.51.100.{}'.format(rnd.randrange(256))))
+        for name_index in range(names_per_zone):
+            records.append(('host{}.sub.{}'.format(name_index, zone), 'A', data))
+    print("Benchmarking the filtering of {} records in {} zones".format(len(records), num_zones))
+
+    _, wildcard_witness = Resolver.analyze_records_for_dump(records)
+    wildcard_records, wildcard_trie = Resolver.compute_wildcard_records(wildcard_witness)
+    all_records = records + sorted(wildcard_records)
+
+    # Index the wildcard suffixes by (type, data), like before the trie was introduced
+    suffixes_by_data = {}
+    for wild_domain, rtype, data in wildcard_records:
+        if (rtype, data) not in suffixes_by_data:
+            suffixes_by_data[(rtype, data)] = set()
+        suffixes_by_data[(rtype, data)].add(wild_domain[2:])
+
+    start_time = time.monotonic()
+    kept_with_scan = [
+        (domain, rtype, data) for domain, rtype, data in all_records
+        if not any(
+            domain != '*.' + suffix and domain.endswith('.' + suffix)
+            for suffix in suffixes_by_data.get((rtype, data), []))
+    ]
+    scan_time = time.monotonic() - start_time
+
+    start_time = time.monotonic()
+    kept_with_trie = [record for record in all_records if not wildcard_trie.covers(record)]
+    trie_time = time.monotonic() - start_time
+
+    if kept_with_scan != kept_with_trie:
+        raise RuntimeError("The trie and the linear scan kept different records")
+    print("{} wildcard records, {} records kept".format(len(wildcard_records), len(kept_with_trie)))
+    print("Linear scan: {:.3f} s".format(scan_time))
+    print("Suffix trie: {:.3f} s".format(trie_time))
 
 
 def main(argv=None):
     parser = argparse.ArgumentParser(description="Resolve DNS records")
-    parser.add_argument('file', metavar="DOMAINS_FILE", type=Path,
+    parser.add_argument('file', metavar="DOMAINS_FILE", type=Path, nargs='?',
                         help="file containing a list of domains to resolve")
+    parser.add_argument('--benchmark-wildcards', metavar="NUM_ZONES", type=int,
+                        help="benchmark the filtering of records covered by wildcards in synthetic zones")
     parser.add_argument('-d', '--directory', type=Path,
                         help="directory where DNS results are cached")
     parser.add_argument('-D', '--hide-dnssec', action='store_true',
@@ -913,23 +1476,71 @@ def main(argv=None):
                         nargs='*', type=ipaddress.ip_network,
                         help="resolve reverse (PTR) records for the IP addresses")
     parser.add_argument('-M', '--merge-cache', action='store_true',
-                        help="merge cache files together")
+                        help="merge cache files together, or compact the cache database")
+    parser.add_argument('-b', '--sqlite-cache', action='store_true',
+                        help="cache DNS results in a SQLite database in the cache directory")
+    parser.add_argument('--migrate-cache', action='store_true',
+                        help="move the JSON files of the cache directory to the SQLite database")
+    parser.add_argument('--streaming-dump', action='store_true',
+                        help="sort the records on disk when producing the output, to bound memory usage")
+    parser.add_argument('--sort-chunk-size', type=int, default=1000000,
+                        help="number of records sorted in memory, with --streaming-dump")
     parser.add_argument('-p', '--prefixes', action='store_true',
                         help="add some well-known prefixes to the domains")
     parser.add_argument('-s', '--sort', action='store_true',
                         help="sort the domains of the input file")
     parser.add_argument('-S', '--no-ssl', action='store_true',
                         help="disable security of HTTPS queries")
-    parser.add_argument('-t', '--time-sleep', type=int, default=1,
-                        help="number of seconds to sleep between DNS queries")
+    parser.add_argument('-t', '--time-sleep', type=int,
+                        help="number of seconds to sleep between DNS queries (default: 1 without --jobs)")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="number of concurrent DNS queries, which are only rate-limited with --rate "
+                        "or --time-sleep")
+    parser.add_argument('-r', '--rate', type=float,
+                        help="maximum number of DNS queries per second to each upstream, with --jobs")
+    parser.add_argument('--burst', type=int, default=1,
+                        help="number of DNS queries which can be sent in a burst, with --rate")
+    parser.add_argument('-u', '--doh-url', type=str,
+                        help="URL of the DNS-over-HTTPS JSON API, with -g or -C")
+    parser.add_argument('--pool-size', type=int,
+                        help="number of persistent connections to the DNS-over-HTTPS API (default: --jobs)")
+    parser.add_argument('-N', '--nameserver', action='append',
+                        help="IP address of a DNS server to query, when not using a DNS-over-HTTPS API")
+    parser.add_argument('--dns-port', type=int, default=53,
+                        help="port of the DNS servers")
     args = parser.parse_args(argv)
 
+    if args.benchmark_wildcards:
+        benchmark_wildcard_filter(args.benchmark_wildcards)
+        return
+
+    if args.file is None:
+        parser.error("please provide a file containing domains")
+
     if args.directory is None:
         parser.error("please provide a cache directory with option -d/--directory")
 
     if args.use_google and args.use_cloudflare:
         parser.error("options to use a DNS-JSON provider are mutually exclusive")
 
+    if args.doh_url and not (args.use_google or args.use_cloudflare):
+        parser.error("option --doh-url requires a DNS-JSON provider")
+
+    if args.migrate_cache and not args.sqlite_cache:
+        parser.error("option --migrate-cache requires a SQLite cache")
+
+    if args.jobs < 1:
+        parser.error("the number of jobs needs to be positive")
+
+    time_sleep = args.time_sleep
+    if time_sleep is None:
+        time_sleep = 1 if args.jobs == 1 else 0
+
+    rate_limit = args.rate
+    if rate_limit is None and args.time_sleep:
+        # Keep the same average rate as when sleeping after each query, if it was requested
+        rate_limit = 1. / args.time_sleep
+
     # Load the list of domains
     with args.file.open(mode='r') as fdomains:
         raw_domains = [l.rstrip('\n') for l in fdomains.readlines()]
@@ -948,24 +1559,46 @@ def main(argv=None):
     # Create the cache directory, if it does not exist
     args.directory.mkdir(exist_ok=True)
 
+    if args.sqlite_cache:
+        cache_store = SqliteCacheStore(args.directory / 'cache.sqlite3')
+        if args.migrate_cache:
+            count = cache_store.import_directory(args.directory, remove_files=True)
+            print("Migrated {} cached responses to {}".format(count, cache_store.db_path))
+        elif any(args.directory.glob('*.json')):
+            print("Warning: ignoring JSON files in {} (use --migrate-cache to import them)".format(args.directory))
+    else:
+        cache_store = DirectoryCacheStore(args.directory)
+
     resolver = Resolver(
-        cache_directory=args.directory,
-        time_sleep=args.time_sleep,
+        cache_store=cache_store,
+        time_sleep=time_sleep,
         use_google=args.use_google,
         use_cloudflare=args.use_cloudflare,
         no_ssl=args.no_ssl,
+        jobs=args.jobs,
+        rate_limit=rate_limit,
+        rate_burst=args.burst,
+        google_url=args.doh_url or GOOGLE_DOH_URL,
+        cloudflare_url=args.doh_url or CLOUDFLARE_DOH_URL,
+        nameservers=args.nameserver,
+        dns_port=args.dns_port,
+        pool_size=args.pool_size,
+        keep_records=not args.streaming_dump,
     )
 
+    def questions_for_domains(domains_to_resolve):
+        for domain in domains_to_resolve:
+            # Treat SRV records in a special way, to restrict the requested record type
+            resolving_types = DNS_SRV_TYPES if '._tcp.' in domain or '._udp.' in domain else DNS_TYPES
+            for rtype in resolving_types:
+                # Do not resolve PTR for normal domains
+                if rtype != 'PTR':
+                    yield (domain, rtype)
+
     # Fill the cache
     domains = list(domains_set)
     random.SystemRandom().shuffle(domains)  # Do not be predictable
-    for domain in domains:
-        # Treat SRV records in a special way, to restrict the requested record type
-        resolving_types = DNS_SRV_TYPES if '._tcp.' in domain or '._udp.' in domain else DNS_TYPES
-        for rtype in resolving_types:
-            # Do not resolve PTR for normal domains
-            if rtype != 'PTR':
-                resolver.resolve_in_cache(domain, rtype)
+    resolver.resolve_questions(questions_for_domains(domains))
 
     # Resolve with well-known prefixes
     if args.prefixes:
@@ -973,41 +1606,50 @@ def main(argv=None):
             '{}.{}'.format(p, d)
             for p, d in itertools.product(WELLKNOWN_PREFIXES, domains))
         random.SystemRandom().shuffle(domains_with_prefixes)  # Do not be predictable
-        for domain in domains_with_prefixes:
-            resolving_types = DNS_SRV_TYPES if '._tcp.' in domain or '._udp.' in domain else DNS_TYPES
-            for rtype in resolving_types:
-                if rtype != 'PTR':
-                    resolver.resolve_in_cache(domain, rtype)
+        resolver.resolve_questions(questions_for_domains(domains_with_prefixes))
 
     # Load the cache
     resolver.load_cache(if_dirty=True)
 
     # Resolve PTR records given on the command line
     if args.ipaddr:
-        for ip_net in args.ipaddr:
-            resolver.resolve_ip(ip_net.network_address)
-            if ip_net.num_addresses >= 2:
-                for ip_addr in ip_net.hosts():
-                    resolver.resolve_ip(ip_addr)
-                resolver.resolve_ip(ip_net.broadcast_address)
+        def ip_addresses_in_networks():
+            for ip_net in args.ipaddr:
+                yield ip_net.network_address
+                if ip_net.num_addresses >= 2:
+                    for ip_addr in ip_net.hosts():
+                        yield ip_addr
+                    yield ip_net.broadcast_address
+
+        resolver.resolve_questions(
+            (resolver.get_ptr_name_for_ip(ip_addr), 'PTR')
+            for ip_addr in ip_addresses_in_networks())
         resolver.load_cache(if_dirty=True)
 
-    # Get all the A records, in order to get PTR
-    all_ipv4_addresses = set(x[2] for x in resolver.dns_records if x[1] == 'A')
-    for ip_addr in all_ipv4_addresses:
-        resolver.resolve_ip(ip_addr, version=4)
-
-    # Get all the AAAA records, in order to get PTR
-    all_ipv6_addresses = set(x[2] for x in resolver.dns_records if x[1] == 'AAAA')
-    for ip_addr in all_ipv6_addresses:
-        resolver.resolve_ip(ip_addr, version=6)
+    # Get all the A and AAAA records, in order to get PTR
+    all_ipv4_addresses = set()
+    all_ipv6_addresses = set()
+    for _, rtype, data in resolver.iter_records():
+        if rtype == 'A':
+            all_ipv4_addresses.add(data)
+        elif rtype == 'AAAA':
+            all_ipv6_addresses.add(data)
+    resolver.resolve_questions(
+        (resolver.get_ptr_name_for_ip(ip_addr, version=4), 'PTR')
+        for ip_addr in all_ipv4_addresses)
+    resolver.resolve_questions(
+        (resolver.get_ptr_name_for_ip(ip_addr, version=6), 'PTR')
+        for ip_addr in all_ipv6_addresses)
 
     # Reload the cache, if needed
     resolver.load_cache(if_dirty=True)
 
+    if resolver.doh_pool is not None and resolver.doh_pool.stats['requests']:
+        print("DNS-over-HTTPS: {}".format(resolver.doh_pool.format_stats()))
+
     # Filter-out non-existing domains from the input file
     if args.filter_exist:
-        found_domains = set(x[0].rstrip('.') for x in resolver.dns_records)
+        found_domains = set(x[0].rstrip('.') for x in resolver.iter_records())
         sorted_domains = sorted(set(domains).intersection(found_domains), key=dns_sortkey)
         if sorted_domains != domains:
             # Write the sorted list back
@@ -1015,19 +1657,27 @@ def main(argv=None):
                 fout.write(''.join((d + '\n') for d in sorted_domains))
 
     # Produce the output
+    def dump_records():
+        if args.streaming_dump:
+            return resolver.dump_records_streaming(
+                hide_dnssec=args.hide_dnssec, chunk_size=args.sort_chunk_size)
+        return resolver.dump_records(hide_dnssec=args.hide_dnssec)
+
     if args.output:
         with args.output.open(mode='w') as fout:
-            for line in resolver.dump_records(hide_dnssec=args.hide_dnssec):
+            for line in dump_records():
                 fout.write(line + '\n')
 
     if args.stdout or not args.output:
-        for line in resolver.dump_records(hide_dnssec=args.hide_dnssec):
+        for line in dump_records():
             print(line)
 
     # Merge all cache files together
     if args.merge_cache:
         resolver.merge_cache_files()
 
+    resolver.close()
+
 
 if __name__ == '__main__':
     main()
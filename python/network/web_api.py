@@ -2,12 +2,26 @@
 """Base primitives to communicate with a web server
 
 This is like Python’s Requests Library, but with a more low-level approach
+
+The connections are kept alive in a thread-safe pool, so that several requests
+to a website only perform the TCP and TLS handshakes once. AsyncWebSiteContext
+provides the same methods to asyncio coroutines, and batch() methods perform
+many requests concurrently.
 """
 
 import argparse
+import asyncio
+import base64
+import codecs
+import concurrent.futures
+import functools
+import http.client
 import http.cookiejar
+import io
 import json
 import logging
+import threading
+import urllib.error
 import urllib.parse
 import urllib.request
 import ssl
@@ -34,26 +48,322 @@ USER_AGENTS = {
 }
 
 
-def disable_ssl_cert_check_opener():
-    """Do not verify the HTTPS certificate
+# Default number of requests which are performed concurrently by batches
+DEFAULT_MAX_CONCURRENCY = 8
+
+# Size of the chunks which are read from streamed responses
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Methods of requests which can be sent again when the server closed a reused connection
+# without answering, even though it may have already processed the request
+IDEMPOTENT_METHODS = frozenset(('DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT', 'TRACE'))
+
+
+def disable_ssl_cert_check_context():
+    """Create a SSL context which does not verify the HTTPS certificate
 
     This enables using a HTTPS proxy wuch as BurpSuite
     """
     ctx = ssl.create_default_context()
     ctx.check_hostname = False
     ctx.verify_mode = ssl.CERT_NONE  # noqa
-    return urllib.request.HTTPSHandler(context=ctx)
+    return ctx
+
 
+class HTTPConnectionPool(object):
+    """Thread-safe pool of persistent HTTP/1.1 connections, kept for each host
 
-class NoRedirectHandler(urllib.request.HTTPRedirectHandler):
-    """Perform HTTP requests without following HTTP redirects"""
-    def redirect_request(self, req, fp, code, msg, hdrs, newurl):
-        pass
+    Like urllib, the proxies are configured by environment variables such as
+    http_proxy and https_proxy by default. HTTPS connections are tunneled
+    through the proxy with CONNECT, and HTTP requests are sent to the proxy
+    with the absolute URI of the resource.
+    """
+    def __init__(self, ssl_context=None, max_idle_per_host=DEFAULT_MAX_CONCURRENCY, timeout=None, proxies=None):
+        self.ssl_context = ssl_context
+        self.max_idle_per_host = max_idle_per_host
+        self.timeout = timeout
+        # Dictionary of scheme -> URL of the proxy, like urllib.request.ProxyHandler
+        self.proxies = urllib.request.getproxies() if proxies is None else proxies
+        self.lock = threading.Lock()
+        # Dictionary of (scheme, host, port) -> list of idle connections
+        self.idle_connections = {}
+        self.stats = {
+            'connections': 0,  # Number of opened connections
+            'requests': 0,  # Number of sent requests
+            'reused': 0,  # Number of requests sent on a connection which was already used
+            'retries': 0,  # Number of requests sent again after the server closed an idle connection
+        }
+
+    def increment_stat(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    @staticmethod
+    def get_key(url):
+        """Get the key of the connections which can be used for an URL"""
+        url_parts = urllib.parse.urlsplit(url)
+        if url_parts.scheme not in ('http', 'https'):
+            raise ValueError("Unsupported URL scheme in {}".format(repr(url)))
+        return url_parts.scheme, url_parts.hostname, url_parts.port
+
+    def get_proxy(self, key):
+        """Get the URL parts of the proxy used to connect to a server, or None to connect directly"""
+        scheme, host, _ = key
+        proxy_url = self.proxies.get(scheme)
+        if not proxy_url or urllib.request.proxy_bypass(host):
+            return None
+        if '://' not in proxy_url:
+            # Like urllib, accept "host:port" as a proxy
+            proxy_url = 'http://' + proxy_url
+        proxy = urllib.parse.urlsplit(proxy_url)
+        if proxy.scheme != 'http':
+            raise ValueError("Unsupported proxy scheme in {}".format(repr(proxy_url)))
+        return proxy
+
+    @staticmethod
+    def get_proxy_headers(proxy):
+        """Get the headers which authenticate to a proxy"""
+        if proxy.username is None:
+            return {}
+        credentials = '{}:{}'.format(urllib.parse.unquote(proxy.username), urllib.parse.unquote(proxy.password or ''))
+        return {'Proxy-Authorization': 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii')}
+
+    def open_connection(self, key):
+        """Open a new connection to a server, through a proxy if one is configured"""
+        scheme, host, port = key
+        self.increment_stat('connections')
+        proxy = self.get_proxy(key)
+        if proxy is None:
+            if scheme == 'http':
+                return http.client.HTTPConnection(host, port, timeout=self.timeout)
+            return http.client.HTTPSConnection(host, port, timeout=self.timeout, context=self.ssl_context)
+        if scheme == 'http':
+            return http.client.HTTPConnection(proxy.hostname, proxy.port, timeout=self.timeout)
+        conn = http.client.HTTPSConnection(proxy.hostname, proxy.port, timeout=self.timeout, context=self.ssl_context)
+        conn.set_tunnel(host, port, headers=self.get_proxy_headers(proxy))
+        return conn
+
+    def send_request(self, conn, method, path, body, headers):
+        """Send a request and receive the headers of its response"""
+        self.increment_stat('requests')
+        conn.request(method, path, body=body, headers=headers)
+        return conn.getresponse()
+
+    def request(self, method, url, body=None, headers=None):
+        """Send a request, returning the connection and the response with its body not read yet
+
+        The connection needs to be given back with release() once the body has been read.
+        """
+        key = self.get_key(url)
+        url_parts = urllib.parse.urlsplit(url)
+        path = url_parts.path or '/'
+        if url_parts.query:
+            path += '?' + url_parts.query
+        headers = headers or {}
+        if key[0] == 'http':
+            proxy = self.get_proxy(key)
+            if proxy is not None:
+                # The proxy gets the absolute URI, without fragment
+                path = urllib.parse.urlunsplit(url_parts[:4] + ('', ))
+                headers = dict(headers, **self.get_proxy_headers(proxy))
+
+        with self.lock:
+            idle_connections = self.idle_connections.get(key)
+            conn = idle_connections.pop() if idle_connections else None
+        if conn is None:
+            conn = self.open_connection(key)
+            resp = self.send_request(conn, method, path, body, headers)
+        else:
+            self.increment_stat('reused')
+            self.increment_stat('requests')
+            resp = None
+            try:
+                conn.request(method, path, body=body, headers=headers)
+            except (http.client.HTTPException, ConnectionError):
+                # The server closed the idle connection before receiving the request
+                conn.close()
+            else:
+                try:
+                    resp = conn.getresponse()
+                except (http.client.HTTPException, ConnectionError):
+                    # The server closed the connection without answering, maybe after
+                    # processing the request: only send it again if this is harmless
+                    conn.close()
+                    if method.upper() not in IDEMPOTENT_METHODS:
+                        raise
+            if resp is None:
+                self.increment_stat('retries')
+                conn = self.open_connection(key)
+                resp = self.send_request(conn, method, path, body, headers)
+        return key, conn, resp
+
+    def release(self, key, conn, resp):
+        """Give back a connection after its response has been used"""
+        if not resp.will_close and not resp.isclosed() and resp.length is not None \
+                and resp.length <= STREAM_CHUNK_SIZE:
+            # Read the rest of a short body, such as the empty one of 204 responses
+            # which is never read, so that the connection can be reused
+            try:
+                resp.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                return
+        if resp.will_close or not resp.isclosed():
+            # The connection cannot be used by another request if the body was not completely read
+            conn.close()
+            return
+        with self.lock:
+            idle_connections = self.idle_connections.setdefault(key, [])
+            if len(idle_connections) < self.max_idle_per_host:
+                idle_connections.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """Close all the idle connections"""
+        with self.lock:
+            idle_connections = self.idle_connections
+            self.idle_connections = {}
+        for connections in idle_connections.values():
+            for conn in connections:
+                conn.close()
+
+    def format_stats(self):
+        """Describe how the connections were used"""
+        with self.lock:
+            stats = self.stats.copy()
+        return "{} requests using {} connections ({} reused, {} retried)".format(
+            stats['requests'], stats['connections'], stats['reused'], stats['retries'])
+
+
+class StreamedResponse(object):
+    """Body of a HTTP response, read while it is being received
+
+    http.client decodes chunked transfer encoding, and reads bodies without
+    Content-Length until the server closes the connection. Once closed, the
+    connection goes back to the pool if the body was completely read.
+    """
+    def __init__(self, pool, key, conn, resp):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.resp = resp
+        self.closed = False
+
+    @property
+    def status(self):
+        return self.resp.status
+
+    def getheader(self, name, default=None):
+        return self.resp.getheader(name, default)
+
+    def read(self, size=-1):
+        """Read at most size bytes, or all the remaining data if size is negative"""
+        if size is None or size < 0:
+            return self.resp.read()
+        return self.resp.read(size)
+
+    def iter_chunks(self, chunk_size=STREAM_CHUNK_SIZE):
+        """Iterate over the chunks of the body, as soon as they are received"""
+        while True:
+            chunk = self.resp.read1(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def __iter__(self):
+        return self.iter_chunks()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.pool.release(self.key, self.conn, self.resp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def iter_json_array(stream, chunk_size=STREAM_CHUNK_SIZE):
+    """Decode a JSON array incrementally from a stream, yielding its items
+
+    Only the item being decoded is kept in memory, which enables processing
+    very large API responses.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = stream.iter_chunks(chunk_size) if hasattr(stream, 'iter_chunks') else iter(
+        functools.partial(stream.read, chunk_size), b'')
+    buffer = ''
+    pos = 0
+    eof = False
+
+    def skip_whitespace():
+        """Skip whitespace, reading more data if needed, and return the next character or None at the end"""
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buffer):
+                return buffer[pos]
+            if eof:
+                return None
+            read_more()
+
+    def read_more():
+        """Append a chunk to the buffer, dropping the data which was already decoded"""
+        nonlocal buffer, pos, eof
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+            buffer = buffer[pos:] + text_decoder.decode(b'', final=True)
+        else:
+            buffer = buffer[pos:] + text_decoder.decode(chunk)
+        pos = 0
+
+    if skip_whitespace() != '[':
+        raise ValueError("The JSON response is not an array")
+    pos += 1
+    if skip_whitespace() == ']':
+        pos += 1
+    else:
+        while True:
+            if skip_whitespace() is None:
+                raise ValueError("Truncated JSON array")
+            while True:
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    read_more()
+                    continue
+                # A number may continue in the next chunk, for example "1" in "1.5e3"
+                if eof or (end < len(buffer) and buffer[end] not in '.eE+-'):
+                    break
+                read_more()
+            pos = end
+            yield item
+
+            separator = skip_whitespace()
+            pos += 1
+            if separator == ']':
+                break
+            if separator != ',':
+                raise ValueError("Unexpected character {} in JSON array".format(repr(separator)))
+    if skip_whitespace() is not None:
+        raise ValueError("Unexpected data after the JSON array")
 
 
 class WebSiteContext(object):
-    """Context associated with a website"""
-    def __init__(self, base_url, disable_ssl_check=False, is_ajax_api=False):
+    """Context associated with a website
+
+    This is thread-safe: several threads can perform requests with the same
+    context, sharing its cookie jar and its pool of connections.
+    """
+    def __init__(self, base_url, disable_ssl_check=False, is_ajax_api=False, pool_size=DEFAULT_MAX_CONCURRENCY):
         # base_url is https://my-website.example.org/sub-directory
         self.base_url = base_url.rstrip('/')
         self.cookie_jar = http.cookiejar.CookieJar()
@@ -61,7 +371,6 @@ class WebSiteContext(object):
 
         self.default_headers = {
             'Referer': self.base_url + '/',
-            'Connection': 'close',
             'User-Agent': USER_AGENTS['chrome-74_windows-x64'],
             'Accept': '*/*',
         }
@@ -71,9 +380,14 @@ class WebSiteContext(object):
             self.default_headers['X-Requested-With'] = 'XMLHttpRequest'
 
         if disable_ssl_check:
-            self.ssl_opener = disable_ssl_cert_check_opener()
+            ssl_context = disable_ssl_cert_check_context()
         else:
-            self.ssl_opener = urllib.request.HTTPSHandler()
+            ssl_context = ssl.create_default_context()
+        self.pool = HTTPConnectionPool(ssl_context=ssl_context, max_idle_per_host=pool_size)
+
+    def close(self):
+        """Close the connections which are kept alive"""
+        self.pool.close()
 
     def get_cookie(self, name):
         """Retrieve the value of a cookie from the cookie jar"""
@@ -82,8 +396,8 @@ class WebSiteContext(object):
                 return cookie.value
         return None
 
-    def http_request(self, method, uri, data=None, headers=None, read_all=False):
-        """Perform a HTTP request"""
+    def http_request_stream(self, method, uri, data=None, headers=None):
+        """Perform a HTTP request, returning a StreamedResponse to read its body"""
         # Fill the headers using the default ones
         if headers is None:
             headers = {}
@@ -95,41 +409,61 @@ class WebSiteContext(object):
         url = self.base_url + uri
         logger.debug("HTTP %s %r", method, url)
         req = urllib.request.Request(url, data=data, headers=headers, method=method)
+        self.cookie_jar.add_cookie_header(req)
 
-        cookies = urllib.request.HTTPCookieProcessor(cookiejar=self.cookie_jar)
-        opener = urllib.request.build_opener(self.ssl_opener, cookies, NoRedirectHandler())
+        # Redirections are not followed
+        key, conn, resp = self.pool.request(method, url, body=data, headers=dict(req.header_items()))
         try:
-            with opener.open(req) as resp:
-                if resp.status not in (200, 204):
-                    logger.error("Request to %r returned HTTP status %d", uri, resp.status)
-                    raise ValueError(resp)
-                content_length = int(resp.getheader('Content-Length', '0'))
-                if content_length:
-                    data = resp.read(content_length)
-                elif read_all:
-                    data = resp.read()
-                else:
-                    data = None
-                return resp, data
+            self.cookie_jar.extract_cookies(resp, req)
+            if resp.status >= 300:
+                # Report HTTP errors like urllib does
+                error_body = resp.read()
+                raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, io.BytesIO(error_body))
+            if resp.status not in (200, 204):
+                logger.error("Request to %r returned HTTP status %d", uri, resp.status)
+                raise ValueError(resp)
         except urllib.error.HTTPError as exc:
             # If there are HTTP errors, they can be caught here
+            self.pool.release(key, conn, resp)
             if exc.status in (400, 401, 403, 405):
                 # There may be an error message in the content
-                content_length = int(exc.getheader('Content-Length', '0'))
-                content_type = exc.getheader('Content-Type', '')
+                content_length = int(exc.headers.get('Content-Length', '0'))
+                content_type = exc.headers.get('Content-Type', '')
                 data = exc.read(content_length) if content_length else None
                 if content_length and content_type == 'application/json;charset=UTF-8':
                     data = json.loads(data)
                 logger.error("Got HTTP %d %r", exc.status, data)
             raise exc
+        except BaseException:
+            self.pool.release(key, conn, resp)
+            raise
+        return StreamedResponse(self.pool, key, conn, resp)
+
+    def http_request(self, method, uri, data=None, headers=None, read_all=False):
+        """Perform a HTTP request"""
+        with self.http_request_stream(method, uri, data=data, headers=headers) as stream:
+            resp = stream.resp
+            content_length = int(resp.getheader('Content-Length', '0'))
+            if content_length:
+                data = stream.read(content_length)
+            elif read_all:
+                data = stream.read()
+            else:
+                data = None
+            return resp, data
 
     @staticmethod
-    def decode_http_json_response(resp, data):
-        """Decode the response from a JSON REST API"""
+    def check_json_content_type(resp):
+        """Check that the response of a JSON REST API is JSON"""
         content_type = resp.getheader('Content-Type', '')
         if content_type != 'application/json;charset=UTF-8':
             logger.error("Unexpected HTTP content type for JSON response: %r", content_type)
             raise ValueError
+
+    @classmethod
+    def decode_http_json_response(cls, resp, data):
+        """Decode the response from a JSON REST API"""
+        cls.check_json_content_type(resp)
         return json.loads(data)
 
     def get(self, uri, **get_params):
@@ -168,6 +502,144 @@ class WebSiteContext(object):
         resp, data = self.post_json(uri, json_data)
         return self.decode_http_json_response(resp, data)
 
+    def get_stream(self, uri, **get_params):
+        """Perform a GET request with GET parameters, returning a StreamedResponse"""
+        data = urllib.parse.urlencode(get_params)
+        if data:
+            uri += '?' + data
+        return self.http_request_stream('GET', uri)
+
+    def post_json_stream(self, uri, json_data):
+        """Perform a POST request with JSON parameters, returning a StreamedResponse"""
+        data = json.dumps(json_data).encode('utf-8')
+        return self.http_request_stream('POST', uri, data=data, headers={
+            'Content-Type': 'application/json',
+        })
+
+    def get_and_json_array(self, uri, **get_params):
+        """Perform a GET request and iterate over the items of a JSON array response, while receiving it"""
+        with self.get_stream(uri, **get_params) as stream:
+            self.check_json_content_type(stream.resp)
+            for item in iter_json_array(stream):
+                yield item
+
+    def post_json_and_json_array(self, uri, json_data):
+        """Perform a POST-JSON request and iterate over the items of a JSON array response"""
+        with self.post_json_stream(uri, json_data) as stream:
+            self.check_json_content_type(stream.resp)
+            for item in iter_json_array(stream):
+                yield item
+
+    def batch(self, requests, max_concurrency=DEFAULT_MAX_CONCURRENCY, return_exceptions=False):
+        """Perform several requests concurrently, returning their results in order
+
+        Each request is a tuple (method name, arguments) or (method name, arguments, keyword arguments),
+        for example ('get_and_json', ('/api/items', )). With return_exceptions,
+        the exceptions are returned as results instead of being raised.
+        """
+        def perform(request):
+            method_name, args = request[:2]
+            kwargs = request[2] if len(request) > 2 else {}
+            try:
+                return getattr(self, method_name)(*args, **kwargs)
+            except Exception as exc:  # pylint: disable=broad-except
+                if return_exceptions:
+                    return exc
+                raise
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            return list(executor.map(perform, requests))
+
+
+class AsyncWebSiteContext(object):
+    """asyncio counterpart of WebSiteContext
+
+    The requests are performed by the methods of a WebSiteContext in a pool of
+    threads, which share its cookie jar and its persistent connections. At
+    most max_concurrency requests are performed at the same time.
+    """
+    def __init__(self, website_context, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        self.website_context = website_context
+        self.cookie_jar = website_context.cookie_jar
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency)
+
+    def close(self):
+        """Wait for the running requests and close the connections"""
+        self.executor.shutdown(wait=True)
+        self.website_context.close()
+
+    async def run(self, method_name, *args, **kwargs):
+        """Run a method of the WebSiteContext in the pool of threads"""
+        method = functools.partial(getattr(self.website_context, method_name), *args, **kwargs)
+        return await asyncio.get_event_loop().run_in_executor(self.executor, method)
+
+    def get_cookie(self, name):
+        """Retrieve the value of a cookie from the cookie jar"""
+        return self.website_context.get_cookie(name)
+
+    async def http_request(self, method, uri, data=None, headers=None, read_all=False):
+        """Perform a HTTP request"""
+        return await self.run('http_request', method, uri, data=data, headers=headers, read_all=read_all)
+
+    async def get(self, uri, **get_params):
+        """Perform a GET request with GET parameters"""
+        return await self.run('get', uri, **get_params)
+
+    async def get_and_json(self, uri, **get_params):
+        """Perform a GET request and expect a JSON response"""
+        return await self.run('get_and_json', uri, **get_params)
+
+    async def post(self, uri, **post_params):
+        """Perform a POST request with POST parameters"""
+        return await self.run('post', uri, **post_params)
+
+    async def post_json(self, uri, json_data):
+        """Perform a POST request with JSON parameters"""
+        return await self.run('post_json', uri, json_data)
+
+    async def post_and_json(self, uri, **post_params):
+        """Perform a POST request and expect a JSON response"""
+        return await self.run('post_and_json', uri, **post_params)
+
+    async def post_json_and_json(self, uri, json_data):
+        """Perform a POST-JSON request and expect a JSON response"""
+        return await self.run('post_json_and_json', uri, json_data)
+
+    async def iter_json_array(self, method_name, *args, **kwargs):
+        """Iterate over the items of a JSON array response, such as get_and_json_array()
+
+        The items are decoded in the pool of threads while the response is received.
+        """
+        items = getattr(self.website_context, method_name)(*args, **kwargs)
+        loop = asyncio.get_event_loop()
+        end = object()
+        try:
+            while True:
+                item = await loop.run_in_executor(self.executor, next, items, end)
+                if item is end:
+                    return
+                yield item
+        finally:
+            # Close the response in the pool of threads too, as the generator may be running there
+            await loop.run_in_executor(self.executor, items.close)
+
+    def get_and_json_array(self, uri, **get_params):
+        """Perform a GET request and iterate asynchronously over the items of a JSON array response"""
+        return self.iter_json_array('get_and_json_array', uri, **get_params)
+
+    def post_json_and_json_array(self, uri, json_data):
+        """Perform a POST-JSON request and iterate asynchronously over the items of a JSON array response"""
+        return self.iter_json_array('post_json_and_json_array', uri, json_data)
+
+    async def batch(self, requests, return_exceptions=False):
+        """Perform several requests concurrently, like WebSiteContext.batch()"""
+        coroutines = []
+        for request in requests:
+            method_name, args = request[:2]
+            kwargs = request[2] if len(request) > 2 else {}
+            coroutines.append(self.run(method_name, *args, **kwargs))
+        return await asyncio.gather(*coroutines, return_exceptions=return_exceptions)
+
 
 def main(argv=None):
     parser = argparse.ArgumentParser(description="Connect to a website")
@@ -183,6 +655,7 @@ def main(argv=None):
     resp, main_page = ctx.http_request('GET', '/', read_all=True)
     logger.debug("Response code: %d", resp.status)
     print(main_page)
+    ctx.close()
 
 
 if __name__ == '__main__':